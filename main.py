@@ -1,3 +1,4 @@
+import os
 import argparse
 
 import sys
@@ -5,7 +6,7 @@ sys.path.append("./src")
 
 from tensorflow.keras.models import load_model
 from seg.utils import load_infer_model
-from seg import predict
+from seg import predict, stream
 from reg import infer_reg
 
 def parse_args():
@@ -15,7 +16,17 @@ def parse_args():
     parser.add_argument('--model_path', type=str,
                         default="./models/regression_model.hdf5")
     parser.add_argument('--method', type=str, default='r',
-                        help="'r': regression, 's': segmentation")
+                        help="'r': regression, 's': segmentation, 'v': segmentation of a video / image sequence")
+    parser.add_argument('--n_snapshots', type=int, default=None,
+                        help="when model_path is a training directory, ensemble its last n SGDR snapshots (all by default)")
+    parser.add_argument('--optimize', action='store_true',
+                        help="fold BatchNorm and drop Dropout before predicting (segmentation only)")
+    parser.add_argument('--pixel_size', type=float, default=None,
+                        help="pixel size (mm) of the image / video frames, required by models trained with config['mm_per_pixel']; head circumference of a video in pixels if not set")
+    parser.add_argument('--save_path', type=str, default=None,
+                        help="csv of the per frame results of the video")
+    parser.add_argument('--cache_dir', type=str, default=None,
+                        help="prediction cache (segmentation only), an image already seen by the model is not predicted again")
     return parser.parse_args()
 
 
@@ -29,6 +40,21 @@ if __name__ == "__main__":
         model = load_model(model_path, compile=False)
         infer_reg.show_pred(image_path, model, mask_path)
 
+    if args.method in ['s', 'v']:
+        # loaded on first use, a cached prediction does not need it
+        if os.path.isdir(model_path):
+            model = predict.LazyModel(lambda: predict.load_ensemble_model(model_path,
+                                                                          n_snapshots=args.n_snapshots,
+                                                                          optimize=args.optimize))
+        else:
+            model = predict.LazyModel(lambda: load_infer_model(model_path, optimize=args.optimize))
+
     if args.method == 's':
-        model = load_infer_model(model_path)
-        predict.plot_pred(model, image_path, mask_path)
+        cache = None
+        if args.cache_dir:
+            cache = predict.open_cache(args.cache_dir, model_path,
+                                       n_snapshots=args.n_snapshots, optimize=args.optimize)
+        predict.plot_pred(model, image_path, mask_path, cache=cache, pixel_size=args.pixel_size)
+
+    if args.method == 'v':
+        stream.stream(model, image_path, pixel_size=args.pixel_size, save_path=args.save_path)
@@ -8,7 +8,8 @@ from PIL import Image
 import tensorflow as tf
 import matplotlib.pyplot as plt
 
-from reg.data import DataLoader, read_image_by_tf
+from reg.data import DataLoader
+from seg.data import read_image_by_tf
 
 data = DataLoader("../data/training_set",
                   one_hot_encoding=True,
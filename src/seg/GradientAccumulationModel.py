@@ -0,0 +1,95 @@
+import tensorflow as tf
+from tensorflow.keras.models import Model
+
+
+class GradientAccumulationModel(Model):
+    '''Functional model whose train step accumulates gradients over micro-batches.
+    # Usage
+        ```python
+            model = with_gradient_accumulation(unet(), accum_steps=4)
+            model.compile(...)
+            model.fit(data.data_gen(64), ...)  # 4 micro-batches of 16, one update per batch of 64
+        ```
+    # Arguments
+        accum_steps: Number of micro-batches every incoming batch is split into. Gradients of the
+                     micro-batches are summed (weighted by their size) and applied once, so the
+                     update is the one of the full batch while only one micro-batch of activations
+                     is alive at a time.
+    # Notes
+        The dataset batch size is the effective batch size, one optimizer step (and one
+        SGDRScheduler step) is taken per dataset batch.
+        BatchNormalization normalises every micro-batch with its own statistics and updates its
+        moving statistics once per micro-batch, i.e. accum_steps times per optimizer step. With
+        micro-batches below ~8 images the batch statistics get noisy, prefer freezing the BN layers
+        (fine-tuning) or keeping the micro-batch size at least at 8.
+    '''
+
+    # not a constructor argument: Keras only serialises subclasses of functional models
+    # whose __init__ has the functional signature, see get_config / from_config
+    accum_steps = 1
+
+    def train_step(self, data):
+        x, y = data[0], data[1]
+
+        batch_size = tf.shape(x)[0]
+        batch_size_f = tf.cast(batch_size, tf.float32)
+
+        accum_grads = [tf.zeros_like(v) for v in self.trainable_variables]
+        for i in range(self.accum_steps):
+            # micro-batch sizes differ by at most one image
+            start = (i * batch_size) // self.accum_steps
+            stop = ((i + 1) * batch_size) // self.accum_steps
+            weight = tf.cast(stop - start, tf.float32) / batch_size_f
+
+            # a batch smaller than accum_steps gives empty micro-batches, they run on one
+            # image with a zero weight instead, which keeps the graph free of conditionals
+            start = tf.minimum(start, batch_size - 1)
+            stop = tf.maximum(stop, start + 1)
+
+            # the micro-batches of the unrolled loop are independent in the graph and would run
+            # concurrently: each one waits for the gradients of the previous one
+            with tf.control_dependencies(accum_grads):
+                x_micro = tf.identity(x[start:stop])
+                y_micro = tf.identity(y[start:stop])
+
+            with tf.GradientTape() as tape:
+                y_pred = self(x_micro, training=True)
+                loss = self.compiled_loss(y_micro, y_pred,
+                                          regularization_losses=self.losses)
+            grads = tape.gradient(loss, self.trainable_variables)
+
+            accum_grads = [a + weight * g if g is not None else a
+                           for a, g in zip(accum_grads, grads)]
+            self.compiled_metrics.update_state(y_micro, y_pred,
+                                               sample_weight=weight)
+
+        self.optimizer.apply_gradients(zip(accum_grads, self.trainable_variables))
+
+        return {m.name: m.result() for m in self.metrics}
+
+    def get_config(self):
+        config = super().get_config()
+        config["accum_steps"] = self.accum_steps
+
+        return config
+
+    @classmethod
+    def from_config(cls, config, custom_objects=None):
+        config = dict(config)
+        accum_steps = config.pop("accum_steps", 1)
+        model = super().from_config(config, custom_objects=custom_objects)
+        model.accum_steps = accum_steps
+
+        return model
+
+
+def with_gradient_accumulation(model, accum_steps):
+    """
+        Rebuilds the functional model on the same layers (weights are shared) as a GradientAccumulationModel.
+    """
+    accum_model = GradientAccumulationModel(inputs=model.inputs,
+                                            outputs=model.outputs,
+                                            name=model.name)
+    accum_model.accum_steps = accum_steps
+
+    return accum_model
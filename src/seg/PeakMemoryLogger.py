@@ -0,0 +1,88 @@
+import resource
+import numpy as np
+
+import tensorflow as tf
+from tensorflow.keras.callbacks import Callback
+
+
+def memory_device():
+    gpus = tf.config.list_logical_devices("GPU")
+
+    return gpus[0].name if gpus else None
+
+
+def peak_memory_mb(device):
+    """
+        Peak allocator memory of device since the last reset, for CPU (no allocator stats) the peak RSS of the process.
+    """
+    if device is None:
+        # ru_maxrss is in KB on linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+    return tf.config.experimental.get_memory_info(device)["peak"] / 2. ** 20
+
+
+def reset_peak_memory(device):
+    if device is not None:
+        tf.config.experimental.reset_memory_stats(device)
+
+
+class PeakMemoryLogger(Callback):
+    '''Records the peak memory of every training step.
+    # Usage
+        ```python
+            memory = PeakMemoryLogger()
+            model.fit(X_train, Y_train, epochs=100, callbacks=[memory])
+            memory.history["peak_memory_mb"]
+        ```
+    # Notes
+        On GPU the allocator peak is reset before each step, so the values are per step.
+        On CPU only the process wide peak RSS is available, which is monotonic over the run.
+        The epoch maximum is also added to the epoch logs as `peak_memory_mb`.
+    '''
+
+    def __init__(self):
+        super().__init__()
+        self.device = memory_device()
+        self.history = {}
+        self.epoch_peaks = list()
+
+    def on_train_batch_begin(self, batch, logs=None):
+        reset_peak_memory(self.device)
+
+    def on_train_batch_end(self, batch, logs=None):
+        peak = peak_memory_mb(self.device)
+        self.history.setdefault("peak_memory_mb", []).append(peak)
+        self.epoch_peaks.append(peak)
+
+    def on_epoch_end(self, epoch, logs=None):
+        if logs is not None and self.epoch_peaks:
+            logs["peak_memory_mb"] = float(np.max(self.epoch_peaks))
+        self.epoch_peaks = list()
+
+
+def measure_step_memory(model, batch_size, loss="binary_crossentropy"):
+    """
+        Peak memory (MB) of one training step of model on random data, e.g. to compare a builder with and without recompute.
+    """
+    device = memory_device()
+    x = tf.random.uniform((batch_size, ) + tuple(model.input_shape[1:]))
+    y = tf.cast(tf.random.uniform((batch_size, ) + tuple(model.output_shape[1:])) > 0.5, tf.float32)
+    optimizer = tf.keras.optimizers.SGD()
+    loss_fn = tf.keras.losses.get(loss)
+
+    @tf.function
+    def train_step(x, y):
+        with tf.GradientTape() as tape:
+            loss_value = tf.reduce_mean(loss_fn(y, model(x, training=True)))
+        grads = tape.gradient(loss_value, model.trainable_variables)
+        optimizer.apply_gradients(zip(grads, model.trainable_variables))
+
+        return loss_value
+
+    # the first call traces and builds the optimizer slots
+    train_step(x, y)
+    reset_peak_memory(device)
+    train_step(x, y).numpy()
+
+    return peak_memory_mb(device)
@@ -1,7 +1,105 @@
+import os
 import numpy as np
 
+import tensorflow as tf
 from tensorflow.keras.callbacks import Callback
-import tensorflow.keras.backend as K
+from tensorflow.keras.optimizers.schedules import LearningRateSchedule
+
+
+class SGDRSchedule(LearningRateSchedule):
+    '''Cosine annealing learning rate schedule with periodic restarts, evaluated by the optimizer
+    from its step counter inside the training graph.
+    # Usage
+        ```python
+            schedule = SGDRSchedule(min_lr=1e-5,
+                                    max_lr=1e-2,
+                                    steps_per_epoch=np.ceil(epoch_size/batch_size),
+                                    lr_decay=0.9,
+                                    cycle_length=5,
+                                    mult_factor=1.5)
+            model.compile(optimizer=SGD(learning_rate=schedule), ...)
+        ```
+    # Arguments
+        min_lr: The lower bound of the learning rate range for the experiment.
+        max_lr: The upper bound of the learning rate range for the experiment.
+        steps_per_epoch: Number of optimizer updates per epoch. Calculated as `np.ceil(epoch_size/batch_size)`.
+        lr_decay: Reduce the max_lr after the completion of each cycle.
+                  Ex. To reduce the max_lr by 20% after each cycle, set this value to 0.8.
+        cycle_length: Initial number of epochs in a cycle.
+        mult_factor: Scale epochs_to_restart after each full cycle completion.
+        max_epochs: Restarts are precomputed up to this epoch, the last cycle is held at min_lr afterwards.
+        epoch_offset: Epoch reached at step_offset, to continue the schedule with another
+                      steps_per_epoch (progressive resizing changes the batch size).
+        step_offset: Optimizer step at which epoch_offset is reached, 0 with a new optimizer.
+    '''
+
+    def __init__(self,
+                 min_lr,
+                 max_lr,
+                 steps_per_epoch,
+                 lr_decay=1,
+                 cycle_length=10,
+                 mult_factor=2,
+                 max_epochs=10000,
+                 epoch_offset=0,
+                 step_offset=0):
+
+        self.min_lr = min_lr
+        self.max_lr = max_lr
+        self.steps_per_epoch = steps_per_epoch
+        self.lr_decay = lr_decay
+        self.cycle_length = cycle_length
+        self.mult_factor = mult_factor
+        self.max_epochs = max_epochs
+        self.epoch_offset = epoch_offset
+        self.step_offset = step_offset
+
+        # epoch at which every cycle starts, same rounding as the epochs_to_restart update
+        cycle_starts = [0]
+        cycle_lengths = list()
+        length = cycle_length
+        while cycle_starts[-1] < max_epochs:
+            cycle_lengths.append(length)
+            cycle_starts.append(cycle_starts[-1] + length)
+            length = np.ceil(length * mult_factor)
+
+        self.restart_epochs = [int(epoch) for epoch in cycle_starts[1:]]
+        # in steps counted from epoch 0 at steps_per_epoch
+        self.cycle_starts = np.array(cycle_starts[:-1], dtype=np.float32) * steps_per_epoch
+        self.cycle_steps = np.array(cycle_lengths, dtype=np.float32) * steps_per_epoch
+
+    def __call__(self, step):
+        '''
+            Learning rate of step, which can be a scalar or a vector of steps.
+        '''
+
+        step = tf.cast(step, tf.float32)
+        if self.epoch_offset or self.step_offset:
+            step = step - self.step_offset + self.epoch_offset * self.steps_per_epoch
+        cycle_starts = tf.constant(self.cycle_starts)
+        cycle_steps = tf.constant(self.cycle_steps)
+
+        cycle = tf.searchsorted(cycle_starts, tf.reshape(step, [-1]), side="right") - 1
+        cycle = tf.reshape(cycle, tf.shape(step))
+
+        fraction_to_restart = (step - tf.gather(cycle_starts, cycle)) / tf.gather(cycle_steps, cycle)
+        fraction_to_restart = tf.minimum(fraction_to_restart, 1.)
+        max_lr = self.max_lr * tf.pow(float(self.lr_decay), tf.cast(cycle, tf.float32))
+
+        return self.min_lr + 0.5 * (max_lr - self.min_lr) * (1. + tf.cos(fraction_to_restart * np.pi))
+
+    def get_config(self):
+        return {
+            "min_lr": self.min_lr,
+            "max_lr": self.max_lr,
+            "steps_per_epoch": self.steps_per_epoch,
+            "lr_decay": self.lr_decay,
+            "cycle_length": self.cycle_length,
+            "mult_factor": self.mult_factor,
+            "max_epochs": self.max_epochs,
+            "epoch_offset": self.epoch_offset,
+            "step_offset": self.step_offset
+        }
 
 
 class SGDRScheduler(Callback):
@@ -14,16 +112,26 @@ class SGDRScheduler(Callback):
                                      lr_decay=0.9,
                                      cycle_length=5,
                                      mult_factor=1.5)
+            model.compile(optimizer=SGD(learning_rate=schedule.schedule), ...)
             model.fit(X_train, Y_train, epochs=100, callbacks=[schedule])
         ```
     # Arguments
         min_lr: The lower bound of the learning rate range for the experiment.
         max_lr: The upper bound of the learning rate range for the experiment.
-        steps_per_epoch: Number of mini-batches in the dataset. Calculated as `np.ceil(epoch_size/batch_size)`. 
+        steps_per_epoch: Number of mini-batches in the dataset. Calculated as `np.ceil(epoch_size/batch_size)`.
         lr_decay: Reduce the max_lr after the completion of each cycle.
                   Ex. To reduce the max_lr by 20% after each cycle, set this value to 0.8.
         cycle_length: Initial number of epochs in a cycle.
         mult_factor: Scale epochs_to_restart after each full cycle completion.
+        save_dir: If set, the model at the end of every cycle is saved there as snapshot_{k}.hdf5
+                  (without optimizer), the snapshots can be ensembled with seg.predict.load_ensemble_model.
+    # Notes
+        The learning rate itself is computed by `self.schedule` (SGDRSchedule) inside the optimizer,
+        the callback only logs it once per epoch and keeps the weights of the end of every cycle.
+        The per-step curve is recomputed offline by `lr_history`.
+        `start_phase` continues the schedule with a new optimizer and another number of steps per epoch
+        (progressive resizing), the restarts stay at the same epochs. Snapshots are only saved, and the
+        end-of-cycle weights only restored, in the last phase: every snapshot has the final input size.
     # References
         Blog post: jeremyjordan.me/nn-learning-rate
         Original paper: http://arxiv.org/abs/1608.03983
@@ -35,73 +143,77 @@ class SGDRScheduler(Callback):
                  steps_per_epoch,
                  lr_decay=1,
                  cycle_length=10,
-                 mult_factor=2):
-
-        self.min_lr = min_lr
-        self.max_lr = max_lr
-        self.lr_decay = lr_decay
-
-        self.batch_since_restart = 0
-        self.next_restart = cycle_length
-
-        self.steps_per_epoch = steps_per_epoch
-
-        self.cycle_length = cycle_length
-        self.mult_factor = mult_factor
-
+                 mult_factor=2,
+                 save_dir=None):
+
+        super().__init__()
+        self.schedule = SGDRSchedule(min_lr=min_lr,
+                                     max_lr=max_lr,
+                                     steps_per_epoch=steps_per_epoch,
+                                     lr_decay=lr_decay,
+                                     cycle_length=cycle_length,
+                                     mult_factor=mult_factor)
+
+        self.save_dir = save_dir
+        self.snapshots = list()
+        self.best_weights = None
+        self.last_phase = True
+        self.steps = 0
+        self.phases = list()
         self.history = {}
 
-    def clr(self):
+    def start_phase(self, steps_per_epoch, initial_epoch, last_phase=True):
         '''
-            Calculate the learning rate.
+            New schedule from initial_epoch with steps_per_epoch, to give to the new optimizer of the phase.
+            last_phase: saves the snapshots of the phase and restores the weights of its last cycle end.
         '''
 
-        fraction_to_restart = self.batch_since_restart / \
-            (self.steps_per_epoch * self.cycle_length)
-        lr = self.min_lr + 0.5 * \
-            (self.max_lr - self.min_lr) * \
-            (1 + np.cos(fraction_to_restart * np.pi))
+        if self.steps > 0:
+            self.phases.append((self.schedule, self.steps))
+        config = self.schedule.get_config()
+        config.update(steps_per_epoch=steps_per_epoch, epoch_offset=initial_epoch, step_offset=0)
+        self.schedule = SGDRSchedule(**config)
 
-        return lr
+        self.steps = 0
+        self.best_weights = None
+        self.last_phase = last_phase
 
-    def on_train_begin(self, logs={}):
-        '''
-            Initialize the learning rate to the minimum value at the start of training.
-        '''
+        return self.schedule
 
-        logs = logs or {}
-        K.set_value(self.model.optimizer.lr, self.max_lr)
-
-    def on_batch_end(self, batch, logs={}):
+    def on_epoch_end(self, epoch, logs=None):
         '''
-            Record previous batch statistics and update the learning rate.
+            Record the learning rate of the last update, keep (and save) the weights at the end of every cycle.
         '''
 
-        logs = logs or {}
-        self.history.setdefault('lr', []).append(
-            K.get_value(self.model.optimizer.lr))
+        self.steps = int(self.model.optimizer.iterations.numpy())
+        lr = float(self.schedule(max(self.steps - 1, 0)))
+        self.history.setdefault("lr", []).append(lr)
+        if logs is not None:
+            logs["lr"] = lr
 
-        for k, v in logs.items():
-            self.history.setdefault(k, []).append(v)
+        if epoch + 1 in self.schedule.restart_epochs:
+            self.best_weights = self.model.get_weights()
 
-        self.batch_since_restart += 1
-        K.set_value(self.model.optimizer.lr, self.clr())
+            if self.save_dir is not None and self.last_phase:
+                snapshot_path = os.path.join(self.save_dir, "snapshot_{:02d}.hdf5".format(len(self.snapshots)))
+                self.model.save(snapshot_path, include_optimizer=False)
+                self.snapshots.append(snapshot_path)
 
-    def on_epoch_end(self, epoch, logs={}):
+    def on_train_end(self, logs=None):
         '''
-            Check for end of current cycle, apply restarts when necessary.
+            Set weights to the values from the end of the most recent cycle for best performance.
         '''
 
-        if epoch + 1 == self.next_restart:
-            self.batch_since_restart = 0
-            self.cycle_length = np.ceil(self.cycle_length * self.mult_factor)
-            self.next_restart += self.cycle_length
-            self.max_lr *= self.lr_decay
-            self.best_weights = self.model.get_weights()
+        if self.best_weights is not None and self.last_phase:
+            self.model.set_weights(self.best_weights)
 
-    def on_train_end(self, logs={}):
+    def lr_history(self):
         '''
-            Set weights to the values from the end of the most recent cycle for best performance.
+            Learning rate of every optimizer step taken so far (all phases), computed from the schedules.
         '''
 
-        self.model.set_weights(self.best_weights)
+        lrs = [schedule(np.arange(steps)).numpy()
+               for schedule, steps in self.phases + [(self.schedule, self.steps)]]
+        lrs = np.concatenate(lrs)
+
+        return {"step": np.arange(len(lrs)), "lr": lrs}
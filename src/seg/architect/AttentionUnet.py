@@ -5,10 +5,11 @@ import numpy as np
 import tensorflow as tf
 from tensorflow.keras import Input
 from tensorflow.keras.models import Model
-from tensorflow.keras.layers import Conv2D, BatchNormalization, Activation, MaxPooling2D, Dropout, Conv2DTranspose, concatenate, ZeroPadding2D, Add, Multiply, Lambda
-from tensorflow.keras import backend as K
+from tensorflow.keras.layers import Conv2D, BatchNormalization, Activation, MaxPooling2D, Dropout, Conv2DTranspose, concatenate, ZeroPadding2D, Add
 
-from seg.utils import load_pretrain_model
+from seg.architect.recompute import checkpoint
+from seg.utils import load_weights_by_structure
+from seg.architect.layers import AttentionGate
 
 
 def activation(x, batchnorm=True):
@@ -62,13 +63,6 @@ def padding(x, y):
     return x, y
 
 
-def expend_as(tensor, rep):
-    my_repeat = Lambda(lambda x, repnum: K.repeat_elements(
-        x, repnum, axis=3), arguments={"repnum": rep})(tensor)
-
-    return my_repeat
-
-
 def attention_gate(x, g, n_filters):
     """
         x: feature from lower layer (spatially smaller signal), has bigger width and height but fewer channel
@@ -94,71 +88,76 @@ def attention_gate(x, g, n_filters):
                             kernel_size=1,
                             batchnorm=False)
     sigmoid = Activation("sigmoid")(psi)
-    alpha = expend_as(sigmoid, n_filters)
-    mul = Multiply()([x, alpha])
+    mul = AttentionGate()([x, sigmoid])
 
     return mul
 
 
-def attention_unet(input_size=(216, 320, 1), n_filters=64, batchnorm=True, dropout_rate=0.1, freeze=False, freeze_at=0):
+def attention_unet(input_size=(216, 320, 1), n_filters=64, batchnorm=True, dropout_rate=0.1, freeze=False, freeze_at=0, recompute=False):
     inputs = Input(input_size, name="img")
+    # recompute: activations of every block are rematerialised in the backward pass
+    conv_block = checkpoint(conv2d_block, recompute)
+    gate = checkpoint(attention_gate, recompute)
 
     # contraction path
-    c1 = conv2d_block(inputs, n_filters * 1,
-                      kernel_size=3, batchnorm=batchnorm)
+    c1 = conv_block(inputs, n_filters * 1,
+                    kernel_size=3, batchnorm=batchnorm)
     p1 = MaxPooling2D((2, 2))(c1)
     p1 = Dropout(dropout_rate)(p1)
 
-    c2 = conv2d_block(p1, n_filters * 2, kernel_size=3, batchnorm=batchnorm)
+    c2 = conv_block(p1, n_filters * 2, kernel_size=3, batchnorm=batchnorm)
     p2 = MaxPooling2D((2, 2))(c2)
     p2 = Dropout(dropout_rate)(p2)
 
-    c3 = conv2d_block(p2, n_filters * 4, kernel_size=3, batchnorm=batchnorm)
+    c3 = conv_block(p2, n_filters * 4, kernel_size=3, batchnorm=batchnorm)
     p3 = MaxPooling2D((2, 2))(c3)
     p3 = Dropout(dropout_rate)(p3)
 
-    c4 = conv2d_block(p3, n_filters * 8, kernel_size=3, batchnorm=batchnorm)
+    c4 = conv_block(p3, n_filters * 8, kernel_size=3, batchnorm=batchnorm)
     p4 = MaxPooling2D((2, 2))(c4)
     p4 = Dropout(dropout_rate)(p4)
 
-    c5 = conv2d_block(p4, n_filters * 16, kernel_size=3, batchnorm=batchnorm)
+    c5 = conv_block(p4, n_filters * 16, kernel_size=3, batchnorm=batchnorm)
 
     # expansion path
-    a6 = attention_gate(c4, c5, n_filters * 8)
+    a6 = gate(c4, c5, n_filters * 8)
     u6 = Conv2DTranspose(n_filters * 8, 3, strides=(2, 2), padding="same")(c5)
     u6, a6 = padding(u6, a6)
     u6 = concatenate([u6, a6])
     u6 = Dropout(dropout_rate)(u6)
-    c6 = conv2d_block(u6, n_filters * 8, kernel_size=3, batchnorm=batchnorm)
+    c6 = conv_block(u6, n_filters * 8, kernel_size=3, batchnorm=batchnorm)
 
-    a7 = attention_gate(c3, c6, n_filters * 4)
+    a7 = gate(c3, c6, n_filters * 4)
     u7 = Conv2DTranspose(n_filters * 4, 3, strides=(2, 2), padding="same")(c6)
     u7 = concatenate([u7, a7])
     u7 = Dropout(dropout_rate)(u7)
-    c7 = conv2d_block(u7, n_filters * 4, kernel_size=3, batchnorm=batchnorm)
+    c7 = conv_block(u7, n_filters * 4, kernel_size=3, batchnorm=batchnorm)
 
-    a8 = attention_gate(c2, c7, n_filters * 2)
+    a8 = gate(c2, c7, n_filters * 2)
     u8 = Conv2DTranspose(n_filters * 2, 3, strides=(2, 2), padding="same")(c7)
     u8 = concatenate([u8, a8])
     u8 = Dropout(dropout_rate)(u8)
-    c8 = conv2d_block(u8, n_filters * 2, kernel_size=3, batchnorm=batchnorm)
+    c8 = conv_block(u8, n_filters * 2, kernel_size=3, batchnorm=batchnorm)
 
-    a9 = attention_gate(c1, c8, n_filters * 1)
+    a9 = gate(c1, c8, n_filters * 1)
     u9 = Conv2DTranspose(n_filters * 1, 3, strides=(2, 2), padding="same")(c8)
     u9 = concatenate([u9, a9])
     u9 = Dropout(dropout_rate)(u9)
-    c9 = conv2d_block(u9, n_filters * 1, kernel_size=3, batchnorm=batchnorm)
+    c9 = conv_block(u9, n_filters * 1, kernel_size=3, batchnorm=batchnorm)
 
     outputs = Conv2D(1, (1, 1), activation="sigmoid")(c9)
 
     model = Model(inputs=[inputs], outputs=[outputs], name="AttentionUNet")
 
     if freeze:
+        if recompute:
+            raise ValueError("freeze relies on the flat layer indices, it cannot be combined with recompute")
         fine_tune_at = freeze_at
-        model_tmp = load_pretrain_model("../models/model_attention_unet.hdf5")
+        # matched by graph structure, so checkpoints saved with the old Lambda / Multiply gates load too
+        load_weights_by_structure(model, "../models/model_attention_unet.hdf5",
+                                  layers=model.layers[:fine_tune_at])
 
-        for layer, layer_tmp in zip(model.layers[:fine_tune_at], model_tmp.layers[:fine_tune_at]):
-            layer.set_weights(layer_tmp.get_weights())
+        for layer in model.layers[:fine_tune_at]:
             layer.trainable = False
 
     model.summary()
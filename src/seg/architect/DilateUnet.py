@@ -5,9 +5,10 @@ import numpy as np
 import tensorflow as tf
 from tensorflow.keras import Input
 from tensorflow.keras.models import Model
-from tensorflow.keras.layers import Conv2D, BatchNormalization, Activation, MaxPooling2D, Dropout, Conv2DTranspose, concatenate, ZeroPadding2D, Add, Multiply, Lambda
+from tensorflow.keras.layers import Conv2D, BatchNormalization, Activation, MaxPooling2D, Dropout, Conv2DTranspose, concatenate, ZeroPadding2D, Add, Multiply, Lambda, AveragePooling2D, UpSampling2D
 from tensorflow.keras import backend as K
 
+from seg.architect.recompute import checkpoint
 from seg.utils import load_pretrain_model
 
 
@@ -86,6 +87,42 @@ def dilated_block(x, n_filters, kernel_size=3, batchnorm=True):
     return a
 
 
+def aspp_block(x, n_filters, kernel_size=3, rates=(1, 2, 4, 8, 16, 32), batchnorm=True):
+    """
+        Parallel (ASPP) bottle neck: a 1x1 branch, one dilated conv per rate and a global pooling branch,
+        concatenated and projected by a 1x1 conv.
+        Rates whose taps fall outside the feature map from its center are dropped: at 216x320 the
+        bottle neck is 27x40, rates 16 and 32 would mostly convolve the zero padding.
+        The branches are independent, so the inter-op thread pool runs them concurrently.
+    """
+    height, width = x.shape[1], x.shape[2]
+    rates = [rate for rate in rates if rate * (kernel_size // 2) < min(height, width) / 2]
+
+    branches = [convolution_block(x, n_filters, kernel_size=1, batchnorm=batchnorm)]
+    for rate in rates:
+        branches.append(convolution_block(x,
+                                          n_filters,
+                                          kernel_size=kernel_size,
+                                          dilation_rate=rate,
+                                          batchnorm=batchnorm))
+
+    # image level features
+    pool = AveragePooling2D(pool_size=(height, width))(x)
+    pool = convolution_block(pool, n_filters, kernel_size=1, batchnorm=batchnorm)
+    branches.append(UpSampling2D(size=(height, width))(pool))
+
+    a = concatenate(branches)
+    a = convolution_block(a, n_filters, kernel_size=1, batchnorm=batchnorm)
+
+    return a
+
+
+BOTTLENECKS = {
+    "dilated": dilated_block,
+    "aspp": aspp_block
+}
+
+
 def padding(x, y):
     x_shape = x.shape.as_list()
     y_shape = y.shape.as_list()
@@ -102,46 +139,54 @@ def padding(x, y):
     return x, y
 
 
-def dilate_unet(input_size=(216, 320, 1), n_filters=64, batchnorm=True, dropout_rate=0.1, freeze=False, freeze_at=0):
+def dilate_unet(input_size=(216, 320, 1), n_filters=64, batchnorm=True, dropout_rate=0.1, freeze=False, freeze_at=0, recompute=False, bottleneck="dilated"):
+    """
+        bottleneck: "dilated" (serial dilated convs, dilated_block) or "aspp" (parallel branches, aspp_block)
+    """
     inputs = Input(input_size, name="img")
+    # recompute: activations of every block are rematerialised in the backward pass
+    conv_block = checkpoint(conv2d_block, recompute)
+    bottleneck_block = checkpoint(BOTTLENECKS[bottleneck], recompute)
 
     # contraction path
-    c1 = conv2d_block(inputs, n_filters * 1,
-                      kernel_size=3, batchnorm=batchnorm)
+    c1 = conv_block(inputs, n_filters * 1,
+                    kernel_size=3, batchnorm=batchnorm)
     p1 = MaxPooling2D((2, 2))(c1)
     p1 = Dropout(dropout_rate)(p1)
 
-    c2 = conv2d_block(p1, n_filters * 2, kernel_size=3, batchnorm=batchnorm)
+    c2 = conv_block(p1, n_filters * 2, kernel_size=3, batchnorm=batchnorm)
     p2 = MaxPooling2D((2, 2))(c2)
     p2 = Dropout(dropout_rate)(p2)
 
-    c3 = conv2d_block(p2, n_filters * 4, kernel_size=3, batchnorm=batchnorm)
+    c3 = conv_block(p2, n_filters * 4, kernel_size=3, batchnorm=batchnorm)
     p3 = MaxPooling2D((2, 2))(c3)
     p3 = Dropout(dropout_rate)(p3)
 
-    c4 = dilated_block(p3, n_filters * 8, kernel_size=3, batchnorm=batchnorm)
+    c4 = bottleneck_block(p3, n_filters * 8, kernel_size=3, batchnorm=batchnorm)
 
     # expansion path
     u5 = Conv2DTranspose(n_filters * 4, 3, strides=(2, 2), padding="same")(c4)
     u5 = concatenate([u5, c3])
     u5 = Dropout(dropout_rate)(u5)
-    c5 = conv2d_block(u5, n_filters * 8, kernel_size=3, batchnorm=batchnorm)
+    c5 = conv_block(u5, n_filters * 8, kernel_size=3, batchnorm=batchnorm)
 
     u6 = Conv2DTranspose(n_filters * 2, 3, strides=(2, 2), padding="same")(c5)
     u6 = concatenate([u6, c2])
     u6 = Dropout(dropout_rate)(u6)
-    c6 = conv2d_block(u6, n_filters * 2, kernel_size=3, batchnorm=batchnorm)
+    c6 = conv_block(u6, n_filters * 2, kernel_size=3, batchnorm=batchnorm)
 
     u7 = Conv2DTranspose(n_filters * 1, 3, strides=(2, 2), padding="same")(c6)
     u7 = concatenate([u7, c1])
     u7 = Dropout(dropout_rate)(u7)
-    c7 = conv2d_block(u7, n_filters * 1, kernel_size=3, batchnorm=batchnorm)
+    c7 = conv_block(u7, n_filters * 1, kernel_size=3, batchnorm=batchnorm)
 
     outputs = Conv2D(1, (1, 1), activation="sigmoid")(c7)
     model = Model(inputs=[inputs], outputs=[outputs],
                   name="DilateUNet")
 
     if freeze:
+        if recompute:
+            raise ValueError("freeze relies on the flat layer indices, it cannot be combined with recompute")
         fine_tune_at = freeze_at
         model_tmp = load_pretrain_model(
             "../models/model_dilate_unet.hdf5")
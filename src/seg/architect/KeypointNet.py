@@ -0,0 +1,47 @@
+import os
+import sys
+import numpy as np
+
+import tensorflow as tf
+from tensorflow.keras import Input
+from tensorflow.keras.models import Model
+from tensorflow.keras.layers import Conv2D
+
+from seg.architect.MobileUnet import mobile_encoder, decoder_block
+
+
+def keypoint_net(input_size=(216, 320, 1), n_keypoints=5, n_filters=32, alpha=1.0, encoder="separable", batchnorm=True, dropout_rate=0.1, recompute=False):
+    """
+        Heatmap keypoint model on the mobile encoder: the decoder stops at stride 4 and a 1x1 conv
+        predicts one heatmap per keypoint (seg.targets.KeypointHeatmapTarget with stride=4).
+        The two full resolution decoder stages of the U-Nets are skipped, the ellipse is recovered
+        from the 5 points with seg.ellipse.ellipse_from_keypoints instead of fitting a mask contour.
+    """
+    inputs = Input(input_size, name="img")
+
+    # contraction path
+    (c1, c2, c3, c4), c5, filters = mobile_encoder(inputs,
+                                                   n_filters=n_filters,
+                                                   alpha=alpha,
+                                                   encoder=encoder,
+                                                   batchnorm=batchnorm,
+                                                   dropout_rate=dropout_rate,
+                                                   recompute=recompute)
+
+    # expansion path, down to stride 4
+    c6 = decoder_block(c5, c4, filters[3], dropout_rate, batchnorm, recompute)
+    c7 = decoder_block(c6, c3, filters[2], dropout_rate, batchnorm, recompute)
+
+    outputs = Conv2D(n_keypoints, (1, 1), activation="sigmoid", name="heatmaps")(c7)
+    model = Model(inputs=[inputs], outputs=[outputs], name="KeypointNet")
+
+    model.summary()
+    # tf.keras.utils.plot_model(model, show_shapes=True)
+
+    return model
+
+
+if __name__ == "__main__":
+    model = keypoint_net()
+    dot_img_file = "../images/keypoint_net.png"
+    tf.keras.utils.plot_model(model, to_file=dot_img_file, show_shapes=True)
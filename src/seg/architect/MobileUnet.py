@@ -0,0 +1,261 @@
+import os
+import sys
+import numpy as np
+
+import tensorflow as tf
+from tensorflow.keras import Input
+from tensorflow.keras.models import Model
+from tensorflow.keras.layers import Conv2D, DepthwiseConv2D, BatchNormalization, ReLU, Dropout, Conv2DTranspose, concatenate, ZeroPadding2D, Add
+
+from seg.architect.recompute import checkpoint
+from seg.utils import load_pretrain_model
+from seg.architect.AttentionUnet import attention_gate, padding
+
+
+def make_divisible(value, divisor=8):
+    """
+        Rounds the number of channels to the nearest multiple of divisor (MobileNet convention)
+    """
+    new_value = max(divisor, int(value + divisor / 2) // divisor * divisor)
+    # make sure that round down does not go down by more than 10%
+    if new_value < 0.9 * value:
+        new_value += divisor
+
+    return new_value
+
+
+def depthwise_conv(x, strides=(1, 1), batchnorm=True):
+    """
+        3x3 depthwise conv. Strided convs pad bottom/right only so that the output is floor(size / 2),
+        the same as MaxPooling2D in the other architectures, which keeps the decoder padding logic valid.
+    """
+    conv_padding = "same"
+    if strides != (1, 1):
+        x = ZeroPadding2D(((0, 1), (0, 1)))(x)
+        conv_padding = "valid"
+
+    x = DepthwiseConv2D(kernel_size=3,
+                        strides=strides,
+                        padding=conv_padding,
+                        use_bias=not batchnorm,
+                        depthwise_initializer="he_normal")(x)
+
+    return x
+
+
+def depthwise_separable_block(x, n_filters, strides=(1, 1), batchnorm=True):
+    """
+        MobileNetV1 block: 3x3 depthwise conv followed by 1x1 pointwise conv
+    """
+    x = depthwise_conv(x, strides=strides, batchnorm=batchnorm)
+    if batchnorm:
+        x = BatchNormalization()(x)
+    x = ReLU(max_value=6.)(x)
+
+    x = Conv2D(filters=n_filters,
+               kernel_size=1,
+               kernel_initializer="he_normal",
+               padding="same",
+               use_bias=not batchnorm)(x)
+    if batchnorm:
+        x = BatchNormalization()(x)
+    x = ReLU(max_value=6.)(x)
+
+    return x
+
+
+def inverted_residual_block(x, n_filters, expansion=6, strides=(1, 1), batchnorm=True):
+    """
+        MobileNetV2 / EfficientNet-lite block: 1x1 expansion, 3x3 depthwise, linear 1x1 projection.
+        A residual connection is added when the input and output shapes match.
+    """
+    in_filters = x.shape[-1]
+    shortcut = x
+
+    if expansion != 1:
+        x = Conv2D(filters=in_filters * expansion,
+                   kernel_size=1,
+                   kernel_initializer="he_normal",
+                   padding="same",
+                   use_bias=not batchnorm)(x)
+        if batchnorm:
+            x = BatchNormalization()(x)
+        x = ReLU(max_value=6.)(x)
+
+    x = depthwise_conv(x, strides=strides, batchnorm=batchnorm)
+    if batchnorm:
+        x = BatchNormalization()(x)
+    x = ReLU(max_value=6.)(x)
+
+    x = Conv2D(filters=n_filters,
+               kernel_size=1,
+               kernel_initializer="he_normal",
+               padding="same",
+               use_bias=not batchnorm)(x)
+    if batchnorm:
+        x = BatchNormalization()(x)
+
+    if strides == (1, 1) and in_filters == n_filters:
+        x = Add()([shortcut, x])
+
+    return x
+
+
+def encoder_block(x, n_filters, strides=(1, 1), encoder="separable", batchnorm=True):
+    if encoder == "separable":
+        x = depthwise_separable_block(x, n_filters, strides=strides,
+                                      batchnorm=batchnorm)
+        x = depthwise_separable_block(x, n_filters, batchnorm=batchnorm)
+    elif encoder == "inverted_residual":
+        x = inverted_residual_block(x, n_filters, strides=strides,
+                                    batchnorm=batchnorm)
+        x = inverted_residual_block(x, n_filters, batchnorm=batchnorm)
+    else:
+        raise ValueError("Unknown encoder: {}".format(encoder))
+
+    return x
+
+
+def upsample_block(x, skip, n_filters):
+    u = Conv2DTranspose(n_filters, 3, strides=(2, 2), padding="same")(x)
+    u, skip = padding(u, skip)
+
+    return concatenate([u, skip])
+
+
+def decoder_block(x, skip, n_filters, dropout_rate=0.1, batchnorm=True, recompute=False):
+    """
+        recompute: checkpoints the upsampling and the conv blocks, the Dropout between them stays
+        outside tf.recompute_grad, whose recomputation would draw another mask than the forward pass
+    """
+    u = checkpoint(upsample_block, recompute)(x, skip, n_filters)
+    u = Dropout(dropout_rate)(u)
+    c = checkpoint(encoder_block, recompute)(u, n_filters, batchnorm=batchnorm)
+
+    return c
+
+
+def mobile_encoder(inputs, n_filters=32, alpha=1.0, encoder="separable", batchnorm=True, dropout_rate=0.1, recompute=False):
+    """
+        Returns the four skip features (stride 1, 2, 4, 8) and the bottleneck (stride 16).
+        The full resolution stem is a plain 3x3 conv, every other stage downsamples with a strided depthwise conv.
+    """
+    filters = [make_divisible(n_filters * alpha * m) for m in (1, 2, 4, 8, 16)]
+
+    c1 = Conv2D(filters=filters[0],
+                kernel_size=3,
+                kernel_initializer="he_normal",
+                padding="same",
+                use_bias=not batchnorm)(inputs)
+    if batchnorm:
+        c1 = BatchNormalization()(c1)
+    c1 = ReLU(max_value=6.)(c1)
+    stage = checkpoint(encoder_block, recompute)
+    c1 = stage(c1, filters[0], encoder=encoder, batchnorm=batchnorm)
+
+    skips = [c1]
+    x = c1
+    for n in filters[1:]:
+        x = Dropout(dropout_rate)(x)
+        x = stage(x, n, strides=(2, 2), encoder=encoder,
+                  batchnorm=batchnorm)
+        skips.append(x)
+
+    return skips[:-1], skips[-1], filters
+
+
+def mobile_unet(input_size=(216, 320, 1), n_filters=32, alpha=1.0, encoder="separable", batchnorm=True, dropout_rate=0.1, freeze=False, freeze_at=0, recompute=False):
+    """
+        U-Net with a depthwise-separable (MobileNetV1) or inverted residual (MobileNetV2 / EfficientNet-lite) encoder.
+        alpha: width multiplier applied to every stage.
+    """
+    inputs = Input(input_size, name="img")
+
+    # contraction path
+    (c1, c2, c3, c4), c5, filters = mobile_encoder(inputs,
+                                                   n_filters=n_filters,
+                                                   alpha=alpha,
+                                                   encoder=encoder,
+                                                   batchnorm=batchnorm,
+                                                   dropout_rate=dropout_rate,
+                                                   recompute=recompute)
+
+    # expansion path
+    c6 = decoder_block(c5, c4, filters[3], dropout_rate, batchnorm, recompute)
+    c7 = decoder_block(c6, c3, filters[2], dropout_rate, batchnorm, recompute)
+    c8 = decoder_block(c7, c2, filters[1], dropout_rate, batchnorm, recompute)
+    c9 = decoder_block(c8, c1, filters[0], dropout_rate, batchnorm, recompute)
+
+    outputs = Conv2D(1, (1, 1), activation="sigmoid")(c9)
+    model = Model(inputs=[inputs], outputs=[outputs], name="MobileUNet")
+
+    if freeze:
+        if recompute:
+            raise ValueError("freeze relies on the flat layer indices, it cannot be combined with recompute")
+        fine_tune_at = freeze_at
+        model_tmp = load_pretrain_model("../models/model_mobile_unet.hdf5")
+
+        for layer, layer_tmp in zip(model.layers[:fine_tune_at], model_tmp.layers[:fine_tune_at]):
+            layer.set_weights(layer_tmp.get_weights())
+            layer.trainable = False
+
+    model.summary()
+    # tf.keras.utils.plot_model(model, show_shapes=True)
+
+    return model
+
+
+def mobile_attention_unet(input_size=(216, 320, 1), n_filters=32, alpha=1.0, encoder="separable", batchnorm=True, dropout_rate=0.1, freeze=False, freeze_at=0, recompute=False):
+    """
+        Attention U-Net with a mobile encoder, the attention gates are shared with AttentionUnet.
+    """
+    inputs = Input(input_size, name="img")
+
+    # contraction path
+    (c1, c2, c3, c4), c5, filters = mobile_encoder(inputs,
+                                                   n_filters=n_filters,
+                                                   alpha=alpha,
+                                                   encoder=encoder,
+                                                   batchnorm=batchnorm,
+                                                   dropout_rate=dropout_rate,
+                                                   recompute=recompute)
+
+    # expansion path
+    gate = checkpoint(attention_gate, recompute)
+    a6 = gate(c4, c5, filters[3])
+    c6 = decoder_block(c5, a6, filters[3], dropout_rate, batchnorm, recompute)
+
+    a7 = gate(c3, c6, filters[2])
+    c7 = decoder_block(c6, a7, filters[2], dropout_rate, batchnorm, recompute)
+
+    a8 = gate(c2, c7, filters[1])
+    c8 = decoder_block(c7, a8, filters[1], dropout_rate, batchnorm, recompute)
+
+    a9 = gate(c1, c8, filters[0])
+    c9 = decoder_block(c8, a9, filters[0], dropout_rate, batchnorm, recompute)
+
+    outputs = Conv2D(1, (1, 1), activation="sigmoid")(c9)
+    model = Model(inputs=[inputs], outputs=[outputs],
+                  name="MobileAttentionUNet")
+
+    if freeze:
+        if recompute:
+            raise ValueError("freeze relies on the flat layer indices, it cannot be combined with recompute")
+        fine_tune_at = freeze_at
+        model_tmp = load_pretrain_model(
+            "../models/model_mobile_attention_unet.hdf5")
+
+        for layer, layer_tmp in zip(model.layers[:fine_tune_at], model_tmp.layers[:fine_tune_at]):
+            layer.set_weights(layer_tmp.get_weights())
+            layer.trainable = False
+
+    model.summary()
+    # tf.keras.utils.plot_model(model, show_shapes=True)
+
+    return model
+
+
+if __name__ == "__main__":
+    model = mobile_attention_unet()
+    dot_img_file = "../images/mobile_attention_unet.png"
+    tf.keras.utils.plot_model(model, to_file=dot_img_file, show_shapes=True)
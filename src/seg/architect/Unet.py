@@ -7,6 +7,7 @@ from tensorflow.keras import Input
 from tensorflow.keras.models import Model
 from tensorflow.keras.layers import Conv2D, BatchNormalization, Activation, MaxPooling2D, Dropout, Conv2DTranspose, concatenate, ZeroPadding2D
 
+from seg.architect.recompute import checkpoint
 from seg.utils import load_pretrain_model
 
 
@@ -48,57 +49,61 @@ def padding(x, y):
     return x, y
 
 
-def unet(input_size=(216, 320, 1), n_filters=64, batchnorm=True, dropout_rate=0.1, freeze=False, freeze_at=0):
+def unet(input_size=(216, 320, 1), n_filters=64, batchnorm=True, dropout_rate=0.1, freeze=False, freeze_at=0, recompute=False):
     inputs = Input(input_size, name="img")
+    # recompute: activations of every block are rematerialised in the backward pass
+    conv_block = checkpoint(conv2d_block, recompute)
 
     # contraction path
-    c1 = conv2d_block(inputs, n_filters*1, kernel_size=3, batchnorm=batchnorm)
+    c1 = conv_block(inputs, n_filters*1, kernel_size=3, batchnorm=batchnorm)
     p1 = MaxPooling2D((2, 2))(c1)
     p1 = Dropout(dropout_rate)(p1)
 
-    c2 = conv2d_block(p1, n_filters * 2, kernel_size=3, batchnorm=batchnorm)
+    c2 = conv_block(p1, n_filters * 2, kernel_size=3, batchnorm=batchnorm)
     p2 = MaxPooling2D((2, 2))(c2)
     p2 = Dropout(dropout_rate)(p2)
 
-    c3 = conv2d_block(p2, n_filters * 4, kernel_size=3, batchnorm=batchnorm)
+    c3 = conv_block(p2, n_filters * 4, kernel_size=3, batchnorm=batchnorm)
     p3 = MaxPooling2D((2, 2))(c3)
     p3 = Dropout(dropout_rate)(p3)
 
-    c4 = conv2d_block(p3, n_filters * 8, kernel_size=3, batchnorm=batchnorm)
+    c4 = conv_block(p3, n_filters * 8, kernel_size=3, batchnorm=batchnorm)
     p4 = MaxPooling2D((2, 2))(c4)
     p4 = Dropout(dropout_rate)(p4)
 
-    c5 = conv2d_block(p4, n_filters * 16, kernel_size=3, batchnorm=batchnorm)
+    c5 = conv_block(p4, n_filters * 16, kernel_size=3, batchnorm=batchnorm)
 
     # expansion path
     u6 = Conv2DTranspose(n_filters * 8, 3, strides=(2, 2), padding='same')(c5)
     u6, c4 = padding(u6, c4)
     u6 = concatenate([u6, c4])
     u6 = Dropout(dropout_rate)(u6)
-    c6 = conv2d_block(u6, n_filters * 8, kernel_size=3, batchnorm=batchnorm)
+    c6 = conv_block(u6, n_filters * 8, kernel_size=3, batchnorm=batchnorm)
 
     u7 = Conv2DTranspose(n_filters * 4, 3, strides=(2, 2), padding='same')(c6)
     u7, c3 = padding(u7, c3)
     u7 = concatenate([u7, c3])
     u7 = Dropout(dropout_rate)(u7)
-    c7 = conv2d_block(u7, n_filters * 4, kernel_size=3, batchnorm=batchnorm)
+    c7 = conv_block(u7, n_filters * 4, kernel_size=3, batchnorm=batchnorm)
 
     u8 = Conv2DTranspose(n_filters * 2, 3, strides=(2, 2), padding='same')(c7)
     u8, c2 = padding(u8, c2)
     u8 = concatenate([u8, c2])
     u8 = Dropout(dropout_rate)(u8)
-    c8 = conv2d_block(u8, n_filters * 2, kernel_size=3, batchnorm=batchnorm)
+    c8 = conv_block(u8, n_filters * 2, kernel_size=3, batchnorm=batchnorm)
 
     u9 = Conv2DTranspose(n_filters * 1, 3, strides=(2, 2), padding='same')(c8)
     u9, c1 = padding(u9, c1)
     u9 = concatenate([u9, c1])
     u9 = Dropout(dropout_rate)(u9)
-    c9 = conv2d_block(u9, n_filters * 1, kernel_size=3, batchnorm=batchnorm)
+    c9 = conv_block(u9, n_filters * 1, kernel_size=3, batchnorm=batchnorm)
 
     outputs = Conv2D(1, (1, 1), activation='sigmoid')(c9)
     model = Model(inputs=[inputs], outputs=[outputs], name="UNet")
 
     if freeze:
+        if recompute:
+            raise ValueError("freeze relies on the flat layer indices, it cannot be combined with recompute")
         fine_tune_at = freeze_at
         model_tmp = load_pretrain_model("../models/model_unet.hdf5")
 
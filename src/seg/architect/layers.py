@@ -0,0 +1,19 @@
+import tensorflow as tf
+from tensorflow.keras.layers import Layer
+
+
+class AttentionGate(Layer):
+    """
+        Scales the skip feature x by the 1-channel attention map alpha: x * alpha.
+        alpha is broadcast over the channels instead of being repeated n_filters times,
+        so no full size (H, W, C) attention tensor is materialised.
+        Inputs: [x (B, H, W, C), alpha (B, H, W, 1)]
+    """
+
+    def call(self, inputs):
+        x, alpha = inputs
+
+        return x * alpha
+
+    def compute_output_shape(self, input_shape):
+        return input_shape[0]
@@ -0,0 +1,73 @@
+import tensorflow as tf
+from tensorflow.keras import Input
+from tensorflow.keras.models import Model
+from tensorflow.keras.layers import Layer
+from tensorflow.keras import backend as K
+
+
+class RecomputeGrad(Layer):
+    """
+        Runs a sub-model inside tf.recompute_grad: its intermediate activations are not kept for the
+        backward pass but recomputed from the block input, trading one extra forward of the block for memory.
+        Note: BatchNormalization moving statistics inside the block are updated again by the recomputation,
+        which slightly speeds up their momentum, the trained weights are unaffected.
+        get_weights() of a model with blocks lists the weights block by block: seg.utils.transfer_weights copies
+        weights between the builds with and without recompute.
+    """
+
+    def __init__(self, block, **kwargs):
+        super().__init__(**kwargs)
+        self.block = block
+
+    def call(self, inputs, training=None):
+        inputs = inputs if isinstance(inputs, (list, tuple)) else [inputs]
+
+        def forward(*x):
+            return self.block(list(x) if len(x) > 1 else x[0], training=training)
+
+        return tf.recompute_grad(forward)(*inputs)
+
+    def compute_output_shape(self, input_shape):
+        return self.block.compute_output_shape(input_shape)
+
+    def get_config(self):
+        config = super().get_config()
+        config["block"] = tf.keras.layers.serialize(self.block)
+
+        return config
+
+    @classmethod
+    def from_config(cls, config, custom_objects=None):
+        config["block"] = tf.keras.layers.deserialize(config["block"],
+                                                      custom_objects=custom_objects)
+
+        return cls(**config)
+
+
+def is_tensor(x):
+    return tf.is_tensor(x) or (hasattr(x, "shape") and hasattr(x, "dtype") and K.is_keras_tensor(x))
+
+
+def checkpoint(block_fn, enabled=False):
+    """
+        Wraps a block builder (conv2d_block, dilated_block, attention_gate, ...) so that the block is
+        built as a sub-model and recomputed in the backward pass. The leading Keras tensor arguments
+        are the block inputs, the other arguments are forwarded to block_fn.
+        Returns block_fn unchanged when enabled is False.
+    """
+    if not enabled:
+        return block_fn
+
+    def wrapper(*args, **kwargs):
+        n_tensors = 0
+        while n_tensors < len(args) and is_tensor(args[n_tensors]):
+            n_tensors += 1
+        tensors, args = args[:n_tensors], args[n_tensors:]
+
+        inputs = [Input(t.shape[1:]) for t in tensors]
+        outputs = block_fn(*inputs, *args, **kwargs)
+        block = Model(inputs=inputs, outputs=outputs)
+
+        return RecomputeGrad(block)(list(tensors) if len(tensors) > 1 else tensors[0])
+
+    return wrapper
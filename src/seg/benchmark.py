@@ -0,0 +1,147 @@
+import os
+import time
+import numpy as np
+import pandas as pd
+
+import tensorflow as tf
+from tensorflow.keras.layers import Conv2D, DepthwiseConv2D, SeparableConv2D, Conv2DTranspose
+
+from seg import seglosses
+from seg.config import config
+from seg.data import DataLoader
+from seg.utils import load_infer_model
+
+from seg.architect.Unet import unet
+from seg.architect.DilateUnet import dilate_unet
+from seg.architect.AttentionUnet import attention_unet
+from seg.architect.DilateAttentionUnet import dilate_attention_unet
+from seg.architect.MobileUnet import mobile_unet, mobile_attention_unet
+
+
+def count_flops(model):
+    """
+        Analytic multiply-add count (x2) of the convolution layers for a single image.
+        Element-wise layers (BN, activations, add, pooling) are ignored, they are a few % at most.
+    """
+    flops = 0
+    for layer in model.layers:
+        if isinstance(layer, Conv2DTranspose):
+            # every input pixel is scattered through the full kernel
+            _, h, w, c_in = layer.input_shape
+            kh, kw = layer.kernel_size
+            flops += 2 * h * w * kh * kw * c_in * layer.filters
+        elif isinstance(layer, SeparableConv2D):
+            _, h, w, c_out = layer.output_shape
+            c_in = layer.input_shape[-1]
+            kh, kw = layer.kernel_size
+            flops += 2 * h * w * c_in * layer.depth_multiplier * kh * kw
+            flops += 2 * h * w * c_in * layer.depth_multiplier * c_out
+        elif isinstance(layer, DepthwiseConv2D):
+            _, h, w, c_out = layer.output_shape
+            kh, kw = layer.kernel_size
+            flops += 2 * h * w * c_out * kh * kw
+        elif isinstance(layer, Conv2D):
+            _, h, w, c_out = layer.output_shape
+            c_in = layer.input_shape[-1]
+            kh, kw = layer.kernel_size
+            flops += 2 * h * w * c_out * kh * kw * c_in // layer.groups
+
+    return flops
+
+
+def measure_latency(model, batch_size=1, warmup=3, runs=20):
+    """
+        Median wall time (ms) of a forward pass in inference mode.
+    """
+    input_shape = model.input_shape[1:]
+    x = tf.random.uniform((batch_size, ) + tuple(input_shape))
+
+    forward = tf.function(lambda x: model(x, training=False))
+    for _ in range(warmup):
+        forward(x).numpy()
+
+    times = list()
+    for _ in range(runs):
+        start = time.perf_counter()
+        forward(x).numpy()
+        times.append(time.perf_counter() - start)
+
+    return 1000. * np.median(times) / batch_size
+
+
+def evaluate_dice(model, batch_size=config["batch_size"]):
+    """
+        Mean Dice on the (non augmented) validation split.
+    """
+    valid_set = DataLoader("./data/training_set/",
+                           mode="valid",
+                           augmentation=False,
+                           one_hot_encoding=True,
+                           palette=config["palette"],
+                           image_size=model.input_shape[1:])
+    valid_gen = valid_set.data_gen(batch_size)
+
+    dices = list()
+    for images, masks in valid_gen:
+        preds = model(images, training=False)
+        dices.append(seglosses.dice_coeff(masks, preds, reduction="none").numpy())
+
+    return float(np.mean(np.concatenate(dices)))
+
+
+BUILDERS = {
+    "unet": lambda: unet(input_size=config["image_size"]),
+    "dilate_unet": lambda: dilate_unet(input_size=config["image_size"]),
+    "attention_unet": lambda: attention_unet(input_size=config["image_size"]),
+    "dilate_attention_unet": lambda: dilate_attention_unet(input_size=config["image_size"]),
+    "dilate_unet_aspp": lambda: dilate_unet(input_size=config["image_size"], bottleneck="aspp"),
+    "dilate_attention_unet_aspp": lambda: dilate_attention_unet(input_size=config["image_size"], bottleneck="aspp"),
+    "mobile_unet_separable_a1.0": lambda: mobile_unet(input_size=config["image_size"], alpha=1.0),
+    "mobile_unet_separable_a0.5": lambda: mobile_unet(input_size=config["image_size"], alpha=0.5),
+    "mobile_unet_inverted_a1.0": lambda: mobile_unet(input_size=config["image_size"], alpha=1.0, encoder="inverted_residual"),
+    "mobile_unet_inverted_a0.5": lambda: mobile_unet(input_size=config["image_size"], alpha=0.5, encoder="inverted_residual"),
+    "mobile_attention_unet_separable_a1.0": lambda: mobile_attention_unet(input_size=config["image_size"], alpha=1.0),
+    "mobile_attention_unet_inverted_a1.0": lambda: mobile_attention_unet(input_size=config["image_size"], alpha=1.0, encoder="inverted_residual"),
+}
+
+
+def benchmark(checkpoints=None, builders=BUILDERS, latency_budget_ms=None, save_path="./data/benchmark.csv"):
+    """
+        Reports params, FLOPs, CPU latency and validation Dice per model.
+        checkpoints: {name: hdf5 path} of trained models, Dice is only reported for these.
+        builders: {name: callable} of untrained architectures, only cost is reported.
+        latency_budget_ms: if set, marks which models fit the per-scan budget.
+    """
+    checkpoints = checkpoints or {}
+    rows = list()
+
+    models = [(name, lambda path=path: load_infer_model(path), True)
+              for name, path in checkpoints.items()]
+    models += [(name, builder, False) for name, builder in builders.items()]
+
+    for name, build, trained in models:
+        print("="*100)
+        print("Benchmarking {} ...".format(name))
+        model = build()
+
+        rows.append({
+            "model": name,
+            "params (M)": model.count_params() / 1e6,
+            "GFLOPs": count_flops(model) / 1e9,
+            "latency (ms)": measure_latency(model),
+            "dice": evaluate_dice(model) if trained else np.nan
+        })
+        tf.keras.backend.clear_session()
+
+    df = pd.DataFrame(rows).sort_values("latency (ms)")
+    if latency_budget_ms is not None:
+        df["within budget"] = df["latency (ms)"] <= latency_budget_ms
+
+    print(df.to_string(index=False))
+    df.to_csv(save_path, index=False)
+
+    return df
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,147 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import numpy as np
+
+from seg.rle import rle_encode_rows, rle_decode_rows
+
+
+def file_hash(paths, chunk_size=1 << 20):
+    """
+        sha256 of the content of a file or of a list of files (a snapshot ensemble), in order
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+
+    digest = hashlib.sha256()
+    for path in paths:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+class PredictionCache(object):
+    '''Persistent key-value store of the predictions, so that images already seen by a model skip it.
+    # Usage
+        ```python
+            with PredictionCache("./data/cache/predictions", file_hash(model_path)) as cache:
+                ellipse, mask = predict.pred_ellipse(model, image_path, cache=cache)
+        ```
+    # Arguments
+        cache_dir: Directory of the sqlite database (predictions.sqlite).
+        model_key: Hash of the model checkpoint(s), see file_hash.
+        settings: Preprocessing and post-processing settings of the predictions (image size, threshold, ...),
+                  part of the key with the image and the model. The pixel size of an image, which varies
+                  from image to image, is given to get / put instead.
+        max_bytes: Size of the stored predictions above which the least recently used ones are evicted.
+        store_masks: Keeps the per-row RLE of the binary mask (seg.rle) with the ellipse.
+    # Notes
+        The key is the sha256 of the image bytes, the model key and the settings: a retrained
+        checkpoint, an edited image or another image size misses the cache instead of returning
+        a stale prediction. Entries are (ellipse as returned by seg.ellipse.ellipse_fit_mask, mask).
+    '''
+
+    def __init__(self, cache_dir, model_key, settings=None, max_bytes=256 * 2 ** 20, store_masks=True):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, "predictions.sqlite")
+        self.prefix = json.dumps({"model": model_key, "settings": settings}, sort_keys=True).encode()
+        self.max_bytes = max_bytes
+        self.store_masks = store_masks
+
+        self.db = sqlite3.connect(self.path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS predictions ("
+                        "key TEXT PRIMARY KEY, ellipse TEXT, shape TEXT, mask BLOB, "
+                        "size INTEGER, accessed REAL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS accessed ON predictions (accessed)")
+        self.db.commit()
+
+        self.hits = 0
+        self.misses = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM predictions").fetchone()[0]
+
+    def key(self, image_bytes, pixel_size=None):
+        pixel_size = b"" if pixel_size is None else json.dumps(float(pixel_size)).encode()
+
+        return hashlib.sha256(self.prefix + pixel_size + b"\0" + image_bytes).hexdigest()
+
+    def size(self):
+        return self.db.execute("SELECT COALESCE(SUM(size), 0) FROM predictions").fetchone()[0]
+
+    def get(self, image_bytes, pixel_size=None):
+        """
+            (ellipse, mask) of the image, mask is a uint8 {0, 1} array or None (store_masks=False), None on a miss
+        """
+        key = self.key(image_bytes, pixel_size)
+        row = self.db.execute("SELECT ellipse, shape, mask FROM predictions WHERE key = ?",
+                              (key, )).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.db.execute("UPDATE predictions SET accessed = ? WHERE key = ?", (time.time(), key))
+        self.db.commit()
+
+        ellipse, shape, record = row
+        (xx, yy), (MA, ma), angle = json.loads(ellipse)
+        mask = None
+        if record is not None:
+            h, w = json.loads(shape)
+            runs_per_row = np.frombuffer(record[:2 * h], dtype=np.uint16)
+            runs = np.frombuffer(record[2 * h:], dtype=np.uint16).reshape(-1, 2)
+            mask = rle_decode_rows(runs_per_row, runs, (h, w))
+
+        return ((xx, yy), (MA, ma), angle), mask
+
+    def put(self, image_bytes, ellipse, mask=None, pixel_size=None):
+        """
+            Stores the prediction of the image, mask (binary 2D array) only if store_masks
+        """
+        (xx, yy), (MA, ma), angle = ellipse
+        ellipse = json.dumps([[float(xx), float(yy)], [float(MA), float(ma)], float(angle)])
+
+        shape = record = None
+        if self.store_masks and mask is not None:
+            mask = np.asarray(mask).squeeze() > 0.5
+            runs_per_row, runs = rle_encode_rows(mask)
+            shape = json.dumps(list(mask.shape))
+            record = runs_per_row.tobytes() + runs.tobytes()
+
+        size = len(ellipse) + (len(record) if record is not None else 0)
+        self.db.execute("INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?, ?)",
+                        (self.key(image_bytes, pixel_size), ellipse, shape, record, size, time.time()))
+        self.evict()
+        self.db.commit()
+
+    def evict(self):
+        """
+            Deletes the least recently used predictions until the cache fits in max_bytes
+        """
+        excess = self.size() - self.max_bytes
+        if excess <= 0:
+            return
+
+        keys = list()
+        for key, size in self.db.execute("SELECT key, size FROM predictions ORDER BY accessed"):
+            keys.append((key, ))
+            excess -= size
+            if excess <= 0:
+                break
+        self.db.executemany("DELETE FROM predictions WHERE key = ?", keys)
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
@@ -5,11 +5,46 @@ config = {
     "optimizer": "sgd",
     "freeze": False,
     "freeze_at": 24,
+    # with freeze, seg.tuning_focal fits the unfrozen layers on the activations of the frozen ones,
+    # computed once in feature_cache_dir (seg.feature_cache), None runs the frozen layers every step
+    "feature_cache_dir": None,
+    "feature_cache_passes": 0,  # fixed augmented passes of the training set in the cache, 0: non-augmented
     "dropout_rate": 0.1,
     "momentum": 0.9,
     "learning_rate": 0.1,
     # (216, 320, 1) # (270, 400, 1) # (432, 640, 1)
     "image_size": (216, 320, 1),
-    "batch_size": 16,
-    "epochs": 200
+    # physical resolution of the model input, None fits every scan in image_size whatever its pixel size;
+    # image_size * mm_per_pixel is the field of view, e.g. 0.6 mm -> 130 x 192 mm at (216, 320)
+    "mm_per_pixel": None,
+    "batch_size": 16,  # effective batch size, split in accum_steps micro-batches
+    "accum_steps": 1,
+    "epochs": 200,
+    # progressive resizing of seg.train.train, None trains at image_size only, e.g.
+    # [{"epoch": 0, "image_size": (112, 160, 1), "batch_size": 64},
+    #  {"epoch": 100, "image_size": (216, 320, 1), "batch_size": 16},
+    #  {"epoch": 170, "image_size": (432, 640, 1), "batch_size": 4}]
+    # the batch size of a phase defaults to batch_size scaled by the number of input pixels,
+    # every size has to be a multiple of 8 (three poolings of dilate_unet)
+    "progressive_resize": None,
+    "seed": 42,  # shuffle, augmentation and weight init
+    "data_cache_dir": "../data/cache",  # decoded and resized images, keyed by image_size / palette / csv
+    "records_dir": None,  # seg.records shards of train / valid, read instead of the png files
+    "bottleneck": "dilated",  # "dilated" (serial) or "aspp" (parallel, rates capped by the feature size)
+    "recompute": False,  # gradient checkpointing of every block, for large image sizes
+    # heatmap keypoint model (seg.train.train_keypoints)
+    "keypoints": {
+        "encoder": "separable",
+        "alpha": 1.0,
+        "sigma": 2.0  # gaussian radius of the heatmaps, in stride 4 cells
+    },
+    # knowledge distillation (seg.train.train_distillation)
+    "distillation": {
+        "teacher_path": "../models/model_dilate_attention_unet.hdf5",
+        "student_filters": 16,
+        "alpha": 0.5,  # weight of the soft teacher term
+        "temperature": 1.0,
+        "soft_loss": "mse",  # "mse" or "kl"
+        "cache_dir": "../models/teacher_cache"
+    }
 }
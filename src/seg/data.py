@@ -1,5 +1,6 @@
 import os
-import random
+import json
+import hashlib
 import numpy as np
 import pandas as pd
 from PIL import Image
@@ -8,9 +9,17 @@ import cv2
 import tensorflow as tf
 
 from seg.config import config
+from seg.targets import get_target
+from seg.records import records_path, read_shards
 
 # https://github.com/HasnainRaz/SemSegPipeline/blob/master/dataloader.py
 AUTOTUNE = tf.data.experimental.AUTOTUNE
+# records shuffled inside every shard when the training shards are read in parallel
+SHARD_BUFFER = 64
+
+
+def random_bool(seed):
+    return tf.cast(tf.random.stateless_uniform([], seed, maxval=2, dtype=tf.int32), tf.bool)
 
 
 class DataLoader(object):
@@ -18,9 +27,18 @@ class DataLoader(object):
         A TensorFlow Dataset API based loader for semantic segmentation problems.
     """
 
-    def __init__(self, root, mode="train", augmentation=False, compose=False, one_hot_encoding=False, palette=None, image_size=(216, 320, 1)):
+    def __init__(self, root, mode="train", augmentation=False, compose=False, one_hot_encoding=False, palette=None, image_size=(216, 320, 1), seed=config["seed"], cache_dir=None, target="mask", csv_path=None, mm_per_pixel=config["mm_per_pixel"], records_dir=config["records_dir"]):
         """
         root: "./data/training_set"
+        seed: seed of the shuffle and of every augmentation decision
+        cache_dir: directory of the on-disk cache of the decoded and resized images, in memory if None
+        target: "mask", "ellipse", "bbox", "keypoints", "heatmaps" or a target builder of seg.targets
+        csv_path: csv of the images and labels, the default one of mode if None
+        mm_per_pixel: resamples every image to this physical resolution with its "pixel size(mm)"
+                      and centre crops / pads it to image_size, instead of fitting the whole scan
+                      in image_size (resize_with_pad) whatever its pixel size
+        records_dir: reads the images and masks from the seg.records shards of the csv in records_dir
+                     (train and valid), the png files when there are none
         """
         super().__init__()
         self.root = root
@@ -30,8 +48,15 @@ class DataLoader(object):
         self.one_hot_encoding = one_hot_encoding
         self.palette = palette
         self.image_size = (image_size[0], image_size[1])
-
-        if (self.mode == "train"):
+        self.channels = image_size[2] if len(image_size) > 2 else 1
+        self.seed = seed
+        self.cache_dir = cache_dir
+        self.target = get_target(target)
+        self.mm_per_pixel = mm_per_pixel
+
+        if csv_path is not None:
+            self.df = pd.read_csv(csv_path)
+        elif (self.mode == "train"):
             self.df = pd.read_csv("./data/train.csv")
         elif (self.mode == "valid"):
             self.df = pd.read_csv("./data/valid.csv")
@@ -40,6 +65,16 @@ class DataLoader(object):
             self.df = pd.read_csv("./data/test_set_pixel_size.csv")
 
         self.parse_data_path()
+        self.pixel_sizes = self.df["pixel size(mm)"].values.astype(np.float32) \
+            if mm_per_pixel is not None else None
+
+        self.records = None
+        if records_dir is not None and self.mode in ["train", "valid"]:
+            path = records_path(records_dir, self.mode, self.df)
+            if os.path.exists(path):
+                self.records = path
+            else:
+                print("No records of this csv in {}, reading the png files".format(records_dir))
 
     def parse_data_path(self):
         if self.mode in ["train", "valid"]:
@@ -52,14 +87,24 @@ class DataLoader(object):
             self.image_paths = [os.path.join(self.root, _[0])
                                 for _ in self.df.values.tolist()]
 
+    def csv_values(self, columns):
+        """
+            float32 table of columns of the csv, one row per image
+        """
+        return tf.constant(self.df[columns].values, tf.float32)
+
     def parse_data(self, image_paths, mask_paths=None):
         image_content = tf.io.read_file(image_paths)
-        # grayscale
-        images = tf.image.decode_png(image_content, channels=1)
+        mask_content = tf.io.read_file(mask_paths) if mask_paths is not None else None
+
+        return self.decode_data(image_content, mask_content)
+
+    def decode_data(self, image_content, mask_content=None):
+        # grayscale, repeated when the model takes 3 channels
+        images = tf.image.decode_png(image_content, channels=self.channels)
         images = tf.cast(images, tf.float32)
 
-        if self.mode in ["train", "valid"]:
-            mask_content = tf.io.read_file(mask_paths)
+        if mask_content is not None:
             # grayscale
             masks = tf.image.decode_png(mask_content, channels=1)
             masks = tf.cast(masks, tf.float32)
@@ -80,21 +125,72 @@ class DataLoader(object):
 
         return image
 
-    def resize_data(self, image, mask=None):
+    def resize_data(self, image, mask=None, pixel_size=None):
         """
-            Resizes image to specified size but still keep aspect ratio
+            Resizes image to specified size but still keep aspect ratio.
+            With mm_per_pixel and the pixel size of the image, resamples it to mm_per_pixel instead
+            (antialiased bilinear for the image, nearest for the mask) and centre crops / pads it
+            to the specified size.
         """
-        image = tf.image.resize_with_pad(
-            image, self.image_size[0], self.image_size[1], method="nearest")
+        image = self.resample(image, pixel_size, "bilinear")
 
         if mask is not None:
-            mask = tf.image.resize_with_pad(
-                mask, self.image_size[0], self.image_size[1], method="nearest")
+            mask = self.resample(mask, pixel_size, "nearest")
 
             return image, mask
 
         return image
 
+    def resample(self, x, pixel_size=None, method="bilinear"):
+        """
+            resize_data of a single image or mask, method of the mm_per_pixel resampling
+        """
+        self.check_pixel_size(pixel_size)
+        if self.mm_per_pixel is None:
+            return tf.image.resize_with_pad(
+                x, self.image_size[0], self.image_size[1], method="nearest")
+
+        scale, _ = self.resize_geometry(tf.shape(x), pixel_size)
+        size = tf.cast(tf.floor(tf.cast(tf.shape(x)[:2], tf.float32) * scale), tf.int32)
+        # downsampling by up to ~8x (0.07 -> 0.6 mm), nearest would drop the small structures of an image
+        x = tf.image.resize(x, size, method=method, antialias=method != "nearest")
+
+        return tf.image.resize_with_crop_or_pad(x, self.image_size[0], self.image_size[1])
+
+    def resize_geometry(self, image_shape, pixel_size=None):
+        """
+            Scale and (x, y) offset mapping the pixels of an image of image_shape to the output of resize_data,
+            also element-wise for vectors of heights, widths and pixel sizes.
+            A pixel p of the output is at (p - offset) / scale * pixel size (mm) in the image.
+        """
+        self.check_pixel_size(pixel_size)
+        height = tf.cast(image_shape[0], tf.float32)
+        width = tf.cast(image_shape[1], tf.float32)
+
+        if self.mm_per_pixel is None:
+            # same computation as tf.image.resize_with_pad
+            ratio = tf.maximum(width / self.image_size[1], height / self.image_size[0])
+        else:
+            ratio = self.mm_per_pixel / tf.cast(pixel_size, tf.float32)
+        resized_height = tf.floor(height / ratio)
+        resized_width = tf.floor(width / ratio)
+
+        # padded (centered as resize_with_pad) or cropped (as resize_with_crop_or_pad)
+        def centre(size, resized):
+            return tf.where(resized <= size,
+                            tf.floor((size - resized) / 2),
+                            -tf.floor((resized - size) / 2))
+
+        offset = tf.stack([centre(self.image_size[1], resized_width),
+                           centre(self.image_size[0], resized_height)])
+
+        return 1. / ratio, offset
+
+    def check_pixel_size(self, pixel_size):
+        if self.mm_per_pixel is not None and pixel_size is None:
+            raise ValueError("The loader resamples to mm_per_pixel={}, the pixel size (mm) of the image is "
+                             "required".format(self.mm_per_pixel))
+
     def one_hot_encode(self, image, mask):
         """
             One hot encodes mask
@@ -110,120 +206,128 @@ class DataLoader(object):
 
         return image, one_hot_map
 
-    def change_brightness(self, image, mask):
+    def change_brightness(self, image, mask, seed):
         """
             Randomly applies a random brightness change.
         """
-        cond_brightness = tf.cast(tf.random.uniform(
-            [], maxval=2, dtype=tf.int32), tf.bool)
-        image = tf.cond(cond_brightness,
-                        lambda: tf.image.random_brightness(image, 0.1),
+        seeds = tf.random.experimental.stateless_split(seed, 2)
+        image = tf.cond(random_bool(seeds[0]),
+                        lambda: tf.image.stateless_random_brightness(
+                            image, 0.1, seeds[1]),
                         lambda: tf.identity(image))
 
         return image, mask
 
-    def change_contrast(self, image, mask):
+    def change_contrast(self, image, mask, seed):
         """
             Randomly applies a random contrast change.
         """
-        cond_contrast = tf.cast(tf.random.uniform(
-            [], maxval=2, dtype=tf.int32), tf.bool)
-        image = tf.cond(cond_contrast,
-                        lambda: tf.image.random_contrast(image, 0.1, 0.5),
+        seeds = tf.random.experimental.stateless_split(seed, 2)
+        image = tf.cond(random_bool(seeds[0]),
+                        lambda: tf.image.stateless_random_contrast(
+                            image, 0.1, 0.5, seeds[1]),
                         lambda: tf.identity(image))
 
         return image, mask
 
-    def flip_horizontally(self, image, mask):
+    def flip_horizontally(self, image, mask, seed):
         """
             Randomly flips image and mask horizontally in accord.
         """
         comb_tensor = tf.concat([image, mask], axis=2)
-        comb_tensor = tf.image.random_flip_left_right(comb_tensor)
-        image, mask = tf.split(comb_tensor, [1, 1], axis=2)
+        comb_tensor = tf.image.stateless_random_flip_left_right(comb_tensor, seed)
+        image, mask = tf.split(comb_tensor, [self.channels, -1], axis=2)
 
         return image, mask
 
-    def reorder_channel(self, tensor, order="channel_first"):
-        if order == "channel_first":
-            return tf.convert_to_tensor(np.moveaxis(tensor.numpy(), -1, 0))
-        else:
-            return tf.convert_to_tensor(np.moveaxis(tensor.numpy(), 0, -1))
-
-    def _tranform(self, tensor, types):
-        tensor = self.reorder_channel(tensor)
-
-        if types == "rotate":
-            tensor = tf.keras.preprocessing.image.random_rotation(tensor, 15)
-        elif types == "shift":
-            tensor = tf.keras.preprocessing.image.random_shift(
-                tensor, 0.1, 0.1)
-        else:
-            tensor = tf.keras.preprocessing.image.random_zoom(
-                tensor, (1.2, 1.2))
-
-        tensor = self.reorder_channel(
-            tf.convert_to_tensor(tensor), order="channel_last")
-
-        return tensor
+    def _affine_transform(self, tensor, interpolation, theta=0., tx=0., ty=0., zx=1., zy=1.):
+        """
+            In-graph tf.keras.preprocessing.image.apply_affine_transform (row_axis=0, col_axis=1, fill_mode="nearest"):
+            rotation by theta degrees, shift by tx / ty pixels and zoom zx / zy along the columns / rows,
+            about the image centre, as one ImageProjectiveTransformV3 op.
+        """
+        theta = tf.cast(theta, tf.float32) * np.pi / 180.
+        tx, ty, zx, zy = [tf.cast(param, tf.float32) for param in (tx, ty, zx, zy)]
+        size = tf.cast(tf.shape(tensor)[:2], tf.float32)
+        cy, cx = (size[0] - 1.) / 2., (size[1] - 1.) / 2.
+        cos, sin = tf.cos(theta), tf.sin(theta)
+
+        # output pixel (x, y) = (column, row) -> input pixel, relative to the centre: rotation(shift(zoom(p)))
+        a0, a1 = cos * zx, -sin * zy
+        b0, b1 = sin * zx, cos * zy
+        a2 = cx - a0 * cx - a1 * cy + cos * tx - sin * ty
+        b2 = cy - b0 * cx - b1 * cy + sin * tx + cos * ty
+        transform = tf.stack([a0, a1, a2, b0, b1, b2, 0., 0.])[tf.newaxis]
+
+        output = tf.raw_ops.ImageProjectiveTransformV3(images=tensor[tf.newaxis],
+                                                       transforms=transform,
+                                                       output_shape=tf.shape(tensor)[:2],
+                                                       fill_value=0.,
+                                                       interpolation=interpolation,
+                                                       fill_mode="NEAREST")[0]
+        output.set_shape(tensor.shape)
+
+        return output
+
+    def affine_transform(self, image, mask, **params):
+        """
+            Same transform of image (bilinear) and mask (nearest, the classes stay hard)
+        """
+        return (self._affine_transform(image, "BILINEAR", **params),
+                self._affine_transform(mask, "NEAREST", **params))
 
-    def rotate(self, image, mask):
+    def rotate(self, image, mask, seed):
         """
             Randomly rotates image and mask
         """
-        cond_rotate = tf.cast(tf.random.uniform(
-            [], maxval=2, dtype=tf.int32), tf.bool)
-        comb_tensor = tf.concat([image, mask], axis=2)
-        comb_tensor = tf.cond(cond_rotate,
-                              lambda: self._tranform(comb_tensor, "rotate"),
-                              lambda: tf.identity(comb_tensor))
-        image, mask = tf.split(comb_tensor, [1, 1], axis=2)
+        seeds = tf.random.experimental.stateless_split(seed, 2)
+        theta = tf.random.stateless_uniform([], seeds[1], -15., 15.)
 
-        return image, mask
+        return tf.cond(random_bool(seeds[0]),
+                       lambda: self.affine_transform(image, mask, theta=theta),
+                       lambda: (tf.identity(image), tf.identity(mask)))
 
-    def shift(self, image, mask):
+    def shift(self, image, mask, seed):
         """
             Randomly translates image and mask
         """
-        cond_shift = tf.cast(tf.random.uniform(
-            [], maxval=2, dtype=tf.int32), tf.bool)
-        comb_tensor = tf.concat([image, mask], axis=2)
-        comb_tensor = tf.cond(cond_shift,
-                              lambda: self._tranform(comb_tensor, "shift"),
-                              lambda: tf.identity(comb_tensor))
-        image, mask = tf.split(comb_tensor, [1, 1], axis=2)
+        seeds = tf.random.experimental.stateless_split(seed, 2)
+        shift = tf.random.stateless_uniform([2], seeds[1], -0.1, 0.1)
+        size = tf.cast(tf.shape(image)[:2], tf.float32)
 
-        return image, mask
+        return tf.cond(random_bool(seeds[0]),
+                       lambda: self.affine_transform(image, mask,
+                                                     tx=shift[1] * size[1],
+                                                     ty=shift[0] * size[0]),
+                       lambda: (tf.identity(image), tf.identity(mask)))
 
-    def zoom(self, image, mask):
+    def zoom(self, image, mask, seed):
         """
             Randomly scale image and mask
         """
-        cond_zoom = tf.cast(tf.random.uniform(
-            [], maxval=2, dtype=tf.int32), tf.bool)
-        comb_tensor = tf.concat([image, mask], axis=2)
-        comb_tensor = tf.cond(cond_zoom,
-                              lambda: self._tranform(comb_tensor, "zoom"),
-                              lambda: tf.identity(comb_tensor))
-        image, mask = tf.split(comb_tensor, [1, 1], axis=2)
-
-        return image, mask
+        return tf.cond(random_bool(seed),
+                       lambda: self.affine_transform(image, mask, zx=1.2, zy=1.2),
+                       lambda: (tf.identity(image), tf.identity(mask)))
 
     def _equalize_histogram(self, image):
         clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
-        img_his_eq = clahe.apply(image.numpy().astype(np.uint8))
-        image = np.expand_dims(img_his_eq, axis=-1)
+        img_his_eq = clahe.apply(image[..., 0].astype(np.uint8))
+        image = np.repeat(img_his_eq[..., None], image.shape[-1], axis=-1)
 
-        return tf.convert_to_tensor(image, dtype=tf.float32)
+        return image.astype(np.float32)
 
-    def equalize_histogram(self, image, mask):
+    def equalize_histogram(self, image, mask, seed):
         """
             Apply CLAHE (Contrast Limited Adaptive Histogram Equalization)
         """
-        cond_he = tf.cast(tf.random.uniform(
-            [], maxval=2, dtype=tf.int32), tf.bool)
-        image = tf.cond(cond_he,
-                        lambda: self._equalize_histogram(image),
+        def clahe():
+            image_eq = tf.numpy_function(self._equalize_histogram, [image], tf.float32)
+            image_eq.set_shape(image.shape)
+
+            return image_eq
+
+        image = tf.cond(random_bool(seed),
+                        clahe,
                         lambda: tf.identity(image))
 
         return image, mask
@@ -253,69 +357,190 @@ class DataLoader(object):
 
         return image, mask
 
+    def augmentations(self):
+        """
+            The geometric augmentations are only used when the target follows them (masks)
+        """
+        if self.target.geometric:
+            return [self.change_brightness,
+                    self.flip_horizontally,
+                    self.rotate,
+                    self.shift]
+
+        return [self.change_brightness,
+                self.change_contrast]
+
+    def pixel_size(self, index):
+        """
+            Pixel size (mm) of the image index when resampling to mm_per_pixel, None otherwise
+        """
+        if self.pixel_sizes is None:
+            return None
+
+        return tf.gather(self.pixel_sizes, index)
+
+    @tf.function
+    def load_function(self, index):
+        """
+            Deterministic stage: read, decode, resize and build the target, kept as uint8 when possible
+            to make the cache smaller
+        """
+        image_content = tf.io.read_file(tf.gather(self.image_paths, index))
+        mask_content = tf.io.read_file(tf.gather(self.mask_paths, index)) \
+            if self.target.needs_mask else None
+
+        return self.prepare(index, image_content, mask_content)
+
+    @tf.function
+    def load_record(self, example):
+        """
+            load_function of an example of the seg.records shards
+        """
+        mask_content = example["mask"] if self.target.needs_mask else None
+
+        return self.prepare(example["index"], example["image"], mask_content)
+
+    def prepare(self, index, image_content, mask_content=None):
+        pixel_size = self.pixel_size(index)
+        if mask_content is not None:
+            image, mask = self.decode_data(image_content, mask_content)
+            mask = self.resample(mask, pixel_size, "nearest")
+        else:
+            image = self.decode_data(image_content)
+            mask = None
+
+        geometry = self.resize_geometry(tf.shape(image), pixel_size)
+        image = self.resize_data(image, pixel_size=pixel_size)
+        target = self.target.load(self, index, mask, geometry)
+
+        # bilinear values with mm_per_pixel, rounded rather than truncated
+        return index, tf.cast(tf.round(image), tf.uint8), target
+
     @tf.function
-    def map_function(self, images_path, masks_path):
-        image, mask = self.parse_data(images_path, masks_path)
-
-        def augmentation_func(image_f, mask_f):
-            image_f, mask_f = self.equalize_histogram(image_f, mask_f)
-            image_f, mask_f = self.normalize_data(image_f, mask_f)
-
-            if self.augmentation:
-                if self.compose:
-                    image_f, mask_f = self.change_brightness(image_f, mask_f)
-                    image_f, mask_f = self.flip_horizontally(image_f, mask_f)
-                    image_f, mask_f = self.rotate(image_f, mask_f)
-                    image_f, mask_f = self.shift(image_f, mask_f)
-                else:
-                    options = [self.change_brightness,
-                               self.flip_horizontally,
-                               self.rotate,
-                               self.shift]
-                    augment_func = random.choice(options)
-                    image_f, mask_f = augment_func(image_f, mask_f)
-
-            if self.one_hot_encoding:
-                if self.palette is None:
-                    raise ValueError('No Palette for one-hot encoding specified in the data loader! \
-                                      please specify one when initializing the loader.')
-                image_f, mask_f = self.one_hot_encode(image_f, mask_f)
-
-            image_f, mask_f = self.resize_data(image_f, mask_f)
-
-            return image_f, mask_f
-
-        return tf.py_function(augmentation_func, [image, mask], [tf.float32, tf.float32])
+    def map_function(self, position, sample):
+        """
+            Stochastic stage, position: position of the element in the epoch.
+            Every random decision is a stateless op seeded with (seed, position, csv row),
+            the pipeline is reproducible whatever the parallelism.
+        """
+        index, image, target = sample
+        image = tf.cast(image, tf.float32)
+        if self.target.needs_mask:
+            target = tf.cast(target, tf.float32)
+
+        seed = tf.stack([tf.constant(self.seed, tf.int64),
+                         position * len(self.image_paths) + index])
+        seeds = tf.random.experimental.stateless_split(seed, 3)
+
+        # CLAHE is drawn at random, an augmentation: evaluation inputs stay the same every epoch
+        if self.augmentation:
+            image, target = self.equalize_histogram(image, target, seeds[0])
+        image, target = self.normalize_data(image, target)
+
+        if self.augmentation:
+            options = self.augmentations()
+            if self.compose:
+                aug_seeds = tf.random.experimental.stateless_split(seeds[1], len(options))
+                for augment_func, aug_seed in zip(options, tf.unstack(aug_seeds)):
+                    image, target = augment_func(image, target, aug_seed)
+            else:
+                choice = tf.random.stateless_uniform([], seeds[1],
+                                                     maxval=len(options),
+                                                     dtype=tf.int32)
+                image, target = tf.switch_case(choice, [
+                    lambda augment_func=augment_func: augment_func(image, target, seeds[2])
+                    for augment_func in options])
+
+        image, target = self.target.build(self, image, target)
+
+        return image, target
 
     @tf.function
-    def test_map_function(self, images_path):
-        image = self.parse_data(images_path)
+    def test_map_function(self, index):
+        image = self.parse_data(tf.gather(self.image_paths, index))
 
         image_f = self.normalize_data(image)
-        image_f = self.resize_data(image_f)
+        image_f = self.resize_data(image_f, pixel_size=self.pixel_size(index))
 
         return image_f
 
-    def data_gen(self, batch_size, shuffle=False):
-        if self.mode in ["train", "valid"]:
-            # Create dataset out of the 2 files:
-            data = tf.data.Dataset.from_tensor_slices(
-                (self.image_paths, self.mask_paths))
+    def content_key(self):
+        """
+            Everything that changes the content or the order of the deterministic stage,
+            the key of its cache and of the caches built from it (teacher predictions)
+        """
+        return {
+            "root": os.path.abspath(self.root),
+            "mode": self.mode,
+            "image_size": list(self.image_size),
+            "mm_per_pixel": self.mm_per_pixel,
+            "palette": self.palette,
+            "channels": self.channels,
+            "target": [type(self.target).__name__, vars(self.target)],
+            "csv": self.df.to_csv(index=False)
+        }
+
+    def cache_path(self, shuffled_shards=False):
+        """
+            Cache file of the deterministic stage, keyed by everything that changes its content:
+            changing the image size, the palette or the csv starts a new cache.
+            shuffled_shards: the cache is filled in the seeded, interleaved order of the shards
+            instead of csv order, in a file of its own.
+        """
+        if self.cache_dir is None:
+            return ""
+
+        key = self.content_key()
+        if shuffled_shards:
+            key["order"] = ["shards", self.seed]
+        key = hashlib.md5(json.dumps(key, sort_keys=True).encode()).hexdigest()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        return os.path.join(self.cache_dir, "{}_{}".format(self.mode, key))
 
-            # Parse images and labels
-            data = data.map(self.map_function, num_parallel_calls=AUTOTUNE)
+    def dataset(self, shuffle=False, with_index=False):
+        """
+            Parsed, unbatched dataset, in csv order unless shuffle.
+            The deterministic stage is computed once and cached (memory or cache_dir), the shuffle
+            (full dataset buffer, new seeded order every epoch) and the augmentations run after the cache.
+            With shuffle, the seg.records shards are read by parallel interleaved streams: consumers
+            keyed on the csv row (teacher predictions) use with_index, (index, image, target) elements.
+        """
+        if self.mode in ["train", "valid"]:
+            if self.records is not None:
+                # csv row of every element from the "index" field of its record, whatever the read order
+                data = read_shards(self.records, shuffle=shuffle, seed=self.seed, shard_buffer=SHARD_BUFFER)
+                data = data.map(self.load_record, num_parallel_calls=AUTOTUNE)
+                data = data.cache(self.cache_path(shuffled_shards=shuffle))
+            else:
+                data = tf.data.Dataset.range(len(self.image_paths))
+                data = data.map(self.load_function, num_parallel_calls=AUTOTUNE)
+                data = data.cache(self.cache_path())
+
+            if shuffle:
+                data = data.shuffle(len(self.image_paths),
+                                    seed=self.seed,
+                                    reshuffle_each_iteration=True)
+
+            # Augment images and labels
+            if with_index:
+                data = data.enumerate().map(lambda position, sample: (sample[0], ) + self.map_function(position, sample),
+                                            num_parallel_calls=AUTOTUNE)
+            else:
+                data = data.enumerate().map(self.map_function,
+                                            num_parallel_calls=AUTOTUNE)
         elif self.mode == "test":
-            data = tf.data.Dataset.from_tensor_slices((self.image_paths))
+            data = tf.data.Dataset.range(len(self.image_paths))
             data = data.map(self.test_map_function,
                             num_parallel_calls=AUTOTUNE)
 
-        if shuffle:
-            # Prefetch, shuffle then batch
-            data = data.prefetch(AUTOTUNE).shuffle(
-                random.randint(0, len(self.image_paths))).batch(batch_size)
-        else:
-            # Batch and prefetch
-            data = data.batch(batch_size).prefetch(AUTOTUNE)
+        return data
+
+    def data_gen(self, batch_size, shuffle=False):
+        data = self.dataset(shuffle=shuffle)
+
+        # Batch and prefetch
+        data = data.batch(batch_size).prefetch(AUTOTUNE)
 
         return data
 
@@ -332,14 +557,55 @@ def read_image_by_tf(path, channels=1):
     return tf.cast(image, tf.float32)
 
 
-def load_infer_image(path, channels=1):
-    image = read_image_by_tf(path, channels=channels)
+def preprocess_infer_image(image, pixel_size=None):
+    """
+        Normalizes and resizes a decoded (h, w, c) image to the model input.
+        pixel_size (mm) is required by the models trained with config["mm_per_pixel"].
+    """
     image = data.normalize_data(image)
-    image = data.resize_data(image)
+    image = data.resize_data(image, pixel_size=pixel_size)
 
     return image
 
 
+def load_infer_image(path, channels=1, pixel_size=None):
+    image = read_image_by_tf(path, channels=channels)
+
+    return preprocess_infer_image(image, pixel_size=pixel_size)
+
+
+def infer_geometry(image_shape, pixel_size=None):
+    """
+        Scale and (x, y) offset of preprocess_infer_image for an image of image_shape, as numpy
+        (element-wise for vectors of heights, widths and pixel sizes, offset is then (2, n))
+    """
+    scale, offset = data.resize_geometry(image_shape, pixel_size)
+
+    return scale.numpy(), offset.numpy()
+
+
+def infer_to_image_pixels(points, image_shape, pixel_size=None):
+    """
+        Maps (..., 2) x/y points of the model input back to pixels of the original image of image_shape
+    """
+    scale, offset = infer_geometry(image_shape, pixel_size)
+
+    return (np.asarray(points) - offset) / scale
+
+
+def infer_to_image_mask(mask, image_shape, pixel_size=None):
+    """
+        Warps a (h, w) mask of the model input back onto the original image of image_shape
+    """
+    scale, offset = infer_geometry(image_shape, pixel_size)
+    # image pixel -> model input pixel, applied as the inverse map
+    matrix = np.float32([[scale, 0., offset[0]],
+                         [0., scale, offset[1]]])
+
+    return cv2.warpAffine(mask, matrix, (int(image_shape[1]), int(image_shape[0])),
+                          flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP)
+
+
 if __name__ == "__main__":
     data = DataLoader("../data/training_set",
                       augmentation=True,
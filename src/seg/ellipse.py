@@ -18,11 +18,22 @@ def ellipse_fit(points, method="Direct"):
 def ellipse_fit_mask(binary_mask, method="Direct"):
     assert binary_mask.min() >= 0.0 and binary_mask.max() <= 1.0
     points = np.argwhere(binary_mask > 0.5)  # TODO: tune threshold
-    (xx, yy), (MA, ma), angle = ellipse_fit(points)
+    (xx, yy), (MA, ma), angle = ellipse_fit(points, method=method)
 
     return (xx, yy), (MA, ma), angle
 
 
+def mask_contour(binary_mask):
+    """
+        Boundary pixels of a binary mask: fitting the ellipse on the contour instead of the filled
+        region avoids shrinking the axes (the points of a filled ellipse are not on the ellipse).
+    """
+    binary_mask = (binary_mask > 0.5).astype(np.uint8)
+    eroded = cv2.erode(binary_mask, np.ones((3, 3), np.uint8))
+
+    return (binary_mask - eroded).astype(np.float32)
+
+
 def ellipse_fit_anno(anno, method="Direct"):
     points = np.argwhere(anno > 127)
     (xx, yy), (MA, ma), angle = ellipse_fit(points)
@@ -31,7 +42,14 @@ def ellipse_fit_anno(anno, method="Direct"):
 
 
 def draw_ellipse(img, binary_mask):
-    (xx, yy), (MA, ma), angle = ellipse_fit_mask(binary_mask)
+    return draw_fitted_ellipse(img, ellipse_fit_mask(binary_mask))
+
+
+def draw_fitted_ellipse(img, ellipse):
+    """
+        Draws an ellipse as returned by ellipse_fit_mask (row / column center and axes)
+    """
+    (xx, yy), (MA, ma), angle = ellipse
     img = cv2.ellipse(img,
                       (int(yy), int(xx)),
                       (int(ma / 2), int(MA / 2)),
@@ -61,10 +79,63 @@ def rotate_point(point, center, deg):
     rad = math.radians(deg)
     rotMatrix = np.array([[math.cos(rad), math.sin(rad)],
                           [-math.sin(rad), math.cos(rad)]])
-    rotated = np.dot(rotMatrix, point).astype(np.int)
+    rotated = np.dot(rotMatrix, point).astype(int)
 
     return tuple(rotated + center)
 
 
+def keypoints_from_heatmaps(heatmaps, stride=4, epsilon=1e-7):
+    """
+        (h, w, k) heatmaps to (k, 2) x/y points in pixels of the model input.
+        The argmax of every heatmap is refined with a parabola fit of the log heatmap on each axis,
+        which is exact for the gaussian targets of seg.targets.KeypointHeatmapTarget.
+    """
+    h, w, k = heatmaps.shape
+    flat = heatmaps.reshape(-1, k).argmax(axis=0)
+    rows, cols = np.unravel_index(flat, (h, w))
+
+    # clip so that the 3 samples of the fit stay inside the heatmap
+    rows = np.clip(rows, 1, h - 2)
+    cols = np.clip(cols, 1, w - 2)
+    channels = np.arange(k)
+    log_heatmaps = np.log(np.maximum(heatmaps, epsilon))
+
+    def refine(before, center, after):
+        curvature = before - 2 * center + after
+        offset = np.where(curvature < 0, 0.5 * (before - after) / np.minimum(curvature, -epsilon), 0.)
+
+        return np.clip(offset, -1., 1.)
+
+    dx = refine(log_heatmaps[rows, cols - 1, channels],
+                log_heatmaps[rows, cols, channels],
+                log_heatmaps[rows, cols + 1, channels])
+    dy = refine(log_heatmaps[rows - 1, cols, channels],
+                log_heatmaps[rows, cols, channels],
+                log_heatmaps[rows + 1, cols, channels])
+
+    points = np.stack([cols + dx, rows + dy], axis=-1)
+
+    # heatmap cell centers to input pixels
+    return (points + 0.5) * stride - 0.5
+
+
+def ellipse_from_keypoints(points):
+    """
+        Ellipse from the center and the four axis end points of seg.split.add_ellipses_keypoints:
+        returns (center x, center y), (semi axis a, semi axis b), angle (rad) in the convention of the csv.
+        Each semi axis is the mean of its two half axes, which averages out part of the point errors.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    center = points[0]
+
+    semi_axis_a = (np.linalg.norm(points[1] - center) + np.linalg.norm(points[3] - center)) / 2
+    semi_axis_b = (np.linalg.norm(points[2] - center) + np.linalg.norm(points[4] - center)) / 2
+
+    dx, dy = points[1] - points[3]
+    angle = np.arctan2(dy, dx) % np.pi
+
+    return (center[0], center[1]), (semi_axis_a, semi_axis_b), angle
+
+
 if __name__ == "__main__":
     pass
@@ -0,0 +1,238 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+
+import tensorflow as tf
+from tensorflow.keras import Input
+from tensorflow.keras.models import Model
+from tensorflow.keras.layers import InputLayer
+from tensorflow.keras.callbacks import ModelCheckpoint
+
+from seg.utils import inbound_layers
+
+AUTOTUNE = tf.data.experimental.AUTOTUNE
+
+META = "meta.json"
+
+
+def frozen_boundary(model, freeze_at):
+    """
+        Names of the layers of model.layers[:freeze_at] whose output feeds model.layers[freeze_at:]:
+        the tensors crossing the cut, the skip connections of the encoder included, in topological order.
+    """
+    frozen = {layer.name for layer in model.layers[:freeze_at]}
+    if frozen & set(model.output_names):
+        raise ValueError("freeze_at {} freezes an output of {}".format(freeze_at, model.name))
+
+    boundary = list()
+    for layer in model.layers[freeze_at:]:
+        for inbound in inbound_layers(layer):
+            if inbound.name in frozen and inbound.name not in boundary:
+                boundary.append(inbound.name)
+
+    return boundary
+
+
+def prefix_model(model, boundary):
+    """
+        Frozen part of model, from its input to the boundary tensors
+    """
+    return Model(inputs=model.inputs,
+                 outputs=[model.get_layer(name).output for name in boundary],
+                 name="{}_prefix".format(model.name))
+
+
+def suffix_model(model, freeze_at, boundary):
+    """
+        Trainable part of model, from the boundary tensors to its output.
+        The layers are the ones of model (not clones): training the suffix trains model.
+    """
+    tensors = {name: Input(shape=model.get_layer(name).output.shape[1:], name="feature_{}".format(name))
+               for name in boundary}
+    for layer in model.layers[freeze_at:]:
+        if isinstance(layer, InputLayer):
+            continue
+
+        x = [tensors[inbound.name] for inbound in inbound_layers(layer)]
+        x = x[0] if len(x) == 1 else x
+        tensors[layer.name] = layer(x)
+
+    return Model(inputs=[tensors[name] for name in boundary],
+                 outputs=[tensors[name] for name in model.output_names],
+                 name="{}_suffix".format(model.name))
+
+
+def weights_hash(model):
+    digest = hashlib.sha256()
+    for weights in model.get_weights():
+        digest.update(np.ascontiguousarray(weights).tobytes())
+
+    return digest.hexdigest()
+
+
+def loader_key(loader):
+    """
+        Everything that changes the samples of a seg.data.DataLoader pass, as cache_path plus the augmentation
+    """
+    return {
+        "root": os.path.abspath(loader.root),
+        "mode": loader.mode,
+        "image_size": list(loader.image_size),
+        "mm_per_pixel": loader.mm_per_pixel,
+        "palette": loader.palette,
+        "channels": loader.channels,
+        "target": [type(loader.target).__name__, vars(loader.target)],
+        "csv": hashlib.md5(loader.df.to_csv(index=False).encode()).hexdigest(),
+        "augmentation": loader.augmentation,
+        "compose": loader.compose,
+        "seed": loader.seed
+    }
+
+
+class FeatureCache(object):
+    '''Activations of the frozen prefix of a fine-tuned model, computed once and memory-mapped on disk,
+    so that only the trainable suffix runs in the training steps.
+    # Usage
+        ```python
+            model = unet(freeze=True, freeze_at=16)
+            features = FeatureCache("../data/cache/features", model, 16)
+            train_path = features.build([DataLoader(..., mode="train", augmentation=False)])
+            valid_path = features.build([DataLoader(..., mode="valid", augmentation=False)])
+            features.suffix.compile(...)
+            features.suffix.fit(features.data_gen(train_path, 16, shuffle=True),
+                                validation_data=features.data_gen(valid_path, 16),
+                                callbacks=[FullModelCheckpoint(model, file_path, save_best_only=True)])
+            model.save(...)  # the suffix shares its layers with model
+        ```
+    # Arguments
+        cache_dir: Directory of the cached datasets, one sub-directory per (prefix weights, loaders).
+        model: Model whose model.layers[:freeze_at] are frozen (freeze=True of the architectures).
+        freeze_at: Number of frozen layers.
+        dtype: Storage type of the activations, "float16" halves the disk and page cache footprint.
+    # Notes
+        The cut is every tensor of the prefix used by the suffix, the skip connections of a U-Net
+        included: the early, full resolution ones dominate the size of the cache.
+        The prefix runs in inference mode: its Dropout layers are off, its BatchNormalization layers
+        use their moving statistics as they do once frozen. The cache holds fixed samples: non-augmented
+        ones, or a fixed number of augmented passes (one loader per pass, with its own seed).
+        A cached dataset is keyed by the prefix weights, so trials of a sweep on the same pretrained
+        prefix share it, and another checkpoint or freeze_at builds a new one.
+    '''
+
+    def __init__(self, cache_dir, model, freeze_at, dtype="float16"):
+        self.cache_dir = cache_dir
+        self.model = model
+        self.freeze_at = freeze_at
+        self.dtype = np.dtype(dtype)
+
+        self.boundary = frozen_boundary(model, freeze_at)
+        self.prefix = prefix_model(model, self.boundary)
+        self.suffix = suffix_model(model, freeze_at, self.boundary)
+        self.prefix_key = weights_hash(self.prefix)
+
+    def path(self, loaders):
+        key = hashlib.md5(json.dumps({
+            "prefix": self.prefix_key,
+            "boundary": self.boundary,
+            "dtype": self.dtype.name,
+            "loaders": [loader_key(loader) for loader in loaders]
+        }, sort_keys=True).encode()).hexdigest()
+
+        return os.path.join(self.cache_dir, "{}_{}".format(loaders[0].mode, key))
+
+    def build(self, loaders, batch_size=16):
+        """
+            Runs the prefix once over every pass of the loaders (seg.data.DataLoader, csv order)
+            and writes the boundary activations and the targets as .npy files.
+            Returns the directory of the cached dataset, built only once.
+        """
+        path = self.path(loaders)
+        if os.path.exists(os.path.join(path, META)):
+            return path
+
+        if os.path.exists(path):
+            # interrupted build, no meta.json
+            shutil.rmtree(path)
+        os.makedirs(path)
+
+        n_samples = sum(len(loader.image_paths) for loader in loaders)
+        forward = tf.function(lambda x: self.prefix(x, training=False))
+
+        print("="*100)
+        print("Caching the activations of {} frozen layers of {} for {} samples in {} ...".format(
+            self.freeze_at, self.model.name, n_samples, path))
+
+        arrays = None
+        start = 0
+        for loader in loaders:
+            for images, targets in loader.data_gen(batch_size, shuffle=False):
+                outputs = tf.nest.flatten(forward(images))
+                if arrays is None:
+                    arrays = [np.lib.format.open_memmap(os.path.join(path, "{}.npy".format(name)), mode="w+",
+                                                        dtype=self.dtype, shape=(n_samples, ) + tuple(x.shape[1:]))
+                              for name, x in zip(self.boundary, outputs)]
+                    arrays.append(np.lib.format.open_memmap(os.path.join(path, "target.npy"), mode="w+",
+                                                            dtype=np.float32,
+                                                            shape=(n_samples, ) + tuple(targets.shape[1:])))
+
+                end = start + len(targets)
+                for array, x in zip(arrays, outputs + [targets]):
+                    array[start:end] = x.numpy()
+                start = end
+
+        for array in arrays:
+            array.flush()
+        del arrays
+
+        with open(os.path.join(path, META), "w") as f:
+            json.dump({"size": n_samples,
+                       "boundary": self.boundary,
+                       "freeze_at": self.freeze_at,
+                       "dtype": self.dtype.name}, f, indent=4)
+
+        return path
+
+    def data_gen(self, path, batch_size, shuffle=False, seed=None):
+        """
+            Batched (features, target) dataset of a built cache, features in the order of the suffix inputs.
+            Each batch is one gather of sorted rows from the memory-mapped files.
+        """
+        arrays = [np.load(os.path.join(path, "{}.npy".format(name)), mmap_mode="r") for name in self.boundary]
+        arrays.append(np.load(os.path.join(path, "target.npy"), mmap_mode="r"))
+        n_samples = len(arrays[-1])
+
+        def gather(indices):
+            indices = np.sort(indices)
+            return [np.asarray(array[indices], dtype=np.float32) for array in arrays]
+
+        def load(indices):
+            batch = tf.numpy_function(gather, [indices], [tf.float32] * len(arrays))
+            for x, array in zip(batch, arrays):
+                x.set_shape((None, ) + array.shape[1:])
+            features = batch[0] if len(batch) == 2 else tuple(batch[:-1])
+
+            return features, batch[-1]
+
+        data = tf.data.Dataset.range(n_samples)
+        if shuffle:
+            data = data.shuffle(n_samples, seed=seed, reshuffle_each_iteration=True)
+        data = data.batch(batch_size).map(load, num_parallel_calls=AUTOTUNE)
+
+        return data.prefetch(AUTOTUNE)
+
+
+class FullModelCheckpoint(ModelCheckpoint):
+    '''ModelCheckpoint of the full model while FeatureCache.suffix is fitted.
+    # Arguments
+        full_model: Model the suffix was cut from, saved instead of the fitted suffix.
+        The other arguments are the ones of ModelCheckpoint.
+    '''
+
+    def __init__(self, full_model, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.full_model = full_model
+
+    def set_model(self, model):
+        super().set_model(self.full_model)
@@ -0,0 +1,122 @@
+import os
+import json
+import struct
+import numpy as np
+
+from seg.rle import rle_encode_rows, rle_decode_rows
+
+# the file ends with the offset of its JSON index
+FOOTER = struct.Struct("<Q")
+
+
+class MaskStore(object):
+    '''Binary masks of a run packed into a single file with per-row RLE and random access by filename.
+    # Usage
+        ```python
+            with MaskStore("./data/predicted/masks.store", mode="w") as store:
+                store.write("000_HC.png", mask)
+
+            store = MaskStore("./data/predicted/masks.store")
+            mask = store["000_HC.png"]          # uint8 {0, 1} (h, w), as seg.ellipse expects
+            for filename, mask in store.items():
+                ...
+        ```
+    # Arguments
+        path: File of the store.
+        mode: "r" to read, "w" to (over)write.
+        threshold: Binarisation threshold of the written masks.
+    # Notes
+        Layout: for every mask the uint16 runs per row followed by the uint16 (start, length) runs,
+        then a JSON index {filename: offset, number of runs, shape} and the 8 bytes offset of the index.
+        Reading maps the file once, a mask costs one slice and one vectorized decode, no file open.
+    '''
+
+    def __init__(self, path, mode="r", threshold=0.5):
+        if mode not in ["r", "w"]:
+            raise ValueError("Unknown mode: {}".format(mode))
+
+        self.path = path
+        self.mode = mode
+        self.threshold = threshold
+
+        if mode == "w":
+            self.file = open(path, "wb")
+            self.index = {}
+            self.offset = 0
+        else:
+            with open(path, "rb") as f:
+                f.seek(-FOOTER.size, os.SEEK_END)
+                index_offset, = FOOTER.unpack(f.read(FOOTER.size))
+                f.seek(index_offset)
+                self.index = json.loads(f.read()[:-FOOTER.size].decode())
+            self.data = np.memmap(path, dtype=np.uint8, mode="r", shape=(index_offset, )) \
+                if index_offset > 0 else np.zeros(0, dtype=np.uint8)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, filename):
+        return filename in self.index
+
+    def __getitem__(self, filename):
+        return self.read(filename)
+
+    def keys(self):
+        return list(self.index.keys())
+
+    def items(self):
+        for filename in self.index:
+            yield filename, self.read(filename)
+
+    def encode(self, mask):
+        """
+            Record bytes, number of runs and shape of mask ((h, w) or (h, w, 1), float in [0, 1] or bool)
+        """
+        mask = np.asarray(mask)
+        if mask.ndim == 3:
+            # squeeze() would also drop the rows or columns of a 1 pixel high / wide mask
+            mask = mask[..., 0]
+        if mask.dtype != bool:
+            mask = mask > self.threshold
+
+        runs_per_row, runs = rle_encode_rows(mask)
+
+        return runs_per_row.tobytes() + runs.tobytes(), len(runs), list(mask.shape)
+
+    def append(self, filename, record, n_runs, shape):
+        self.file.write(record)
+        self.index[filename] = {"offset": self.offset,
+                                "runs": n_runs,
+                                "shape": shape}
+        self.offset += len(record)
+
+    def write(self, filename, mask):
+        """
+            Appends mask of the image filename
+        """
+        self.append(filename, *self.encode(mask))
+
+    def read(self, filename):
+        entry = self.index[filename]
+        h, w = entry["shape"]
+        start = entry["offset"]
+        middle = start + 2 * h
+        end = middle + 4 * entry["runs"]
+
+        runs_per_row = self.data[start:middle].view(np.uint16)
+        runs = self.data[middle:end].view(np.uint16).reshape(-1, 2)
+
+        return rle_decode_rows(runs_per_row, runs, (h, w))
+
+    def close(self):
+        if self.mode == "w" and self.file is not None:
+            self.file.write(json.dumps(self.index).encode())
+            self.file.write(FOOTER.pack(self.offset))
+            self.file.close()
+            self.file = None
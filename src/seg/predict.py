@@ -1,4 +1,5 @@
 import os
+import glob
 import numpy as np
 import pandas as pd
 
@@ -8,11 +9,16 @@ from pathlib import Path
 import matplotlib.pyplot as plt
 
 import tensorflow as tf
+from tensorflow.keras import Input
+from tensorflow.keras.models import Model
+from tensorflow.keras.layers import Average
 
 from seg.config import config
-from seg.ellipse import draw_ellipse
+from seg.ellipse import draw_ellipse, draw_fitted_ellipse, ellipse_fit_mask, keypoints_from_heatmaps, ellipse_from_keypoints
 from seg.utils import load_infer_model
-from seg.data import DataLoader, read_image_by_tf, load_infer_image
+from seg.writer import MaskWriter
+from seg.cache import PredictionCache, file_hash
+from seg.data import DataLoader, read_image_by_tf, load_infer_image, infer_geometry, infer_to_image_pixels, infer_to_image_mask
 
 
 def eval(model_path):
@@ -24,44 +30,199 @@ def eval(model_path):
     print("Model trained using 799 images and validated with 200 images. Evaluates using valid set ...")
     valid_set = DataLoader("./data/training_set/",
                            mode="valid",
-                           augmentation=True,
+                           augmentation=False,
                            one_hot_encoding=True,
                            palette=config["palette"],
                            image_size=config["image_size"])
-    valid_gen = valid_set.data_gen(config["batch_size"], shuffle=True)
+    valid_gen = valid_set.data_gen(config["batch_size"])
 
     result = model.evaluate(valid_gen, verbose=0)
     print("Model'score: {} \nLoss: {}.".format(result[1], result[0]))
 
 
+class LazyModel(object):
+    '''Model loaded on its first use, so that runs answered by a PredictionCache never load the checkpoint.
+    # Usage
+        ```python
+            model = LazyModel(lambda: load_infer_model(model_path))
+            ellipse, mask = pred_ellipse(model, image_path, cache=cache)
+        ```
+    # Arguments
+        load_fn: Function returning the model, called once.
+    # Notes
+        Calls and attributes are forwarded to the loaded model.
+    '''
+
+    def __init__(self, load_fn):
+        self.load_fn = load_fn
+        self.model = None
+
+    def get(self):
+        if self.model is None:
+            self.model = self.load_fn()
+
+        return self.model
+
+    def __call__(self, *args, **kwargs):
+        return self.get()(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+
+def open_cache(cache_dir, model_path, n_snapshots=None, optimize=False):
+    """
+        PredictionCache of the checkpoint (or of the snapshot ensemble of a training directory) in model_path
+    """
+    paths = snapshot_paths(model_path, n_snapshots) if os.path.isdir(model_path) else [model_path]
+
+    return PredictionCache(cache_dir, file_hash(paths),
+                           settings={"image_size": list(config["image_size"]),
+                                     "mm_per_pixel": config["mm_per_pixel"],
+                                     "optimize": optimize})
+
+
 def pred_one_image(model, image):
     pred_image = model.predict(tf.expand_dims(image, axis=0))
 
     return pred_image.squeeze()
 
 
-def pred(model_path, save_path="./data/predcited"):
-    Path(save_path).mkdir(parents=True, exist_ok=True)
+def pred_ellipse(model, image_path, cache=None, pixel_size=None, with_mask=True):
+    """
+        Ellipse (seg.ellipse.ellipse_fit_mask, pixels of the model input) and binary mask of image_path.
+        With a seg.cache.PredictionCache, an image already predicted by the same model is not run again
+        (pass a LazyModel to not even load it).
+        pixel_size: pixel size (mm) of the image, required with config["mm_per_pixel"]
+        with_mask: without it, a cached ellipse is enough (store_masks=False), the mask is then None
+    """
+    if cache is not None:
+        with open(image_path, "rb") as f:
+            image_bytes = f.read()
+        hit = cache.get(image_bytes, pixel_size)
+        if hit is not None and (hit[1] is not None or not with_mask):
+            ellipse, mask = hit
+            return ellipse, mask.astype(np.float32) if mask is not None else None
+
+    image = load_infer_image(image_path, pixel_size=pixel_size)
+    pred_mask = (pred_one_image(model, image) > 0.5).astype(np.float32)
+    ellipse = ellipse_fit_mask(pred_mask)
+
+    if cache is not None:
+        cache.put(image_bytes, ellipse, pred_mask, pixel_size)
+
+    return ellipse, pred_mask
+
+
+def pred_ellipses(model, image_paths, cache=None, pixel_sizes=None):
+    """
+        DataFrame of the ellipses (pixels of the model input) of image_paths, for reports and submissions:
+        cached ellipses are returned as they are, only new or changed images run the model.
+    """
+    pixel_sizes = [None] * len(image_paths) if pixel_sizes is None else pixel_sizes
+
+    records = list()
+    for image_path, pixel_size in zip(image_paths, pixel_sizes):
+        (xx, yy), (MA, ma), angle = pred_ellipse(model, image_path, cache=cache,
+                                                 pixel_size=pixel_size, with_mask=False)[0]
+        records.append((os.path.basename(image_path), xx, yy, MA, ma, angle))
+
+    if cache is not None:
+        print("Prediction cache: {} hits, {} misses".format(cache.hits, cache.misses))
+
+    return pd.DataFrame(records, columns=["filename", "xx", "yy", "MA", "ma", "angle"])
 
-    # load model
-    model = load_infer_model(model_path)
 
+def pred_ellipse_keypoints(model, image_path, stride=4, pixel_size=None):
+    """
+        Ellipse of a keypoint model (seg.architect.KeypointNet) in pixels of the original image:
+        (center x, center y), (semi axis a, semi axis b), angle (rad).
+        The head circumference is ellipse_circumference_approx(a, b) times the pixel size.
+    """
+    image = load_infer_image(image_path, pixel_size=pixel_size)
+    heatmaps = pred_one_image(model, image)
+    if heatmaps.ndim == 2:
+        heatmaps = heatmaps[..., None]
+
+    points = keypoints_from_heatmaps(heatmaps, stride=stride)
+    points = infer_to_image_pixels(points, read_image_by_tf(image_path).shape, pixel_size)
+
+    return ellipse_from_keypoints(points)
+
+
+def snapshot_paths(model_dir, n_snapshots=None):
+    """
+        Cycle-end snapshots saved by SGDRScheduler in model_dir, the n_snapshots most recent ones if set.
+    """
+    paths = sorted(glob.glob(os.path.join(model_dir, "snapshot_*.hdf5")))
+    if not paths:
+        raise ValueError("No snapshot_*.hdf5 found in {}".format(model_dir))
+
+    return paths[-n_snapshots:] if n_snapshots else paths
+
+
+def load_ensemble_model(model_dir, n_snapshots=None, optimize=False):
+    """
+        Stacks the SGDR snapshots into one model that averages their masks,
+        so a single forward pass runs every snapshot on the same batch.
+    """
+    paths = snapshot_paths(model_dir, n_snapshots)
+    snapshots = list()
+    for i, path in enumerate(paths):
+        snapshot = load_infer_model(path, optimize=optimize)
+        # nested models need unique names
+        snapshot._name = "snapshot_{:02d}".format(i)
+        snapshots.append(snapshot)
+
+    input_shapes = {tuple(snapshot.input_shape[1:]) for snapshot in snapshots}
+    if len(input_shapes) > 1:
+        raise ValueError("Snapshots of {} have different input sizes {}, ensemble snapshots of one input size "
+                         "(n_snapshots)".format(model_dir, sorted(input_shapes)))
+
+    inputs = Input(snapshots[0].input_shape[1:], name="img")
+    outputs = [snapshot(inputs, training=False) for snapshot in snapshots]
+    outputs = Average()(outputs) if len(outputs) > 1 else outputs[0]
+
+    print("Ensemble of {} snapshots from {}".format(len(snapshots), model_dir))
+
+    return Model(inputs=[inputs], outputs=[outputs], name="SnapshotEnsemble")
+
+
+def pred_model(model, save_path="./data/predcited", fmt="png", batch_size=config["batch_size"]):
+    """
+        Predicts the test set in batches, the masks are encoded and written to save_path by a
+        MaskWriter thread pool (fmt: "png", "png1", "rle" or "ellipse") while the next batch runs.
+    """
     # load test data
     print("="*100)
     print("Loading testing data ...\n")
-    df = pd.read_csv("./data/test_set_pixel_size.csv")
+    test_set = DataLoader("./data/test_set/",
+                          mode="test",
+                          image_size=config["image_size"])
+    filenames = test_set.df["filename"].tolist()
 
     print("="*100)
     print("Predicting...")
-    for idx, row in df.iterrows():
-        image_path = os.path.join("./data/test_set", row["filename"])
-        image = load_infer_image(image_path)
+    with MaskWriter(save_path, fmt=fmt) as writer:
+        start = 0
+        for images in test_set.data_gen(batch_size):
+            pred_images = model(images, training=False).numpy()
+            for filename, pred_image in zip(filenames[start:], pred_images):
+                writer.write(filename, pred_image)
+            start += len(pred_images)
+
+
+def pred(model_path, save_path="./data/predcited", fmt="png"):
+    # load model
+    model = load_infer_model(model_path)
+
+    pred_model(model, save_path, fmt=fmt)
 
-        pred_image = pred_one_image(model, image)
-        pre_paths = image_path.replace(".png", "_Predicted_Mask.png")
 
-        pred_image = Image.fromarray(pred_image * 255).convert("L")
-        pred_image.save(pre_paths)
+def pred_ensemble(model_dir, n_snapshots=None, save_path="./data/predcited", fmt="png"):
+    model = load_ensemble_model(model_dir, n_snapshots)
+
+    pred_model(model, save_path, fmt=fmt)
 
 
 def plot(image):
@@ -71,7 +232,7 @@ def plot(image):
     plt.show()
 
 
-def plot_pred(model, image_path, mask_path=None):
+def plot_pred(model, image_path, mask_path=None, cache=None, pixel_size=None):
 
     image_ori = read_image_by_tf(image_path)
     # image_ori = tf.image.resize_with_pad(
@@ -87,9 +248,16 @@ def plot_pred(model, image_path, mask_path=None):
         )/255 * 64, mask.numpy()/255 * 134, mask.numpy()/255 * 244)), dtype=np.uint8)
         image_ori = cv2.addWeighted(image_ori, 1.0, mask, 1, 0)
 
-    image = load_infer_image(image_path)
-    pred_mask = pred_one_image(model, image)
-    pred_mask = cv2.resize(pred_mask, (800, 540))
+    ellipse, pred_mask = pred_ellipse(model, image_path, cache=cache, pixel_size=pixel_size, with_mask=False)
+    if pred_mask is None:
+        # ellipse only cache: the ellipse is drawn without the mask
+        (xx, yy), (MA, ma), angle = ellipse
+        scale, _ = infer_geometry(image_ori.shape, pixel_size)
+        (col, row), = infer_to_image_pixels([[yy, xx]], image_ori.shape, pixel_size)
+        plot(draw_fitted_ellipse(image_ori, ((row, col), (MA / scale, ma / scale), angle)))
+        return
+
+    pred_mask = infer_to_image_mask(pred_mask, image_ori.shape, pixel_size)
     pred_image = np.asarray(
         np.dstack((pred_mask * 234, pred_mask * 68, pred_mask * 53)), dtype=np.uint8)
 
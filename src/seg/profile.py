@@ -0,0 +1,153 @@
+import json
+import time
+import argparse
+import numpy as np
+import pandas as pd
+
+import tensorflow as tf
+from tensorflow.keras.layers import InputLayer
+
+from seg.utils import inbound_layers, load_infer_model
+from seg.benchmark import BUILDERS, measure_latency
+
+
+def activation_bytes(outputs):
+    return int(sum(np.prod(t.shape) * t.dtype.size for t in tf.nest.flatten(outputs)))
+
+
+def profile_layers(model, batch_size=1, warmup=3, runs=20):
+    """
+        Replays the functional graph of model layer by layer (topological order, as utils.rebuild_model)
+        with one tf.function per layer, and times every layer on warm passes.
+        Returns a DataFrame in execution order: layer, type, output shape, activation bytes,
+        median time (ms) and block, plus the (start, duration) in us of every layer in the last pass.
+    """
+    input_shape = model.input_shape[1:]
+    x = tf.random.uniform((batch_size, ) + tuple(input_shape))
+
+    layers = [layer for layer in model.layers if not isinstance(layer, InputLayer)]
+    calls = {layer.name: tf.function(lambda x, layer=layer: layer(x, training=False))
+             for layer in layers}
+
+    def forward(timings=None):
+        tensors = {name: x for name in model.input_names}
+        for layer in layers:
+            inputs = [tensors[inbound.name] for inbound in inbound_layers(layer)]
+            inputs = inputs[0] if len(inputs) == 1 else inputs
+
+            start = time.perf_counter()
+            outputs = calls[layer.name](inputs)
+            # CPU kernels run synchronously, the call returns once the layer is computed
+            end = time.perf_counter()
+
+            tensors[layer.name] = outputs
+            if timings is not None:
+                timings.setdefault(layer.name, []).append((start, end))
+
+        return tensors
+
+    for _ in range(warmup):
+        tensors = forward()
+
+    timings = {}
+    for _ in range(runs):
+        forward(timings)
+
+    rows = list()
+    origin = timings[layers[0].name][-1][0]
+    block = 0
+    previous_size = None
+    for layer in layers:
+        outputs = tensors[layer.name]
+        shape = tuple(tf.nest.flatten(outputs)[0].shape)
+        # a block is a run of consecutive layers at the same resolution (an encoder or decoder stage)
+        size = shape[1:3] if len(shape) == 4 else None
+        if size != previous_size:
+            block += 1
+            previous_size = size
+
+        durations = [end - start for start, end in timings[layer.name]]
+        start, end = timings[layer.name][-1]
+        rows.append({
+            "layer": layer.name,
+            "type": type(layer).__name__,
+            "output shape": shape,
+            "activation (MB)": activation_bytes(outputs) / 2. ** 20,
+            "time (ms)": 1000. * np.median(durations),
+            "block": "b{:02d} {}".format(block, "x".join(map(str, size)) if size else "-"),
+            "trace start (us)": 1e6 * (start - origin),
+            "trace duration (us)": 1e6 * (end - start)
+        })
+
+    return pd.DataFrame(rows)
+
+
+def chrome_trace(df, save_path):
+    """
+        Chrome trace (chrome://tracing, Perfetto) of the last profiled pass: layers on thread 0,
+        blocks on thread 1.
+    """
+    events = list()
+    for row in df.itertuples(index=False):
+        events.append({"name": row[0], "cat": row[1], "ph": "X", "pid": 0, "tid": 0,
+                       "ts": row[6], "dur": row[7],
+                       "args": {"output shape": str(row[2]), "activation (MB)": row[3], "block": row[5]}})
+
+    for block, group in df.groupby("block", sort=False):
+        start = group["trace start (us)"].min()
+        end = (group["trace start (us)"] + group["trace duration (us)"]).max()
+        events.append({"name": block, "cat": "block", "ph": "X", "pid": 0, "tid": 1,
+                       "ts": start, "dur": end - start})
+
+    with open(save_path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+def profile(model, batch_size=1, warmup=3, runs=20, top=20, trace_path=None):
+    """
+        Prints the layers, layer types and blocks sorted by median CPU time, with their activation memory.
+        Returns the per layer DataFrame.
+    """
+    df = profile_layers(model, batch_size=batch_size, warmup=warmup, runs=runs)
+    total = df["time (ms)"].sum()
+    df["share (%)"] = 100. * df["time (ms)"] / total
+
+    columns = ["layer", "type", "block", "output shape", "activation (MB)", "time (ms)", "share (%)"]
+    aggregations = {"time (ms)": "sum", "share (%)": "sum", "activation (MB)": "sum", "layer": "count"}
+
+    print("="*100)
+    print("{}: {:.2f} ms per image as a whole graph, {:.2f} ms summed over layers".format(
+        model.name, measure_latency(model, batch_size=batch_size), total / batch_size))
+    print("="*100)
+    print(df.sort_values("time (ms)", ascending=False)[columns].head(top).to_string(index=False))
+    for key in ["type", "block"]:
+        print("="*100)
+        print(df.groupby(key).agg(aggregations).rename(columns={"layer": "layers"})
+              .sort_values("time (ms)", ascending=False).to_string())
+
+    if trace_path:
+        chrome_trace(df, trace_path)
+        print("Chrome trace written to {}".format(trace_path))
+
+    return df
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('model', type=str,
+                        help="name of a seg.benchmark builder ({}) or an hdf5 checkpoint".format(", ".join(BUILDERS)))
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--top', type=int, default=20)
+    parser.add_argument('--trace_path', type=str, default=None)
+    parser.add_argument('--save_path', type=str, default=None,
+                        help="csv of the per layer profile")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    model = BUILDERS[args.model]() if args.model in BUILDERS else load_infer_model(args.model)
+    df = profile(model, batch_size=args.batch_size, runs=args.runs, top=args.top, trace_path=args.trace_path)
+    if args.save_path:
+        df.to_csv(args.save_path, index=False)
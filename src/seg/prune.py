@@ -0,0 +1,266 @@
+import os
+import argparse
+import numpy as np
+import pandas as pd
+
+import tensorflow as tf
+from tensorflow.keras.layers import InputLayer, Conv2D, Conv2DTranspose, BatchNormalization, Activation, Dropout, MaxPooling2D, ZeroPadding2D, Concatenate, Add
+
+from seg import seglosses
+from seg.config import config
+from seg.data import DataLoader
+from seg.utils import load_pretrain_model, inbound_layers, clone_layer, rebuild_model, time_to_timestr
+from seg.benchmark import count_flops
+from seg.train import steps_per_epoch, build_lr_schedule, build_optimizer, build_loss, build_callbacks, save_history
+
+# layers that keep the channels of their (single) input
+PASS_THROUGH = (Activation, Dropout, MaxPooling2D, ZeroPadding2D)
+
+
+def producing_conv(layer):
+    """
+        Walks back through BN / activations / dropout to the conv that produced the channels of layer
+    """
+    while not isinstance(layer, Conv2D) or isinstance(layer, Conv2DTranspose):
+        if not isinstance(layer, PASS_THROUGH + (BatchNormalization, )):
+            return None
+        layer = inbound_layers(layer)[0]
+
+    return layer
+
+
+def outbound_layers(model, layer):
+    return [l for l in model.layers
+            if not isinstance(l, InputLayer) and layer in inbound_layers(l)]
+
+
+def filter_scores(model, conv, criterion="bn_gamma"):
+    """
+        Importance of each output filter of conv: |gamma| of the following BatchNormalization,
+        or the L1 norm of the filter weights (also the fallback when the conv is not followed by BN).
+    """
+    consumers = outbound_layers(model, conv)
+    if criterion == "bn_gamma" and len(consumers) == 1 and isinstance(consumers[0], BatchNormalization):
+        gamma = consumers[0].get_weights()[0]
+        return np.abs(gamma)
+
+    kernel = conv.get_weights()[0]
+
+    return np.abs(kernel).sum(axis=(0, 1, 2))
+
+
+def prunable_groups(model):
+    """
+        Groups of convs whose output channels must be pruned with the same indices.
+        Convs summed by an Add (the dilated bottleneck) share one group, every other conv is its own group.
+        The output conv and the transposed convs are never pruned.
+    """
+    output_layers = [model.get_layer(name) for name in model.output_names]
+    convs = [layer for layer in model.layers
+             if isinstance(layer, Conv2D) and not isinstance(layer, Conv2DTranspose)
+             and layer not in output_layers]
+
+    group_of = {conv.name: [conv] for conv in convs}
+    for layer in model.layers:
+        if isinstance(layer, Add):
+            members = [producing_conv(inbound) for inbound in inbound_layers(layer)]
+            if any(member is None or member.name not in group_of for member in members):
+                # an input does not come from a prunable conv, keep the whole sum intact
+                for member in members:
+                    if member is not None:
+                        group_of.pop(member.name, None)
+                continue
+
+            group = list()
+            for member in members:
+                for conv in group_of[member.name]:
+                    if conv not in group:
+                        group.append(conv)
+            for conv in group:
+                group_of[conv.name] = group
+
+    groups = list()
+    for group in group_of.values():
+        if group not in groups:
+            groups.append(group)
+
+    return groups
+
+
+def select_filters(model, ratio=0.5, criterion="bn_gamma", divisor=8):
+    """
+        Returns {conv name: sorted indices of the filters to keep}.
+        Every group keeps (1 - ratio) of its filters rounded to a multiple of divisor.
+    """
+    keep = {}
+    for group in prunable_groups(model):
+        scores = [filter_scores(model, conv, criterion) for conv in group]
+        # normalise per conv so that every member of a group weighs the same
+        score = np.sum([s / (s.mean() + 1e-12) for s in scores], axis=0)
+
+        n_filters = len(score)
+        n_keep = int(round(n_filters * (1. - ratio) / divisor)) * divisor
+        n_keep = min(n_filters, max(divisor, n_keep))
+
+        indices = np.sort(np.argsort(-score)[:n_keep])
+        for conv in group:
+            keep[conv.name] = indices
+
+    return keep
+
+
+def prune_model(model, ratio=0.5, criterion="bn_gamma"):
+    """
+        Physically removes the lowest ranked filters of every conv2d_block / convolution_block / dilated_block conv.
+        Channel indices are propagated through BN, pooling, padding, the skip concatenations and the inputs of
+        the Conv2DTranspose layers, so the result is a smaller dense model with the surviving weights.
+    """
+    keep = select_filters(model, ratio=ratio, criterion=criterion)
+
+    def clone_fn(layer):
+        if layer.name in keep:
+            return clone_layer(layer, filters=len(keep[layer.name]))
+
+        return clone_layer(layer)
+
+    pruned = rebuild_model(model, clone_fn)
+
+    # kept output channels of every layer, in terms of the original channels
+    channels = {}
+    for layer in model.layers:
+        if isinstance(layer, InputLayer):
+            channels[layer.name] = np.arange(layer.output_shape[0][-1])
+            continue
+
+        inbound = inbound_layers(layer)
+        in_channels = channels[inbound[0].name]
+        weights = layer.get_weights()
+        new_layer = pruned.get_layer(layer.name)
+
+        if isinstance(layer, Conv2DTranspose):
+            # kernel: (h, w, out, in)
+            out_channels = np.arange(layer.filters)
+            weights[0] = weights[0][:, :, :, in_channels]
+        elif isinstance(layer, Conv2D):
+            # kernel: (h, w, in, out)
+            out_channels = keep.get(layer.name, np.arange(layer.filters))
+            weights[0] = weights[0][:, :, in_channels][..., out_channels]
+            if layer.use_bias:
+                weights[1] = weights[1][out_channels]
+        elif isinstance(layer, BatchNormalization):
+            out_channels = in_channels
+            weights = [w[in_channels] for w in weights]
+        elif isinstance(layer, Concatenate):
+            offset = 0
+            out_channels = list()
+            for layer_in in inbound:
+                out_channels.append(channels[layer_in.name] + offset)
+                offset += layer_in.output_shape[-1]
+            out_channels = np.concatenate(out_channels)
+        elif isinstance(layer, Add):
+            for layer_in in inbound[1:]:
+                if not np.array_equal(channels[layer_in.name], in_channels):
+                    raise ValueError("Inputs of {} were pruned differently".format(layer.name))
+            out_channels = in_channels
+        elif isinstance(layer, PASS_THROUGH):
+            out_channels = in_channels
+        else:
+            raise ValueError("Layer {} ({}) is not supported by the pruner, only unet / dilate_unet are.".format(
+                layer.name, layer.__class__.__name__))
+
+        channels[layer.name] = out_channels
+        if weights:
+            new_layer.set_weights(weights)
+
+    return pruned
+
+
+def fine_tune(model, epochs=10, learning_rate=None):
+    """
+        Briefly re-trains the pruned model with the seg.train setup (optimizer, loss, SGDR, checkpoints).
+    """
+    learning_rate = learning_rate or config["learning_rate"] * 0.1
+
+    train_set = DataLoader("../data/training_set/",
+                           mode="train",
+                           augmentation=True,
+                           compose=False,
+                           one_hot_encoding=True,
+                           palette=config["palette"],
+                           image_size=config["image_size"],
+                           cache_dir=config["data_cache_dir"])
+    train_gen = train_set.data_gen(config["batch_size"], shuffle=True)
+
+    valid_set = DataLoader("../data/training_set/",
+                           mode="valid",
+                           augmentation=False,
+                           compose=False,
+                           one_hot_encoding=True,
+                           palette=config["palette"],
+                           image_size=config["image_size"],
+                           cache_dir=config["data_cache_dir"])
+    valid_gen = valid_set.data_gen(config["batch_size"])
+
+    lr_schedule = build_lr_schedule(steps_per_epoch(train_gen), learning_rate)
+    optimizer = build_optimizer(config["optimizer"], lr_schedule.schedule)
+    model.compile(optimizer=optimizer,
+                  loss=[build_loss(config["loss"])],
+                  metrics=[seglosses.jaccard_index, seglosses.dice_coeff, seglosses.bce_loss])
+
+    timestr = time_to_timestr()
+    callbacks_list = build_callbacks(model, optimizer, timestr, lr_schedule)
+
+    print("="*100)
+    print("FINE-TUNING ...\n")
+    history = model.fit(train_gen,
+                        epochs=epochs,
+                        callbacks=callbacks_list,
+                        validation_data=valid_gen)
+
+    save_history(history, lr_schedule, timestr)
+
+    return model
+
+
+def prune(checkpoint_path, ratio=0.5, criterion="bn_gamma", epochs=10, output_path=None):
+    model = load_pretrain_model(checkpoint_path)
+    pruned = prune_model(model, ratio=ratio, criterion=criterion)
+    pruned._name = "{}Pruned".format(model.name)
+
+    print("="*100)
+    print(pd.DataFrame({
+        "params (M)": [model.count_params() / 1e6, pruned.count_params() / 1e6],
+        "GFLOPs": [count_flops(model) / 1e9, count_flops(pruned) / 1e9]
+    }, index=["original", "pruned"]).to_string())
+
+    if epochs > 0:
+        pruned = fine_tune(pruned, epochs=epochs)
+
+    output_path = output_path or checkpoint_path.replace(
+        ".hdf5", "_pruned{}.hdf5".format(int(ratio * 100)))
+    pruned.save(output_path)
+    print("Pruned model saved to {}".format(output_path))
+
+    return pruned
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('checkpoint_path', type=str)
+    parser.add_argument('--ratio', type=float, default=0.5,
+                        help="fraction of filters removed from every conv")
+    parser.add_argument('--criterion', type=str, default='bn_gamma',
+                        help="'bn_gamma' or 'l1'")
+    parser.add_argument('--epochs', type=int, default=10,
+                        help="fine-tuning epochs, 0 to skip")
+    parser.add_argument('--output_path', type=str, default=None)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    prune(args.checkpoint_path,
+          ratio=args.ratio,
+          criterion=args.criterion,
+          epochs=args.epochs,
+          output_path=args.output_path)
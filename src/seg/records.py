@@ -0,0 +1,142 @@
+import os
+import json
+import hashlib
+import argparse
+import numpy as np
+import pandas as pd
+
+import tensorflow as tf
+
+AUTOTUNE = tf.data.experimental.AUTOTUNE
+
+MANIFEST = "manifest.json"
+
+
+def csv_hash(df):
+    return hashlib.md5(df.to_csv(index=False).encode()).hexdigest()
+
+
+def records_path(records_dir, mode, df):
+    """
+        Shard directory of the csv df of mode: shards written for another csv are never read
+    """
+    return os.path.join(records_dir, "{}_{}".format(mode, csv_hash(df)[:12]))
+
+
+def bytes_feature(value):
+    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+
+
+def write_shards(df, root, records_dir, mode="train", n_shards=8, compression="GZIP", masks=True):
+    """
+        Packs the images of df (filename column, relative to root), their masks (*_Annotation.png)
+        and every numeric column into n_shards TFRecord files of contiguous rows.
+        The png bytes are stored as is, decoding stays in the DataLoader.
+        compression: "GZIP", "ZLIB" or None. Returns the shard directory.
+    """
+    path = records_path(records_dir, mode, df)
+    os.makedirs(path, exist_ok=True)
+    columns = df.select_dtypes("number").columns.tolist()
+    options = tf.io.TFRecordOptions(compression_type=compression or "")
+
+    shards = list()
+    for k, rows in enumerate(np.array_split(np.arange(len(df)), n_shards)):
+        name = "shard-{:05d}-of-{:05d}.tfrecord".format(k, n_shards)
+        with tf.io.TFRecordWriter(os.path.join(path, name), options) as writer:
+            for i in rows:
+                filename = df["filename"].iloc[i]
+                image_path = os.path.join(root, filename)
+                with open(image_path, "rb") as f:
+                    image = f.read()
+                mask = b""
+                if masks:
+                    with open(image_path.replace(".png", "_Annotation.png"), "rb") as f:
+                        mask = f.read()
+
+                example = tf.train.Example(features=tf.train.Features(feature={
+                    "index": tf.train.Feature(int64_list=tf.train.Int64List(value=[i])),
+                    "filename": bytes_feature(filename.encode()),
+                    "image": bytes_feature(image),
+                    "mask": bytes_feature(mask),
+                    "values": tf.train.Feature(float_list=tf.train.FloatList(
+                        value=df[columns].iloc[i].values.astype(np.float32)))
+                }))
+                writer.write(example.SerializeToString())
+        shards.append(name)
+
+    with open(os.path.join(path, MANIFEST), "w") as f:
+        json.dump({"shards": shards,
+                   "size": len(df),
+                   "columns": columns,
+                   "compression": compression,
+                   "csv": csv_hash(df)}, f, indent=4)
+
+    print("{} images of {} written to {} shards in {}".format(len(df), mode, n_shards, path))
+
+    return path
+
+
+def load_manifest(path):
+    with open(os.path.join(path, MANIFEST)) as f:
+        return json.load(f)
+
+
+def read_shards(path, shuffle=False, seed=None, shard_buffer=0, cycle_length=8):
+    """
+        Parsed examples ({"index", "filename", "image", "mask", "values"}) of the shards in path.
+        Without shuffle, the shards are read one after the other, in csv order (contiguous rows per shard).
+        shuffle: new seeded shard order every iteration, read by cycle_length parallel, interleaved
+        sequential streams, and a shard_buffer shuffle inside every shard.
+    """
+    manifest = load_manifest(path)
+    files = tf.data.Dataset.from_tensor_slices([os.path.join(path, name) for name in manifest["shards"]])
+    if shuffle:
+        files = files.shuffle(len(manifest["shards"]), seed=seed, reshuffle_each_iteration=True)
+
+    def read(file):
+        records = tf.data.TFRecordDataset(file,
+                                          compression_type=manifest["compression"] or "",
+                                          buffer_size=8 * 2 ** 20)
+        if shuffle and shard_buffer > 1:
+            records = records.shuffle(shard_buffer, seed=seed, reshuffle_each_iteration=True)
+
+        return records
+
+    features = {
+        "index": tf.io.FixedLenFeature([], tf.int64),
+        "filename": tf.io.FixedLenFeature([], tf.string),
+        "image": tf.io.FixedLenFeature([], tf.string),
+        "mask": tf.io.FixedLenFeature([], tf.string),
+        "values": tf.io.FixedLenFeature([len(manifest["columns"])], tf.float32)
+    }
+
+    if shuffle:
+        data = files.interleave(read,
+                                cycle_length=min(cycle_length, len(manifest["shards"])),
+                                num_parallel_calls=AUTOTUNE)
+    else:
+        data = files.flat_map(read).prefetch(AUTOTUNE)
+
+    data = data.map(lambda record: tf.io.parse_single_example(record, features),
+                    num_parallel_calls=AUTOTUNE)
+
+    # unknown after the file level flat_map / interleave, steps_per_epoch needs it
+    return data.apply(tf.data.experimental.assert_cardinality(manifest["size"]))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--root', type=str, default="./data/training_set")
+    parser.add_argument('--records_dir', type=str, default="./data/records")
+    parser.add_argument('--n_shards', type=int, default=8)
+    parser.add_argument('--compression', type=str, default="GZIP",
+                        help="'GZIP', 'ZLIB' or 'none'")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    compression = None if args.compression.lower() == "none" else args.compression
+    for mode in ["train", "valid"]:
+        write_shards(pd.read_csv("./data/{}.csv".format(mode)), args.root, args.records_dir,
+                     mode=mode, n_shards=args.n_shards, compression=compression)
@@ -0,0 +1,70 @@
+import numpy as np
+
+
+def rle_encode(mask):
+    """
+        Run-length encoding of a binary mask in row-major order: alternating run lengths of 0 and 1,
+        starting with 0 (a leading 0 when the first pixel is set).
+    """
+    flat = np.asarray(mask, dtype=bool).ravel()
+    if flat.size == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    boundaries = np.concatenate([[0], changes, [flat.size]])
+    counts = np.diff(boundaries)
+
+    if flat[0]:
+        counts = np.concatenate([[0], counts])
+
+    return counts
+
+
+def rle_decode(counts, shape):
+    """
+        Inverse of rle_encode, returns a uint8 {0, 1} mask of shape
+    """
+    counts = np.asarray(counts, dtype=np.int64)
+    values = (np.arange(len(counts)) % 2).astype(np.uint8)
+
+    return np.repeat(values, counts).reshape(shape)
+
+
+def rle_encode_rows(mask):
+    """
+        Per-row run-length encoding of a binary (h, w) mask.
+        Returns the number of runs of every row (h, ) and the (start, length) of every run (n, 2),
+        rows in order, both uint16.
+    """
+    mask = np.asarray(mask, dtype=bool)
+    h, w = mask.shape
+
+    padded = np.zeros((h, w + 2), dtype=np.int8)
+    padded[:, 1:-1] = mask
+    transitions = np.diff(padded, axis=1)
+
+    # np.nonzero is row-major, runs come out grouped by row and sorted by column
+    rows, starts = np.nonzero(transitions == 1)
+    _, ends = np.nonzero(transitions == -1)
+
+    runs_per_row = np.bincount(rows, minlength=h).astype(np.uint16)
+    runs = np.stack([starts, ends - starts], axis=1).astype(np.uint16)
+
+    return runs_per_row, runs
+
+
+def rle_decode_rows(runs_per_row, runs, shape):
+    """
+        Inverse of rle_encode_rows, returns a uint8 {0, 1} mask of shape
+    """
+    h, w = shape
+    rows = np.repeat(np.arange(h), np.asarray(runs_per_row, dtype=np.int64))
+    starts = runs[:, 0].astype(np.int64)
+    ends = starts + runs[:, 1]
+
+    # +1 at every run start, -1 after every run end, the cumulative sum fills the runs
+    steps = np.zeros((h, w + 1), dtype=np.int8)
+    steps[rows, starts] = 1
+    steps[rows, ends] = -1
+
+    return np.cumsum(steps, axis=1, dtype=np.int8)[:, :w].astype(np.uint8)
@@ -96,6 +96,53 @@ def focal_dice_loss(gamma=2., loss_weight=(1., 1.)):
     return f_d_loss
 
 
+def gt_only(metric):
+    """
+        Evaluates metric on the ground truth channel only, y_true packs [ground truth, teacher mask]
+    """
+    def wrapper(y_true, y_pred, reduction="mean"):
+        return metric(y_true[..., :1], y_pred, reduction=reduction)
+
+    wrapper.__name__ = metric.__name__
+
+    return wrapper
+
+
+def soften(p, temperature=1., epsilon=1e-7):
+    """
+        sigmoid(logit(p) / T)
+    """
+    p = K.clip(p, epsilon, 1. - epsilon)
+
+    return K.sigmoid(K.log(p / (1. - p)) / temperature)
+
+
+def distillation_loss(base_loss, alpha=0.5, temperature=1., soft_loss="mse", epsilon=1e-7):
+    """
+        y_true: [ground truth, teacher mask] packed on the channel axis
+        L = (1 - alpha) * base_loss(ground truth, student) + alpha * T^2 * soft(teacher, student)
+    """
+    def d_loss(y_true, y_pred, reduction="mean"):
+        y_gt = y_true[..., :1]
+        y_teacher = soften(y_true[..., 1:], temperature, epsilon)
+        y_student = soften(y_pred, temperature, epsilon)
+
+        if soft_loss == "kl":
+            # binary KL(teacher || student) per pixel
+            soft = y_teacher * K.log(y_teacher / y_student) + \
+                (1. - y_teacher) * K.log((1. - y_teacher) / (1. - y_student))
+        else:
+            soft = K.square(y_teacher - y_student)
+        soft = K.mean(K.batch_flatten(soft), axis=1)
+
+        loss = (1. - alpha) * base_loss(y_gt, y_pred, reduction=reduction) + \
+            alpha * temperature ** 2 * apply_reduction(soft, reduction=reduction)
+
+        return loss
+
+    return d_loss
+
+
 # %%
 if __name__ == "__main__":
     y_true = K.variable(np.array([[[[1], [1], [1], [0], [0]],
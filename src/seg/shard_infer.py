@@ -0,0 +1,190 @@
+import os
+import time
+import argparse
+import numpy as np
+import pandas as pd
+import multiprocessing
+
+from seg.writer import MaskWriter, FORMATS
+
+# model of a worker process, loaded once by init_worker
+worker = {}
+
+
+def init_worker(model_path, threads, optimize, barrier):
+    """
+        Pins the TensorFlow thread pools of the worker before any op runs, then loads the model once
+    """
+    worker["barrier"] = barrier
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+    from seg.utils import load_infer_model
+    model = load_infer_model(model_path, optimize=optimize)
+    worker["forward"] = tf.function(lambda x: model(x, training=False))
+    worker["model"] = model
+
+    # traces the forward pass, so that the first chunk is not slower than the others
+    worker["forward"](tf.zeros((1, ) + tuple(model.input_shape[1:])))
+
+
+def ready(_):
+    # every worker blocks on one of these tasks, so all of them have loaded their model
+    worker["barrier"].wait()
+
+    return os.getpid()
+
+
+def predict_chunk(chunk):
+    """
+        chunk: (image path, pixel size) pairs, returns their masks as uint8 (probability * 255)
+    """
+    import tensorflow as tf
+    from seg.data import load_infer_image
+
+    images = tf.stack([load_infer_image(path, pixel_size=pixel_size) for path, pixel_size in chunk])
+    masks = worker["forward"](images).numpy()
+
+    return np.clip(np.round(masks * 255), 0, 255).astype(np.uint8).squeeze(-1)
+
+
+def chunks(items, batch_size):
+    return [items[i:i + batch_size] for i in range(0, len(items), batch_size)]
+
+
+class ShardPool(object):
+    '''Pool of inference worker processes, each with its own copy of the model and its own thread pools.
+    # Usage
+        ```python
+            with ShardPool("../models/model.hdf5", processes=8, threads=8) as pool:
+                for filename, mask in pool.predict(filenames, pixel_sizes, "./data/test_set"):
+                    ...
+        ```
+    # Arguments
+        model_path: Checkpoint loaded by every worker (seg.utils.load_infer_model).
+        processes: Number of worker processes.
+        threads: intra-op threads of every worker, processes * threads should match the cores.
+        batch_size: Images per task sent to a worker.
+        optimize: Folds BatchNormalization in the workers, see seg.utils.optimize_for_inference.
+    # Notes
+        Workers are spawned (not forked) so that each starts a fresh TensorFlow runtime.
+        Results come back in input order (imap), while up to processes tasks run ahead.
+    '''
+
+    def __init__(self, model_path, processes=1, threads=1, batch_size=4, optimize=False):
+        self.processes = processes
+        self.threads = threads
+        self.batch_size = batch_size
+
+        context = multiprocessing.get_context("spawn")
+        self.pool = context.Pool(processes,
+                                 initializer=init_worker,
+                                 initargs=(model_path, threads, optimize, context.Barrier(processes)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def wait_ready(self):
+        """
+            Blocks until the workers have loaded their model
+        """
+        self.pool.map(ready, range(self.processes), chunksize=1)
+
+    def predict(self, filenames, pixel_sizes, image_dir):
+        """
+            (filename, mask in [0, 1]) of every image, in input order
+        """
+        items = [(os.path.join(image_dir, filename), float(pixel_size))
+                 for filename, pixel_size in zip(filenames, pixel_sizes)]
+        names = chunks(list(filenames), self.batch_size)
+
+        for chunk_names, masks in zip(names, self.pool.imap(predict_chunk, chunks(items, self.batch_size))):
+            for filename, mask in zip(chunk_names, masks):
+                yield filename, mask / 255.
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+def shard_predict(model_path, manifest="./data/test_set_pixel_size.csv", image_dir="./data/test_set", save_path="./data/predcited", fmt="png", processes=1, threads=1, batch_size=4, optimize=False):
+    """
+        Predicts every image of the manifest (csv or DataFrame of filename, pixel size(mm)) on a ShardPool and writes
+        the masks in input order with a MaskWriter (a single writer thread keeps the jsonl in order).
+        Returns the throughput in images / s, model loading excluded.
+    """
+    df = manifest if isinstance(manifest, pd.DataFrame) else pd.read_csv(manifest)
+
+    print("="*100)
+    print("Predicting {} images on {} processes x {} threads ...".format(len(df), processes, threads))
+    with ShardPool(model_path, processes, threads, batch_size, optimize) as pool:
+        pool.wait_ready()
+        start = time.perf_counter()
+        writer = MaskWriter(save_path, fmt=fmt, workers=1) if save_path else None
+        for filename, mask in pool.predict(df["filename"], df["pixel size(mm)"], image_dir):
+            if writer is not None:
+                writer.write(filename, mask)
+        if writer is not None:
+            writer.close()
+        throughput = len(df) / (time.perf_counter() - start)
+
+    print("{:.1f} images / s".format(throughput))
+
+    return throughput
+
+
+def autotune(model_path, manifest="./data/test_set_pixel_size.csv", image_dir="./data/test_set", cores=None, n_images=64, batch_size=4):
+    """
+        Measures the throughput of every processes x threads split of the cores on the first n_images
+        of the manifest, nothing written. Returns the best (processes, threads) and the results.
+    """
+    cores = cores or os.cpu_count()
+    df = pd.read_csv(manifest).head(n_images)
+
+    results = list()
+    processes = 1
+    while processes <= cores:
+        threads = cores // processes
+        throughput = shard_predict(model_path, df, image_dir, save_path=None,
+                                   processes=processes, threads=threads, batch_size=batch_size)
+        results.append({"processes": processes, "threads": threads, "images / s": throughput})
+        processes *= 2
+
+    results = pd.DataFrame(results).sort_values("images / s", ascending=False)
+    print("="*100)
+    print(results.to_string(index=False))
+    best = results.iloc[0]
+
+    return (int(best["processes"]), int(best["threads"])), results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('model_path', type=str)
+    parser.add_argument('--manifest', type=str, default="./data/test_set_pixel_size.csv")
+    parser.add_argument('--image_dir', type=str, default="./data/test_set")
+    parser.add_argument('--save_path', type=str, default="./data/predcited")
+    parser.add_argument('--fmt', type=str, default="png", help=", ".join(FORMATS))
+    parser.add_argument('--processes', type=int, default=None,
+                        help="autotuned over processes x threads = cores if not set")
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--optimize', action='store_true')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    processes, threads = args.processes, args.threads
+    if processes is None:
+        (processes, threads), _ = autotune(args.model_path, args.manifest, args.image_dir,
+                                           batch_size=args.batch_size)
+    threads = threads or max(1, os.cpu_count() // processes)
+
+    shard_predict(args.model_path, args.manifest, args.image_dir, args.save_path, args.fmt,
+                  processes=processes, threads=threads, batch_size=args.batch_size,
+                  optimize=args.optimize)
@@ -1,10 +1,11 @@
 import os
 import numpy as np
 import pandas as pd
+from PIL import Image
 
 from sklearn.model_selection import train_test_split
 
-from seg.ellipse_fitting import ellipse_fit_anno, ellipse_circumference_approx, rotate_point
+from seg.ellipse import ellipse_fit_anno, ellipse_circumference_approx, rotate_point
 
 
 def read_image(path):
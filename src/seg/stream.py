@@ -0,0 +1,288 @@
+import os
+import glob
+import time
+import queue
+import threading
+import numpy as np
+import pandas as pd
+
+import cv2
+import tensorflow as tf
+
+from seg.ellipse import ellipse_fit_mask, mask_contour, ellipse_circumference_approx
+from seg.data import preprocess_infer_image, infer_geometry
+
+IMAGE_EXTENSIONS = ["*.png", "*.jpg", "*.jpeg", "*.bmp"]
+
+
+def read_frames(source):
+    """
+        Gray uint8 (h, w) frames of a video file, a directory of images or a glob pattern of images,
+        the images in sorted order.
+    """
+    if os.path.isdir(source) or "*" in source:
+        if os.path.isdir(source):
+            paths = [path for ext in IMAGE_EXTENSIONS for path in glob.glob(os.path.join(source, ext))]
+        else:
+            paths = glob.glob(source)
+        for path in sorted(paths):
+            yield cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+        return
+
+    capture = cv2.VideoCapture(source)
+    if not capture.isOpened():
+        raise ValueError("Cannot open video: {}".format(source))
+    try:
+        while True:
+            ok, frame = capture.read()
+            if not ok:
+                break
+            if frame.ndim == 3:
+                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            yield frame
+    finally:
+        capture.release()
+
+
+def prefetch(frames, size=8):
+    """
+        Reads frames on a background thread through a queue bounded to size frames, so that
+        decoding overlaps with inference without buffering the whole loop.
+    """
+    frames_queue = queue.Queue(maxsize=size)
+    end = object()
+    errors = []
+
+    def produce():
+        try:
+            for frame in frames:
+                frames_queue.put(frame)
+        except Exception as e:
+            errors.append(e)
+        frames_queue.put(end)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+
+    while True:
+        frame = frames_queue.get()
+        if frame is end:
+            break
+        yield frame
+
+    thread.join()
+    if errors:
+        raise errors[0]
+
+
+def thumbnail(frame, size=(64, 48)):
+    return cv2.resize(frame, size, interpolation=cv2.INTER_AREA).astype(np.float32)
+
+
+class StreamPredictor(object):
+    '''Segments the frames of a cine-loop one by one, reusing the previous frame where it can.
+    # Usage
+        ```python
+            predictor = StreamPredictor(load_infer_model(model_path), pixel_size=0.12)
+            for result in predictor.run("./data/sweep.avi"):
+                print(result["frame"], result["hc_smooth"])
+            print(predictor.best)
+        ```
+    # Arguments
+        model: Segmentation model, input of config["image_size"].
+        pixel_size: Pixel size (mm) of the frames, the head circumference is in pixels if None.
+        skip_threshold: Mean absolute difference (gray levels) of 64x48 thumbnails under which
+                        a frame repeats the result of the last segmented frame.
+        max_skip: Number of consecutive skipped frames after which a frame is segmented anyway.
+        roi_margin: Margin around the previous ellipse, relative to its major semi axis, of the crop
+                    segmented in the next frame.
+        smoothing: Weight of the new measure in the exponential moving average of the head circumference.
+        threshold: Binarisation threshold of the mask.
+        prefetch_size: Number of frames decoded ahead of the model.
+    # Notes
+        The crop keeps the aspect ratio of the model input, so the head is segmented at a higher
+        resolution than in the full frame. The prior is dropped (full frame in the next frame) when
+        the mask is empty or the fitted ellipse leaves the crop.
+        Every result has the ellipse in frame pixels (center x, center y, semi axes a, b, angle in rad
+        as in seg.submission) and a score, mean mask confidence times the IoU of the mask and its ellipse;
+        `best` is the result with the highest score, the best plane of the sweep.
+    '''
+
+    def __init__(self, model, pixel_size=None, skip_threshold=1.0, max_skip=5, roi_margin=0.3, smoothing=0.3, threshold=0.5, prefetch_size=8):
+        self.model = model
+        self.pixel_size = pixel_size
+        self.skip_threshold = skip_threshold
+        self.max_skip = max_skip
+        self.roi_margin = roi_margin
+        self.smoothing = smoothing
+        self.threshold = threshold
+        self.prefetch_size = prefetch_size
+
+        self.input_size = model.input_shape[1:3]
+        self.forward = tf.function(lambda x: model(x, training=False))
+        self.reset()
+
+    def reset(self):
+        self.last_thumbnail = None
+        self.last_result = None
+        self.roi = None
+        self.skipped = 0
+        self.hc_smooth = None
+        self.best = None
+
+    def crop_box(self, frame_shape):
+        """
+            (x0, y0, x1, y1) crop around the previous ellipse, the whole frame without prior
+        """
+        height, width = frame_shape[:2]
+        if self.roi is None:
+            return 0, 0, width, height
+
+        (center_x, center_y), radius = self.roi
+        half_width = radius * (1. + self.roi_margin)
+        half_height = half_width
+        # aspect ratio of the model input
+        aspect = self.input_size[1] / self.input_size[0]
+        if half_width / half_height < aspect:
+            half_width = half_height * aspect
+        else:
+            half_height = half_width / aspect
+
+        x0 = int(max(0, np.floor(center_x - half_width)))
+        y0 = int(max(0, np.floor(center_y - half_height)))
+        x1 = int(min(width, np.ceil(center_x + half_width)))
+        y1 = int(min(height, np.ceil(center_y + half_height)))
+
+        return x0, y0, x1, y1
+
+    def segment(self, frame):
+        """
+            Probability mask of the model input and the crop box it covers
+        """
+        x0, y0, x1, y1 = self.crop_box(frame.shape)
+        crop = frame[y0:y1, x0:x1]
+
+        image = tf.convert_to_tensor(crop[..., None], tf.float32)
+        image = preprocess_infer_image(image, pixel_size=self.pixel_size)
+        mask = self.forward(image[None]).numpy().squeeze()
+
+        return mask, (x0, y0, x1, y1)
+
+    def measure(self, mask, box):
+        """
+            Ellipse in frame pixels, head circumference and score of a probability mask
+        """
+        binary_mask = (mask > self.threshold).astype(np.float32)
+        if binary_mask.sum() < 5:
+            return None
+
+        (xx, yy), (MA, ma), angle = ellipse_fit_mask(mask_contour(binary_mask))
+
+        # mask pixels -> crop pixels -> frame pixels
+        x0, y0, x1, y1 = box
+        scale, offset = infer_geometry((y1 - y0, x1 - x0), self.pixel_size)
+        center_x = (yy - offset[0]) / scale + x0
+        center_y = (xx - offset[1]) / scale + y0
+        semi_axis_a = ma / 2 / scale
+        semi_axis_b = MA / 2 / scale
+
+        hc = ellipse_circumference_approx(semi_axis_a, semi_axis_b)
+        if self.pixel_size is not None:
+            hc *= self.pixel_size
+
+        ellipse = cv2.ellipse(np.zeros(binary_mask.shape, np.uint8),
+                              (int(yy), int(xx)),
+                              (int(ma / 2), int(MA / 2)),
+                              -angle, 0, 360, color=1, thickness=-1)
+        union = np.logical_or(ellipse, binary_mask).sum()
+        iou = np.logical_and(ellipse, binary_mask).sum() / max(union, 1)
+        score = float(mask[binary_mask > 0].mean() * iou)
+
+        radius = max(semi_axis_a, semi_axis_b)
+        inside = (center_x - radius >= x0 and center_x + radius <= x1 and
+                  center_y - radius >= y0 and center_y + radius <= y1)
+
+        return {"center_x": float(center_x),
+                "center_y": float(center_y),
+                "semi_axis_a": float(semi_axis_a),
+                "semi_axis_b": float(semi_axis_b),
+                "angle": float((-angle * np.pi / 180) % np.pi),
+                "hc": float(hc),
+                "score": score,
+                "inside": inside}
+
+    def predict(self, index, frame):
+        """
+            Result of one frame, the last one when the frame barely changed
+        """
+        small = thumbnail(frame)
+        if (self.last_result is not None and self.skipped < self.max_skip and
+                np.abs(small - self.last_thumbnail).mean() < self.skip_threshold):
+            self.skipped += 1
+            return dict(self.last_result, frame=index, skipped=True)
+
+        self.skipped = 0
+        self.last_thumbnail = small
+
+        mask, box = self.segment(frame)
+        measure = self.measure(mask, box)
+
+        if measure is None:
+            self.roi = None
+            result = {"frame": index, "skipped": False, "roi": box, "hc": np.nan,
+                      "hc_smooth": self.hc_smooth, "score": 0.}
+        else:
+            inside = measure.pop("inside")
+            self.roi = ((measure["center_x"], measure["center_y"]),
+                        max(measure["semi_axis_a"], measure["semi_axis_b"])) if inside else None
+
+            if self.hc_smooth is None:
+                self.hc_smooth = measure["hc"]
+            else:
+                self.hc_smooth += self.smoothing * (measure["hc"] - self.hc_smooth)
+
+            result = dict(measure, frame=index, skipped=False, roi=box, hc_smooth=self.hc_smooth)
+            if self.best is None or result["score"] > self.best["score"]:
+                self.best = result
+
+        self.last_result = result
+
+        return result
+
+    def run(self, source):
+        """
+            Results of every frame of source (see read_frames)
+        """
+        self.reset()
+        frames = prefetch(read_frames(source), self.prefetch_size)
+        for index, frame in enumerate(frames):
+            yield self.predict(index, frame)
+
+
+def stream(model, source, pixel_size=None, save_path=None, **kwargs):
+    """
+        Runs a StreamPredictor over source, writes the per frame results to the csv save_path
+        and returns them with the best plane.
+    """
+    predictor = StreamPredictor(model, pixel_size=pixel_size, **kwargs)
+
+    print("="*100)
+    print("Streaming {} ...".format(source))
+    start = time.perf_counter()
+    results = list(predictor.run(source))
+    elapsed = time.perf_counter() - start
+
+    df = pd.DataFrame(results)
+    if len(df):
+        print("{} frames, {} segmented, {:.1f} fps".format(
+            len(df), int((~df["skipped"]).sum()), len(df) / elapsed))
+    if predictor.best is not None:
+        unit = "mm" if pixel_size is not None else "pixels"
+        print("Best plane: frame {}, HC {:.2f} {} (smoothed {:.2f}), score {:.3f}".format(
+            predictor.best["frame"], predictor.best["hc"], unit,
+            predictor.best["hc_smooth"], predictor.best["score"]))
+
+    if save_path:
+        df.to_csv(save_path, index=False)
+
+    return df, predictor.best
@@ -1,59 +1,179 @@
 import os
+import json
+import glob
+import argparse
 import numpy as np
 import pandas as pd
+from PIL import Image
 
-from seg.data import load_infer_image
-from seg.predict import pred_one_image
-from seg.ellipse_fitting import ellipse_fit_mask
+from seg.rle import rle_decode
 from seg.utils import load_infer_model
+from seg.predict import LazyModel, open_cache, pred_ellipses, load_ensemble_model
+from seg.data import infer_geometry
+from seg.maskstore import MaskStore
+from seg.ellipse import ellipse_fit_mask, mask_contour
 
 
-def generate_submission(model_path, predicted_path):
-    centers_x = list()
-    centers_y = list()
-    axes_a = list()
-    axes_b = list()
-    angles = list()
+def binary_format(name, threshold):
+    if threshold is not None:
+        raise ValueError("The {} predictions are binary masks, the threshold only applies to the 8-bit png "
+                         "probability maps: predict again with fmt=\"png\" to tune it".format(name))
 
-    model = load_infer_model(model_path)
 
-    df = pd.read_csv("./data/test_set_pixel_size.csv")
+def load_predictions(predicted_path, threshold=None):
+    """
+        (filename, binary mask) of the predictions written by seg.predict.pred in predicted_path,
+        whatever the format of its MaskWriter: masks.store, masks.jsonl or *_Predicted_Mask.png.
+        threshold (0.5 if None) only applies to the 8-bit png probability maps, the other formats
+        are already binary and raise a ValueError when a threshold is given.
+    """
+    store_path = os.path.join(predicted_path, "masks.store")
+    rle_path = os.path.join(predicted_path, "masks.jsonl")
 
-    for idx, row in df.iterrows():
-        image_path = os.path.join("./data/test_set", row["filename"])
-        image = load_infer_image(image_path)
+    if os.path.exists(store_path):
+        binary_format("store", threshold)
+        with MaskStore(store_path) as store:
+            for filename, mask in store.items():
+                yield filename, mask
+    elif os.path.exists(rle_path):
+        binary_format("rle", threshold)
+        with open(rle_path) as f:
+            for line in f:
+                record = json.loads(line)
+                yield record["filename"], rle_decode(record["counts"], record["shape"])
+    else:
+        paths = sorted(glob.glob(os.path.join(predicted_path, "*_Predicted_Mask.png")))
+        if not paths:
+            raise ValueError("No stored predictions found in {}".format(predicted_path))
+        for path in paths:
+            image = Image.open(path)
+            if image.mode == "1":
+                binary_format("png1", threshold)
+            image = np.asarray(image.convert("L"), dtype=np.float32) / 255.
+            filename = os.path.basename(path).replace("_Predicted_Mask.png", ".png")
+            yield filename, (image > (0.5 if threshold is None else threshold)).astype(np.uint8)
 
-        pred_image = pred_one_image(model, image)
 
-        assert 540 / pred_image.shape[0] == 800 / pred_image.shape[1]
+def fit_ellipses(predicted_path, threshold=None, method=None, contour=None):
+    """
+        DataFrame of the ellipses (seg.ellipse.ellipse_fit_mask, mask pixels) of the stored predictions,
+        with the mask height and width. An ellipses.jsonl is read as is (no mask, nothing to refit):
+        giving threshold, method or contour then raises a ValueError.
+        method: "Direct" (if None), "AMS" or "Simple", contour: fits the mask boundary instead of the filled mask.
+    """
+    ellipse_path = os.path.join(predicted_path, "ellipses.jsonl")
+    if os.path.exists(ellipse_path):
+        if threshold is not None or method is not None or contour is not None:
+            raise ValueError("{} holds fitted ellipses only, threshold, method and contour cannot be applied: "
+                             "predict again with fmt=\"png\" to tune them".format(ellipse_path))
+        df = pd.read_json(ellipse_path, lines=True)
+        df[["xx", "yy"]] = pd.DataFrame(df.pop("center").tolist(), index=df.index)
+        df[["MA", "ma"]] = pd.DataFrame(df.pop("axes").tolist(), index=df.index)
+        df[["height", "width"]] = pd.DataFrame(df.pop("shape").tolist(), index=df.index)
 
-        (xx, yy), (MA, ma), angle = ellipse_fit_mask(pred_image)
-        factor = row["pixel size(mm)"] * 540 / pred_image.shape[0]
+        return df
 
-        center_x_mm = factor * yy
-        center_y_mm = factor * xx
-        semi_axes_a_mm = factor * ma / 2
-        semi_axes_b_mm = factor * MA / 2
-        angle_rad = (-angle * np.pi / 180) % np.pi
+    records = list()
+    for filename, mask in load_predictions(predicted_path, threshold):
+        mask = mask.astype(np.float32)
+        if contour:
+            mask = mask_contour(mask)
+        (xx, yy), (MA, ma), angle = ellipse_fit_mask(mask, method=method or "Direct")
+        records.append((filename, xx, yy, MA, ma, angle) + mask.shape)
 
-        centers_x.append(center_x_mm)
-        centers_y.append(center_y_mm)
-        axes_a.append(semi_axes_a_mm)
-        axes_b.append(semi_axes_b_mm)
-        angles.append(angle_rad)
+    return pd.DataFrame(records, columns=["filename", "xx", "yy", "MA", "ma", "angle", "height", "width"])
 
-    df = df.drop(columns="pixel size(mm)")
-    df["center_x_mm"] = centers_x
-    df["center_y_mm"] = centers_y
-    df["semi_axes_a_mm"] = axes_a
-    df["semi_axes_b_mm"] = axes_b
-    df["angle_rad"] = angles
+
+def generate_submission(predicted_path, threshold=None, method=None, contour=None, pixel_size_path="./data/test_set_pixel_size.csv", image_dir="./data/test_set"):
+    """
+        Submission csv from the stored predictions of a seg.predict.pred run, no model involved:
+        the ellipses are fitted once per mask and mapped to mm for every row at once, with the
+        geometry of the preprocessing (resize_with_pad, or the config["mm_per_pixel"] resampling).
+        threshold, method, contour: None keeps the defaults (0.5, "Direct", filled mask), a ValueError
+        is raised when one is given that the stored format cannot apply.
+    """
+    ellipses = fit_ellipses(predicted_path, threshold=threshold, method=method, contour=contour)
+
+    return ellipses_to_submission(ellipses, predicted_path.rstrip("/").split("/")[-1],
+                                  pixel_size_path=pixel_size_path, image_dir=image_dir)
+
+
+def cached_submission(model_path, cache_dir, name, n_snapshots=None, pixel_size_path="./data/test_set_pixel_size.csv", image_dir="./data/test_set"):
+    """
+        Submission csv predicted through a seg.cache.PredictionCache (ellipses only are enough):
+        a rerun on the same checkpoint and images reads every ellipse from the cache and never loads
+        the model, only new or changed images are predicted.
+        model_path: checkpoint, or training directory of SGDR snapshots to ensemble
+    """
+    df = pd.read_csv(pixel_size_path)
+    if os.path.isdir(model_path):
+        model = LazyModel(lambda: load_ensemble_model(model_path, n_snapshots))
+    else:
+        model = LazyModel(lambda: load_infer_model(model_path))
+
+    with open_cache(cache_dir, model_path, n_snapshots) as cache:
+        ellipses = pred_ellipses(model, [os.path.join(image_dir, filename) for filename in df["filename"]],
+                                 cache=cache, pixel_sizes=df["pixel size(mm)"].values)
+
+    return ellipses_to_submission(ellipses, name, pixel_size_path=pixel_size_path, image_dir=image_dir)
+
+
+def ellipses_to_submission(ellipses, name, pixel_size_path="./data/test_set_pixel_size.csv", image_dir="./data/test_set"):
+    """
+        Maps the ellipses (pixels of the model input, one row per filename) to mm for every row at once
+        and writes ./submission/<name>.csv
+    """
+    df = pd.read_csv(pixel_size_path)
+    df = df.merge(ellipses, on="filename", how="left", validate="one_to_one")
+    missing = df["xx"].isna()
+    if missing.any():
+        raise ValueError("No prediction for {}".format(df.loc[missing, "filename"].tolist()))
+
+    # png header only, the images are not decoded
+    shapes = np.array([Image.open(os.path.join(image_dir, filename)).size[::-1]
+                       for filename in df["filename"]])
+    scale, offset = infer_geometry((shapes[:, 0], shapes[:, 1]), df["pixel size(mm)"].values)
+
+    factor = df["pixel size(mm)"] / scale
+    df["center_x_mm"] = factor * (df["yy"] - offset[0])
+    df["center_y_mm"] = factor * (df["xx"] - offset[1])
+    df["semi_axes_a_mm"] = factor * df["ma"] / 2
+    df["semi_axes_b_mm"] = factor * df["MA"] / 2
+    df["angle_rad"] = (-df["angle"] * np.pi / 180) % np.pi
+
+    df = df[["filename", "center_x_mm", "center_y_mm", "semi_axes_a_mm", "semi_axes_b_mm", "angle_rad"]]
 
     print("="*100)
     print("Make submission csv ...")
-    df.to_csv(
-        "./submission/{}.csv".format(predicted_path.split("/")[-1]), index=False)
+    df.to_csv("./submission/{}.csv".format(name), index=False)
+
+    return df
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('predicted_path', type=str,
+                        help="output directory of seg.predict.pred, only names the csv with --model_path")
+    parser.add_argument('--threshold', type=float, default=None,
+                        help="0.5 by default, 8-bit png predictions only")
+    parser.add_argument('--method', type=str, default=None,
+                        help="ellipse fit: 'Direct' (default), 'AMS' or 'Simple', not with the ellipse format")
+    parser.add_argument('--contour', action='store_true', default=None,
+                        help="fit the mask boundary instead of the filled mask, not with the ellipse format")
+    parser.add_argument('--model_path', type=str, default=None,
+                        help="predicts the test set through the prediction cache of --cache_dir instead of reading stored predictions")
+    parser.add_argument('--cache_dir', type=str, default="./data/cache/predictions")
+    parser.add_argument('--n_snapshots', type=int, default=None)
+    return parser.parse_args()
 
 
 if __name__ == "__main__":
-    generate_submission()
+    args = parse_args()
+    if args.model_path:
+        cached_submission(args.model_path, args.cache_dir, args.predicted_path.rstrip("/").split("/")[-1],
+                          n_snapshots=args.n_snapshots)
+    else:
+        generate_submission(args.predicted_path,
+                            threshold=args.threshold,
+                            method=args.method,
+                            contour=args.contour)
@@ -0,0 +1,158 @@
+import tensorflow as tf
+
+
+class MaskTarget(object):
+    """
+        Segmentation mask, one-hot encoded with the palette of the loader.
+        The mask is transformed together with the image by the geometric augmentations.
+    """
+    needs_mask = True
+    geometric = True
+
+    def load(self, loader, index, mask, geometry):
+        return tf.cast(mask, tf.uint8)
+
+    def build(self, loader, image, target):
+        mask = tf.cast(target, tf.float32)
+
+        if loader.one_hot_encoding:
+            if loader.palette is None:
+                raise ValueError('No Palette for one-hot encoding specified in the data loader! \
+                                  please specify one when initializing the loader.')
+            image, mask = loader.one_hot_encode(image, mask)
+
+        return image, mask
+
+
+class CsvTarget(object):
+    """
+        Base of the targets read from the csv of the loader, in pixels of the resized image.
+        Only the photometric augmentations are applied since the labels do not follow the geometric ones.
+        normalize: divides the coordinates by the input size (and angles by pi).
+    """
+    needs_mask = False
+    geometric = False
+    columns = []
+
+    def __init__(self, normalize=False):
+        self.normalize = normalize
+
+    def load(self, loader, index, mask, geometry):
+        values = tf.gather(loader.csv_values(self.columns), index)
+
+        return self.transform(loader, values, geometry)
+
+    def build(self, loader, image, target):
+        return image, target
+
+    def transform(self, loader, values, geometry):
+        raise NotImplementedError
+
+    def to_input_pixels(self, points, geometry):
+        """
+            (..., 2) x/y points of the original image to pixels of the resized and padded image
+        """
+        scale, offset = geometry
+
+        return points * scale + offset
+
+
+class EllipseTarget(CsvTarget):
+    """
+        center x, center y, semi axis a, semi axis b (pixels), angle (rad)
+    """
+    columns = ["center x(mm)", "center y(mm)", "semi axes a(mm)", "semi axes b(mm)", "angle(rad)", "pixel size(mm)"]
+
+    def transform(self, loader, values, geometry):
+        scale, _ = geometry
+        center = self.to_input_pixels(values[0:2] / values[5], geometry)
+        axes = values[2:4] / values[5] * scale
+        angle = values[4:5]
+
+        if self.normalize:
+            size = tf.constant([loader.image_size[1], loader.image_size[0]], tf.float32)
+            center /= size
+            axes /= size
+            angle /= 3.141592653589793
+
+        return tf.concat([center, axes, angle], axis=0)
+
+
+class BoundingBoxTarget(CsvTarget):
+    """
+        x min, y min, x max, y max (pixels)
+    """
+    columns = ["x min", "y min", "x max", "y max"]
+
+    def transform(self, loader, values, geometry):
+        corners = self.to_input_pixels(tf.reshape(values, (2, 2)), geometry)
+
+        if self.normalize:
+            corners /= tf.constant([loader.image_size[1], loader.image_size[0]], tf.float32)
+
+        return tf.reshape(corners, (4, ))
+
+
+class KeypointTarget(CsvTarget):
+    """
+        (5, 2) x/y of the ellipse center and of the four axis end points (seg.split.add_ellipses_keypoints)
+    """
+    columns = ["x0", "y0", "x1", "y1", "x2", "y2", "x3", "y3", "x4", "y4"]
+
+    def transform(self, loader, values, geometry):
+        points = self.to_input_pixels(tf.reshape(values, (5, 2)), geometry)
+
+        if self.normalize:
+            points /= tf.constant([loader.image_size[1], loader.image_size[0]], tf.float32)
+
+        return points
+
+
+class KeypointHeatmapTarget(KeypointTarget):
+    """
+        (H / stride, W / stride, 5) gaussian heatmaps of the ellipse keypoints, rendered in-graph
+        after the cache from the csv coordinates.
+        stride: output stride of the keypoint model, sigma: gaussian radius in output cells.
+    """
+
+    def __init__(self, stride=4, sigma=2.):
+        super().__init__(normalize=False)
+        self.stride = stride
+        self.sigma = sigma
+
+    def build(self, loader, image, target):
+        height = loader.image_size[0] // self.stride
+        width = loader.image_size[1] // self.stride
+
+        # keypoints in output cells, (1, 1, k, 2)
+        points = (target + 0.5) / self.stride - 0.5
+        points = points[None, None]
+
+        grid_y, grid_x = tf.meshgrid(tf.range(height, dtype=tf.float32),
+                                     tf.range(width, dtype=tf.float32),
+                                     indexing="ij")
+        grid = tf.stack([grid_x, grid_y], axis=-1)[:, :, None]
+
+        distance = tf.reduce_sum(tf.square(grid - points), axis=-1)
+        heatmaps = tf.exp(-distance / (2. * self.sigma ** 2))
+
+        return image, heatmaps
+
+
+TARGETS = {
+    "mask": MaskTarget,
+    "ellipse": EllipseTarget,
+    "bbox": BoundingBoxTarget,
+    "keypoints": KeypointTarget,
+    "heatmaps": KeypointHeatmapTarget
+}
+
+
+def get_target(target):
+    """
+        Target builder from its name in TARGETS, or the builder itself
+    """
+    if isinstance(target, str):
+        return TARGETS[target]()
+
+    return target
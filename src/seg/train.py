@@ -1,4 +1,6 @@
 import os
+import json
+import hashlib
 import numpy as np
 import pandas as pd
 
@@ -9,14 +11,18 @@ from pathlib import Path
 
 from seg import seglosses
 from seg.config import config
-from seg.data import DataLoader
-from seg.utils import time_to_timestr
+from seg.data import DataLoader, AUTOTUNE
+from seg.targets import KeypointHeatmapTarget
+from seg.utils import time_to_timestr, set_seed, load_pretrain_model
 from seg.SGDRScheduler import SGDRScheduler
+from seg.PeakMemoryLogger import PeakMemoryLogger
+from seg.GradientAccumulationModel import with_gradient_accumulation
 
 from seg.architect.Unet import unet
 from seg.architect.DilateUnet import dilate_unet
 from seg.architect.AttentionUnet import attention_unet
 from seg.architect.DilateAttentionUnet import dilate_attention_unet
+from seg.architect.KeypointNet import keypoint_net
 
 import tensorflow as tf
 from tensorflow.keras.optimizers import SGD, Adam, RMSprop
@@ -36,54 +42,18 @@ def lr_step_decay(epoch, lr):
     return initial_learning_rate * math.pow(drop_rate, math.floor(epoch/epochs_drop))
 
 
-def train():
-
-    # device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-    # print(device)
-
-    print("Epochs: {}\t\tBatch size: {}\t\tInput size: {}".format(config["epochs"],
-                                                                  config["batch_size"],
-                                                                  config["image_size"]))
-
-    # Datasets
-    print("="*100)
-    print("LOADING DATA ...\n")
-    train_set = DataLoader("../data/training_set/",
-                           mode="train",
-                           augmentation=True,
-                           compose=False,
-                           one_hot_encoding=True,
-                           palette=config["palette"],
-                           image_size=config["image_size"])
-    train_gen = train_set.data_gen(config["batch_size"], shuffle=True)
-
-    valid_set = DataLoader("../data/training_set/",
-                           mode="valid",
-                           augmentation=True,
-                           compose=False,
-                           one_hot_encoding=True,
-                           palette=config["palette"],
-                           image_size=config["image_size"])
-    valid_gen = valid_set.data_gen(config["batch_size"], shuffle=True)
-
-    # define model
-    model = dilate_unet(input_size=config["image_size"],
-                        dropout_rate=config["dropout_rate"],
-                        freeze=config["freeze"],
-                        freeze_at=config["freeze_at"])
-    print("Model: ", model._name)
-
-    # optim
+def build_optimizer(name, learning_rate=None):
+    learning_rate = learning_rate or config["learning_rate"]
     optimizers = {
-        "sgd": SGD(learning_rate=config["learning_rate"], momentum=config["momentum"], nesterov=True),
-        "adam": Adam(learning_rate=config["learning_rate"], amsgrad=True),
-        "rmsprop": RMSprop(learning_rate=config["learning_rate"], momentum=config["momentum"])
+        "sgd": SGD(learning_rate=learning_rate, momentum=config["momentum"], nesterov=True),
+        "adam": Adam(learning_rate=learning_rate, amsgrad=True),
+        "rmsprop": RMSprop(learning_rate=learning_rate, momentum=config["momentum"])
     }
 
-    optimizer = optimizers[config["optimizer"]]
-    print("Optimizer: ", optimizer._name)
+    return optimizers[name]
 
-    # loss
+
+def build_loss(name):
     losses = {
         "jaccard": seglosses.jaccard_loss,
         "dice": seglosses.dice_loss,
@@ -92,21 +62,36 @@ def train():
         "focal": seglosses.focal_loss(gamma=config["gamma"]),
         "focal_dice": seglosses.focal_dice_loss(gamma=config["gamma"]),
     }
-    print("Loss: ", losses[config["loss"]])
 
-    model.compile(optimizer=optimizer,
-                  loss=[losses[config["loss"]]],
-                  metrics=[seglosses.jaccard_index, seglosses.dice_coeff, seglosses.bce_loss])
+    return losses[name]
 
-    # callbacks
+
+def steps_per_epoch(data_gen):
+    """
+        Number of batches of a finite tf.data pipeline, i.e. optimizer updates per epoch
+    """
+    steps = int(tf.data.experimental.cardinality(data_gen))
+    if steps < 0:
+        raise ValueError("The cardinality of the training data is unknown or infinite")
+
+    return steps
+
+
+def build_lr_schedule(steps_per_epoch, learning_rate=None):
+    """
+        SGDR callback, its `schedule` has to be given to the optimizer as learning rate
+    """
     lr_schedule = SGDRScheduler(min_lr=1e-5,
-                                max_lr=config["learning_rate"],
-                                steps_per_epoch=np.ceil(
-                                    config["epochs"] / config["batch_size"]),
+                                max_lr=learning_rate or config["learning_rate"],
+                                steps_per_epoch=steps_per_epoch,
                                 lr_decay=0.9,
                                 cycle_length=10,
                                 mult_factor=1.5)
 
+    return lr_schedule
+
+
+def build_callbacks(model, optimizer, timestr, lr_schedule, batch_size=None, image_size=None):
     # lr_schedule = LearningRateScheduler(lr_step_decay,
     #                                     verbose=1)
 
@@ -120,45 +105,389 @@ def train():
                           patience=50,
                           verbose=1)
 
-    timestr = time_to_timestr()
     log_dir = "../logs/fit/{}".format(timestr)
     tensorboard_callback = TensorBoard(log_dir=log_dir,
                                        write_images=True)
 
     Path("../models/{}".format(timestr)).mkdir(parents=True, exist_ok=True)
+    # one snapshot per SGDR cycle, for seg.predict.load_ensemble_model
+    lr_schedule.save_dir = "../models/{}".format(timestr)
     file_path = "../models/%s/%s_%s_ep{epoch:02d}_bsize%d_insize%s.hdf5" % (
         timestr,
         model._name,
         optimizer._name,
-        config["batch_size"],
-        config["image_size"]
+        batch_size or config["batch_size"],
+        image_size or config["image_size"]
     )
     checkpoint = ModelCheckpoint(file_path, verbose=1, save_best_only=True)
 
+    memory = PeakMemoryLogger()
+
     callbacks_list = [
         lr_schedule,
+        memory,
         early,
         # anne,
         checkpoint,
         tensorboard_callback
     ]
 
+    return callbacks_list
+
+
+def save_history(history, lr_schedule, timestr):
+    """
+        history: History of model.fit, or the list of the Histories of the phases of a run
+    """
+    histories = history if isinstance(history, list) else [history]
+    his = pd.concat([pd.DataFrame(h.history) for h in histories], ignore_index=True)
+    his.to_csv("../models/{}/history.csv".format(timestr), index=False)
+
+    his = pd.DataFrame(lr_schedule.lr_history())
+    his.to_csv("../models/{}/history_lr.csv".format(timestr), index=False)
+
+
+def resize_phases():
+    """
+        Phases of the progressive resizing, (first epoch, input size, batch size) sorted by epoch,
+        a single phase at config["image_size"] without config["progressive_resize"].
+        The batch size of a phase defaults to config["batch_size"] scaled by the number of input pixels.
+    """
+    phases = config["progressive_resize"] or [{"epoch": 0, "image_size": config["image_size"]}]
+    pixels = config["image_size"][0] * config["image_size"][1]
+
+    resized = list()
+    for phase in sorted(phases, key=lambda phase: phase["epoch"]):
+        image_size = tuple(phase["image_size"])
+        if image_size[0] % 8 or image_size[1] % 8:
+            raise ValueError("Progressive resize input size {} is not a multiple of 8".format(image_size))
+        batch_size = phase.get("batch_size") or \
+            max(1, int(config["batch_size"] * pixels / (image_size[0] * image_size[1])))
+        resized.append((phase["epoch"], image_size, batch_size))
+
+    if resized[0][0] != 0:
+        raise ValueError("The first progressive resize phase has to start at epoch 0")
+
+    return resized
+
+
+def train():
+
+    # device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    # print(device)
+
+    phases = resize_phases()
+    if len(phases) > 1 and config["bottleneck"] == "aspp":
+        raise ValueError("The ASPP dilation rates depend on the input size, progressive resizing needs the same layers in every phase")
+
+    print("Epochs: {}\t\tBatch size: {}\t\tInput size: {}".format(config["epochs"],
+                                                                  [phase[2] for phase in phases],
+                                                                  [phase[1] for phase in phases]))
+    set_seed(config["seed"])
+
+    lr_schedule = None
+    previous_model = None
+    histories = list()
+    timestr = time_to_timestr()
+
+    for k, (initial_epoch, image_size, batch_size) in enumerate(phases):
+        last_phase = k == len(phases) - 1
+        epochs = config["epochs"] if last_phase else phases[k + 1][0]
+
+        # Datasets
+        print("="*100)
+        print("LOADING DATA (epochs {} to {}, input size {}, batch size {}) ...\n".format(
+            initial_epoch, epochs, image_size, batch_size))
+        train_set = DataLoader("../data/training_set/",
+                               mode="train",
+                               augmentation=True,
+                               compose=False,
+                               one_hot_encoding=True,
+                               palette=config["palette"],
+                               image_size=image_size,
+                               cache_dir=config["data_cache_dir"])
+        train_gen = train_set.data_gen(batch_size, shuffle=True)
+
+        valid_set = DataLoader("../data/training_set/",
+                               mode="valid",
+                               augmentation=False,
+                               compose=False,
+                               one_hot_encoding=True,
+                               palette=config["palette"],
+                               image_size=image_size,
+                               cache_dir=config["data_cache_dir"])
+        valid_gen = valid_set.data_gen(batch_size)
+
+        # define model, fully convolutional: the weights of the previous phase fit any input size
+        model = dilate_unet(input_size=image_size,
+                            dropout_rate=config["dropout_rate"],
+                            freeze=config["freeze"],
+                            freeze_at=config["freeze_at"],
+                            recompute=config["recompute"],
+                            bottleneck=config["bottleneck"])
+        if previous_model is not None:
+            model.set_weights(previous_model.get_weights())
+        if config["accum_steps"] > 1:
+            model = with_gradient_accumulation(model, config["accum_steps"])
+        print("Model: ", model._name)
+
+        # optim, the SGDR cycles continue over the phases
+        if lr_schedule is None:
+            lr_schedule = build_lr_schedule(steps_per_epoch(train_gen))
+        schedule = lr_schedule.start_phase(steps_per_epoch(train_gen), initial_epoch,
+                                           last_phase=last_phase)
+        optimizer = build_optimizer(config["optimizer"], schedule)
+        print("Optimizer: ", optimizer._name)
+
+        # loss
+        loss = build_loss(config["loss"])
+        print("Loss: ", loss)
+
+        model.compile(optimizer=optimizer,
+                      loss=[loss],
+                      metrics=[seglosses.jaccard_index, seglosses.dice_coeff, seglosses.bce_loss])
+
+        # callbacks
+        callbacks_list = build_callbacks(model, optimizer, timestr, lr_schedule,
+                                         batch_size=batch_size, image_size=image_size)
+
+        print("="*100)
+        print("TRAINING ...\n")
+
+        history = model.fit(train_gen,
+                            batch_size=batch_size,
+                            initial_epoch=initial_epoch,
+                            epochs=epochs,
+                            callbacks=callbacks_list,
+                            validation_data=valid_gen,
+                            workers=8,
+                            use_multiprocessing=True)
+        histories.append(history)
+        previous_model = model
+
+    save_history(histories, lr_schedule, timestr)
+
+    print("="*100)
+
+
+def cache_teacher_predictions(teacher_path, data_set, cache_dir, batch_size=config["batch_size"]):
+    """
+        Runs the teacher once over the (non augmented) data set and stores its soft masks as a float16 .npy,
+        rows follow the csv order of data_set.
+        The cache file is keyed on the teacher checkpoint, its modification time and the content key of
+        data_set (input size, resampling, palette, csv, ...), so it is recomputed only when one of them changes.
+    """
+    key = hashlib.md5(json.dumps({"teacher": os.path.abspath(teacher_path),
+                                  "mtime": os.path.getmtime(teacher_path),
+                                  "data": data_set.content_key()}, sort_keys=True).encode()).hexdigest()
+    cache_path = os.path.join(cache_dir, "teacher_{}.npy".format(key))
+
+    if os.path.exists(cache_path):
+        print("Using cached teacher predictions: {}".format(cache_path))
+        return cache_path
+
+    Path(cache_dir).mkdir(parents=True, exist_ok=True)
+    teacher = load_pretrain_model(teacher_path)
+    n_images = len(data_set.image_paths)
+    shape = (n_images, ) + tuple(teacher.output_shape[1:])
+
+    tmp_path = cache_path.replace(".npy", ".tmp.npy")
+    cache = np.lib.format.open_memmap(tmp_path, mode="w+",
+                                      dtype=np.float16, shape=shape)
+
+    print("Caching teacher predictions ...")
+    # rows are written at the csv row of every image, whatever the read order
+    for indices, images, _ in tqdm(data_set.dataset(with_index=True).batch(batch_size)):
+        preds = teacher(images, training=False).numpy()
+        cache[indices.numpy()] = preds.astype(np.float16)
+
+    cache.flush()
+    del cache
+    # rename last so an interrupted run never leaves a partial cache behind
+    os.replace(tmp_path, cache_path)
+
+    del teacher
+    tf.keras.backend.clear_session()
+
+    return cache_path
+
+
+def distillation_data_gen(data_set, cache_path, batch_size, shuffle=False):
+    """
+        Yields (image, [mask, teacher mask]) batches, the teacher mask of every image is read from the
+        memory-mapped cache at its csv row.
+    """
+    teacher_masks = np.load(cache_path, mmap_mode="r")
+    mask_shape = tuple(data_set.image_size) + (len(data_set.palette), )
+    teacher_shape = teacher_masks.shape[1:]
+
+    def read_teacher(index):
+        return teacher_masks[index].astype(np.float32)
+
+    def pack(index, image, mask):
+        teacher_mask = tf.numpy_function(read_teacher, [index], tf.float32)
+        mask = tf.ensure_shape(mask, mask_shape)
+        teacher_mask = tf.ensure_shape(teacher_mask, teacher_shape)
+
+        return image, tf.concat([mask, teacher_mask], axis=-1)
+
+    data = data_set.dataset(shuffle=shuffle, with_index=True)
+    data = data.map(pack, num_parallel_calls=AUTOTUNE)
+
+    return data.batch(batch_size).prefetch(AUTOTUNE)
+
+
+def train_distillation():
+    """
+        Trains a narrow unet student against the ground truth and the soft masks of a trained teacher.
+        Teacher masks are computed once and cached to disk, augmentation is disabled since the cached
+        teacher masks have to stay aligned with the images.
+    """
+    distill = config["distillation"]
+
+    print("Epochs: {}\t\tBatch size: {}\t\tInput size: {}".format(config["epochs"],
+                                                                  config["batch_size"],
+                                                                  config["image_size"]))
+    set_seed(config["seed"])
+
+    # Datasets
+    print("="*100)
+    print("LOADING DATA ...\n")
+    train_set = DataLoader("../data/training_set/",
+                           mode="train",
+                           augmentation=False,
+                           one_hot_encoding=True,
+                           palette=config["palette"],
+                           image_size=config["image_size"],
+                           cache_dir=config["data_cache_dir"])
+    valid_set = DataLoader("../data/training_set/",
+                           mode="valid",
+                           augmentation=False,
+                           one_hot_encoding=True,
+                           palette=config["palette"],
+                           image_size=config["image_size"],
+                           cache_dir=config["data_cache_dir"])
+
+    train_cache = cache_teacher_predictions(distill["teacher_path"],
+                                            train_set,
+                                            distill["cache_dir"])
+    valid_cache = cache_teacher_predictions(distill["teacher_path"],
+                                            valid_set,
+                                            distill["cache_dir"])
+
+    train_gen = distillation_data_gen(train_set, train_cache,
+                                      config["batch_size"], shuffle=True)
+    valid_gen = distillation_data_gen(valid_set, valid_cache,
+                                      config["batch_size"])
+
+    # define student
+    model = unet(input_size=config["image_size"],
+                 n_filters=distill["student_filters"],
+                 dropout_rate=config["dropout_rate"],
+                 recompute=config["recompute"])
+    model._name = "{}Student{}".format(model._name, distill["student_filters"])
+    print("Model: ", model._name)
+
+    # optim
+    lr_schedule = build_lr_schedule(steps_per_epoch(train_gen))
+    optimizer = build_optimizer(config["optimizer"], lr_schedule.schedule)
+    print("Optimizer: ", optimizer._name)
+
+    # loss
+    loss = seglosses.distillation_loss(build_loss(config["loss"]),
+                                       alpha=distill["alpha"],
+                                       temperature=distill["temperature"],
+                                       soft_loss=distill["soft_loss"])
+    print("Loss: ", loss)
+
+    model.compile(optimizer=optimizer,
+                  loss=[loss],
+                  metrics=[seglosses.gt_only(seglosses.jaccard_index),
+                           seglosses.gt_only(seglosses.dice_coeff),
+                           seglosses.gt_only(seglosses.bce_loss)])
+
+    # callbacks
+    timestr = time_to_timestr()
+    callbacks_list = build_callbacks(model, optimizer, timestr, lr_schedule)
+
     print("="*100)
     print("TRAINING ...\n")
 
     history = model.fit(train_gen,
-                        batch_size=config["batch_size"],
                         epochs=config["epochs"],
                         callbacks=callbacks_list,
-                        validation_data=valid_gen,
-                        workers=8,
-                        use_multiprocessing=True)
+                        validation_data=valid_gen)
 
-    his = pd.DataFrame(history.history)
-    his.to_csv("../models/{}/history.csv".format(timestr), index=False)
+    save_history(history, lr_schedule, timestr)
 
-    his = pd.DataFrame(lr_schedule.history)
-    his.to_csv("../models/{}/history_lr.csv".format(timestr), index=False)
+    print("="*100)
+
+
+def train_keypoints():
+    """
+        Trains the heatmap keypoint model on the center and axis end points of the ellipses
+        (train_keypoints.csv / valid_keypoints.csv from seg.split).
+    """
+    keypoints = config["keypoints"]
+
+    print("Epochs: {}\t\tBatch size: {}\t\tInput size: {}".format(config["epochs"],
+                                                                  config["batch_size"],
+                                                                  config["image_size"]))
+    set_seed(config["seed"])
+
+    # Datasets
+    print("="*100)
+    print("LOADING DATA ...\n")
+    train_set = DataLoader("../data/training_set/",
+                           mode="train",
+                           augmentation=True,
+                           compose=False,
+                           image_size=config["image_size"],
+                           cache_dir=config["data_cache_dir"],
+                           target=KeypointHeatmapTarget(stride=4, sigma=keypoints["sigma"]),
+                           csv_path="./data/train_keypoints.csv")
+    train_gen = train_set.data_gen(config["batch_size"], shuffle=True)
+
+    valid_set = DataLoader("../data/training_set/",
+                           mode="valid",
+                           augmentation=False,
+                           image_size=config["image_size"],
+                           cache_dir=config["data_cache_dir"],
+                           target=KeypointHeatmapTarget(stride=4, sigma=keypoints["sigma"]),
+                           csv_path="./data/valid_keypoints.csv")
+    valid_gen = valid_set.data_gen(config["batch_size"])
+
+    # define model
+    model = keypoint_net(input_size=config["image_size"],
+                         encoder=keypoints["encoder"],
+                         alpha=keypoints["alpha"],
+                         dropout_rate=config["dropout_rate"],
+                         recompute=config["recompute"])
+    print("Model: ", model._name)
+
+    # optim
+    lr_schedule = build_lr_schedule(steps_per_epoch(train_gen))
+    optimizer = build_optimizer(config["optimizer"], lr_schedule.schedule)
+    print("Optimizer: ", optimizer._name)
+
+    # heatmap regression
+    model.compile(optimizer=optimizer,
+                  loss="mse",
+                  metrics=["mae"])
+
+    # callbacks
+    timestr = time_to_timestr()
+    callbacks_list = build_callbacks(model, optimizer, timestr, lr_schedule)
+
+    print("="*100)
+    print("TRAINING ...\n")
+
+    history = model.fit(train_gen,
+                        epochs=config["epochs"],
+                        callbacks=callbacks_list,
+                        validation_data=valid_gen)
+
+    save_history(history, lr_schedule, timestr)
 
     print("="*100)
 
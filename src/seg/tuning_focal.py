@@ -11,6 +11,7 @@ from seg.config import config
 from seg.data import DataLoader
 from seg.architect.Unet import unet
 from seg.utils import time_to_timestr
+from seg.feature_cache import FeatureCache, FullModelCheckpoint
 
 import tensorflow as tf
 from tensorflow.keras.optimizers import SGD, Adam, RMSprop
@@ -56,6 +57,32 @@ def lr_step_decay(epoch, lr):
     return initial_learning_rate * math.pow(drop_rate, math.floor(epoch/epochs_drop))
 
 
+def cached_features(model, freeze_at):
+    """
+        Suffix of model after its freeze_at frozen layers and its train / valid datasets of cached activations,
+        the training set is the non-augmented one or config["feature_cache_passes"] fixed augmented passes.
+    """
+    def loader(mode, augmentation, seed=config["seed"]):
+        return DataLoader("../data/training_set/",
+                          mode=mode,
+                          augmentation=augmentation,
+                          one_hot_encoding=True,
+                          palette=config["palette"],
+                          image_size=config["image_size"],
+                          seed=seed,
+                          cache_dir=config["data_cache_dir"])
+
+    passes = config["feature_cache_passes"]
+    train_loaders = [loader("train", True, config["seed"] + k) for k in range(passes)] or [loader("train", False)]
+
+    features = FeatureCache(config["feature_cache_dir"], model, freeze_at)
+    train_gen = features.data_gen(features.build(train_loaders), config["batch_size"],
+                                  shuffle=True, seed=config["seed"])
+    valid_gen = features.data_gen(features.build([loader("valid", False)]), config["batch_size"])
+
+    return features.suffix, train_gen, valid_gen
+
+
 def train(run_dir, hparams, train_gen, valid_gen):
     # define model
     model = unet(dropout_rate=hparams[HP_DROPOUT],
@@ -63,6 +90,11 @@ def train(run_dir, hparams, train_gen, valid_gen):
                  freeze_at=hparams[HP_FREEZE_AT])
     print("Model: ", model._name)
 
+    # the frozen layers run once over the data, the trainable ones are fitted on their activations
+    fit_model = model
+    if config["freeze"] and config["feature_cache_dir"]:
+        fit_model, train_gen, valid_gen = cached_features(model, hparams[HP_FREEZE_AT])
+
     # optim
     optimizers = {
         "sgd": SGD(learning_rate=config["learning_rate"], momentum=config["momentum"], nesterov=True),
@@ -82,9 +114,9 @@ def train(run_dir, hparams, train_gen, valid_gen):
     }
     loss = losses[hparams[HP_LOSS]]
 
-    model.compile(optimizer=optimizer,
-                  loss=[loss],
-                  metrics=[seglosses.jaccard_index, seglosses.dice_coeff, seglosses.bce_loss])
+    fit_model.compile(optimizer=optimizer,
+                      loss=[loss],
+                      metrics=[seglosses.jaccard_index, seglosses.dice_coeff, seglosses.bce_loss])
 
     # callbacks
     lr_schedule = LearningRateScheduler(lr_step_decay,
@@ -115,7 +147,7 @@ def train(run_dir, hparams, train_gen, valid_gen):
     Path("../models/{}/{}".format(run_dir.split("/")[-2],
                                   run_dir.split("/")[-1])).mkdir(parents=True, exist_ok=True)
 
-    checkpoint = ModelCheckpoint(file_path, verbose=1, save_best_only=True)
+    checkpoint = FullModelCheckpoint(model, file_path, verbose=1, save_best_only=True)
 
     callbacks_list = [
         lr_schedule,
@@ -129,13 +161,13 @@ def train(run_dir, hparams, train_gen, valid_gen):
     print("="*100)
     print("TRAINING ...\n")
 
-    history = model.fit(train_gen,
-                        batch_size=config["batch_size"],
-                        epochs=config["epochs"],
-                        callbacks=callbacks_list,
-                        validation_data=valid_gen,
-                        workers=8,
-                        use_multiprocessing=True)
+    history = fit_model.fit(train_gen,
+                            batch_size=config["batch_size"],
+                            epochs=config["epochs"],
+                            callbacks=callbacks_list,
+                            validation_data=valid_gen,
+                            workers=8,
+                            use_multiprocessing=True)
 
     his = pd.DataFrame(history.history)
     his.to_csv("../models/{}/{}/history.csv".format(run_dir.split("/")[-2],
@@ -148,16 +180,18 @@ def prepare_data():
                            augmentation=True,
                            one_hot_encoding=True,
                            palette=config["palette"],
-                           image_size=config["image_size"])
+                           image_size=config["image_size"],
+                           cache_dir=config["data_cache_dir"])
     train_gen = train_set.data_gen(config["batch_size"], shuffle=True)
 
     valid_set = DataLoader("../data/training_set/",
                            mode="valid",
-                           augmentation=True,
+                           augmentation=False,
                            one_hot_encoding=True,
                            palette=config["palette"],
-                           image_size=config["image_size"])
-    valid_gen = valid_set.data_gen(config["batch_size"], shuffle=True)
+                           image_size=config["image_size"],
+                           cache_dir=config["data_cache_dir"])
+    valid_gen = valid_set.data_gen(config["batch_size"])
 
     return (train_gen, valid_gen)
 
@@ -1,4 +1,8 @@
 import os
+import json
+import random
+import h5py
+import hashlib
 import numpy as np
 
 import math
@@ -6,9 +10,14 @@ import datetime
 from PIL import Image
 
 import tensorflow as tf
-from tensorflow.keras.models import load_model
+from tensorflow.keras import Input
+from tensorflow.keras.models import Model, load_model
+from tensorflow.keras.layers import InputLayer, Conv2D, DepthwiseConv2D, Conv2DTranspose, BatchNormalization, Dropout
 
 from seg import seglosses
+from seg.architect.layers import AttentionGate
+from seg.architect.recompute import RecomputeGrad
+from seg.GradientAccumulationModel import GradientAccumulationModel
 
 
 def time_to_timestr():
@@ -17,6 +26,15 @@ def time_to_timestr():
     return timestr
 
 
+def set_seed(seed):
+    """
+        Seeds python, numpy and tensorflow (weight init, dropout), the input pipeline has its own seed
+    """
+    random.seed(seed)
+    np.random.seed(seed)
+    tf.random.set_seed(seed)
+
+
 def load_pretrain_model(file_path):
     custom_objects = {
         "jaccard_loss": seglosses.jaccard_loss,
@@ -26,11 +44,321 @@ def load_pretrain_model(file_path):
         "bce_loss": seglosses.bce_loss,
         "bce_dice_loss": seglosses.bce_dice_loss,
         "loss": seglosses.focal_loss(),
-        "f_d_loss": seglosses.focal_dice_loss()
+        "f_d_loss": seglosses.focal_dice_loss(),
+        "AttentionGate": AttentionGate,
+        "RecomputeGrad": RecomputeGrad,
+        "GradientAccumulationModel": GradientAccumulationModel
     }
 
     return load_model(file_path, custom_objects=custom_objects)
 
 
-def load_infer_model(file_path):
-    return load_model(file_path, compile=False)
+def load_infer_model(file_path, optimize=False):
+    """
+        optimize: folds BatchNormalization into the convs and drops Dropout, see optimize_for_inference
+    """
+    model = load_model(file_path, compile=False,
+                       custom_objects={"AttentionGate": AttentionGate,
+                                       "RecomputeGrad": RecomputeGrad,
+                                       "GradientAccumulationModel": GradientAccumulationModel})
+
+    if optimize:
+        model = optimize_for_inference(model)
+
+    return model
+
+
+def layer_signatures(model_config):
+    """
+        {layer name: hash of the sub-graph that produces the layer}, computed from a functional model config.
+        Layer names are ignored, so two builds of the same architecture get the same signatures.
+        The legacy attention broadcast Lambda(repeat_elements) -> Multiply hashes like AttentionGate.
+    """
+    layers = {layer["name"]: layer for layer in model_config["layers"]}
+    signatures = {}
+
+    def signature(name):
+        if name in signatures:
+            return signatures[name]
+
+        layer = layers[name]
+        nodes = layer["inbound_nodes"]
+        inbound = [node[0] for node in nodes[0]] if nodes else []
+        class_name = layer["class_name"]
+
+        if class_name == "Lambda":
+            key = signature(inbound[0])
+        else:
+            if class_name in ("Multiply", "AttentionGate"):
+                class_name = "Gate"
+            layer_config = layer["config"]
+            hparams = [layer_config.get(k) for k in ("filters", "kernel_size", "strides", "dilation_rate")]
+            key = "{}{}({})".format(class_name, hparams,
+                                    ",".join(signature(n) for n in inbound))
+            key = hashlib.md5(key.encode()).hexdigest()
+
+        signatures[name] = key
+
+        return key
+
+    for name in layers:
+        signature(name)
+
+    return signatures
+
+
+def load_weights_by_structure(model, file_path, layers=None):
+    """
+        Weight-mapping shim: copies weights from an HDF5 checkpoint into model by matching layers on their
+        position in the graph instead of their name or index. Checkpoints saved before the attention gates
+        became an AttentionGate layer (Lambda + Multiply) therefore load into the current builders.
+        layers: restricts the copy to these layers of model (default: all).
+    """
+    layers = model.layers if layers is None else layers
+
+    with h5py.File(file_path, "r") as f:
+        model_config = f.attrs["model_config"]
+        if isinstance(model_config, bytes):
+            model_config = model_config.decode("utf-8")
+        saved_signatures = layer_signatures(json.loads(model_config)["config"])
+        saved_names = {}
+        for name, key in saved_signatures.items():
+            saved_names.setdefault(key, []).append(name)
+
+        signatures = layer_signatures(json.loads(model.to_json())["config"])
+        weights_group = f["model_weights"] if "model_weights" in f else f
+
+        for layer in layers:
+            if not layer.weights:
+                continue
+
+            names = saved_names.get(signatures[layer.name], [])
+            if len(names) != 1:
+                raise ValueError("Cannot match layer {} in {} ({} candidates)".format(
+                    layer.name, file_path, len(names)))
+
+            group = weights_group[names[0]]
+            weight_names = [n.decode("utf-8") if isinstance(n, bytes) else n
+                            for n in group.attrs["weight_names"]]
+            layer.set_weights([np.asarray(group[n]) for n in weight_names])
+
+
+def convert_legacy_checkpoint(builder, file_path, output_path, **kwargs):
+    """
+        Rebuilds a checkpoint with the current builder (e.g. attention_unet) and re-saves it,
+        old Lambda based attention checkpoints become serialisable AttentionGate ones.
+    """
+    model = builder(**kwargs)
+    load_weights_by_structure(model, file_path)
+    model.save(output_path)
+
+    return model
+
+
+def inbound_layers(layer):
+    """
+        Layers feeding layer in the functional graph it was built in, in call order
+    """
+    inbound = layer._inbound_nodes[0].inbound_layers
+    if not isinstance(inbound, (list, tuple)):
+        inbound = [inbound]
+
+    return list(inbound)
+
+
+def clone_layer(layer, **overrides):
+    """
+        New, unbuilt layer with the same config as layer, config keys in overrides are replaced
+    """
+    layer_config = layer.get_config()
+    layer_config.update(overrides)
+
+    return layer.__class__.from_config(layer_config)
+
+
+def rebuild_model(model, clone_fn):
+    """
+        Re-creates a functional model layer by layer in topological order.
+        clone_fn(layer) returns the layer to use in the new graph, or None to drop the layer (its single input is passed through).
+        Weights are not copied, new layers are built and can be assigned with set_weights afterwards.
+    """
+    tensors = {}
+    for layer in model.layers:
+        if isinstance(layer, InputLayer):
+            tensors[layer.name] = Input(batch_shape=layer.get_config()["batch_input_shape"],
+                                        name=layer.name)
+            continue
+
+        x = [tensors[inbound.name] for inbound in inbound_layers(layer)]
+        x = x[0] if len(x) == 1 else x
+
+        new_layer = clone_fn(layer)
+        tensors[layer.name] = x if new_layer is None else new_layer(x)
+
+    inputs = [tensors[name] for name in model.input_names]
+    outputs = [tensors[name] for name in model.output_names]
+
+    return Model(inputs=inputs, outputs=outputs, name=model.name)
+
+
+def flatten_model(model):
+    """
+        Plain functional copy of model, the RecomputeGrad blocks of the recompute=True builds replaced by their layers.
+        Layers keep their names and weights, so the lean graph of optimize_for_inference is the one of recompute=False.
+    """
+    def inline(graph, inputs):
+        tensors = dict(zip(graph.input_names, inputs))
+        for layer in graph.layers:
+            if isinstance(layer, InputLayer):
+                continue
+
+            x = [tensors[inbound.name] for inbound in inbound_layers(layer)]
+            if isinstance(layer, RecomputeGrad):
+                tensors[layer.name] = inline(layer.block, x)
+                continue
+
+            new_layer = clone_layer(layer)
+            tensors[layer.name] = new_layer(x[0] if len(x) == 1 else x)
+            new_layer.set_weights(layer.get_weights())
+
+        outputs = [tensors[name] for name in graph.output_names]
+
+        return outputs[0] if len(outputs) == 1 else outputs
+
+    inputs = [Input(batch_shape=layer.get_config()["batch_input_shape"], name=layer.name)
+              for layer in (model.get_layer(name) for name in model.input_names)]
+    outputs = inline(model, inputs)
+
+    return Model(inputs=inputs, outputs=outputs, name=model.name)
+
+
+def nested_layers(model):
+    """
+        {name: layer} of model, the layers inside its RecomputeGrad blocks included
+    """
+    layers = {}
+    for layer in model.layers:
+        if isinstance(layer, RecomputeGrad):
+            layers.update(nested_layers(layer.block))
+        elif not isinstance(layer, InputLayer):
+            layers[layer.name] = layer
+
+    return layers
+
+
+def transfer_weights(source, target):
+    """
+        Copies the weights of source into target, two builds of the same architecture with or without recompute:
+        get_weights() lists the weights of a recompute=True model block by block, so set_weights cannot be used
+        across the setting. Layers are matched on their position in the flattened graphs (see flatten_model).
+    """
+    source_layers = [layer for layer in flatten_model(source).layers if layer.weights]
+    target_layers = [layer for layer in flatten_model(target).layers if layer.weights]
+    if len(source_layers) != len(target_layers):
+        raise ValueError("Cannot transfer the weights of {} ({} layers with weights) to {} ({} layers with weights)".format(
+            source.name, len(source_layers), target.name, len(target_layers)))
+
+    originals = nested_layers(target)
+    for source_layer, target_layer in zip(source_layers, target_layers):
+        weights = source_layer.get_weights()
+        shapes = [w.shape for w in target_layer.get_weights()]
+        if type(source_layer) is not type(target_layer) or [w.shape for w in weights] != shapes:
+            raise ValueError("Cannot transfer the weights of {} to {}: layer {} does not match layer {}".format(
+                source.name, target.name, source_layer.name, target_layer.name))
+
+        originals[target_layer.name].set_weights(weights)
+
+
+def foldable_batchnorms(model):
+    """
+        {conv name: BatchNormalization} for every BN that directly follows a linear Conv2D / DepthwiseConv2D
+        whose only consumer it is.
+    """
+    folds = {}
+    for layer in model.layers:
+        if not isinstance(layer, BatchNormalization):
+            continue
+
+        conv = inbound_layers(layer)[0]
+        if not isinstance(conv, (Conv2D, DepthwiseConv2D)) or isinstance(conv, Conv2DTranspose):
+            continue
+        if conv.get_config().get("activation") != "linear" or len(conv._outbound_nodes) != 1:
+            continue
+        if layer.axis not in (-1, [-1], [3], 3):
+            continue
+
+        folds[conv.name] = layer
+
+    return folds
+
+
+def fold_batchnorm(conv, bn):
+    """
+        Returns (kernel, bias) of conv with the inference-mode bn folded in:
+        W' = W * gamma / sqrt(var + eps),  b' = (b - mean) * gamma / sqrt(var + eps) + beta
+    """
+    weights = conv.get_weights()
+    kernel = weights[0]
+    bias = weights[1] if conv.use_bias else np.zeros(bn.moving_mean.shape, dtype=kernel.dtype)
+
+    gamma = bn.gamma.numpy() if bn.scale else 1.
+    beta = bn.beta.numpy() if bn.center else 0.
+    scale = gamma / np.sqrt(bn.moving_variance.numpy() + bn.epsilon)
+
+    if isinstance(conv, DepthwiseConv2D):
+        # kernel: (h, w, in, depth_multiplier), output channel = in * depth_multiplier + m
+        kernel = kernel * scale.reshape(kernel.shape[2], kernel.shape[3])
+    else:
+        # kernel: (h, w, in, out)
+        kernel = kernel * scale
+
+    bias = (bias - bn.moving_mean.numpy()) * scale + beta
+
+    return kernel.astype(weights[0].dtype), bias.astype(weights[0].dtype)
+
+
+def optimize_for_inference(model, verify=True, n_samples=4, atol=1e-3):
+    """
+        Lean inference graph of any seg architecture: every Conv -> BatchNormalization pair becomes a single conv
+        with folded weights and bias, Dropout layers are removed.
+        verify: checks on random inputs that the optimised model matches the original.
+    """
+    original = model
+    if any(isinstance(layer, RecomputeGrad) for layer in model.layers):
+        # the BatchNormalization layers are hidden in the blocks, fold them in the plain graph
+        model = flatten_model(model)
+
+    folds = foldable_batchnorms(model)
+    folded_bns = set(bn.name for bn in folds.values())
+
+    def clone_fn(layer):
+        if isinstance(layer, Dropout) or layer.name in folded_bns:
+            return None
+        if layer.name in folds:
+            return clone_layer(layer, use_bias=True)
+
+        return clone_layer(layer)
+
+    lean = rebuild_model(model, clone_fn)
+
+    for layer in model.layers:
+        if not layer.weights or layer.name in folded_bns:
+            continue
+
+        if layer.name in folds:
+            lean.get_layer(layer.name).set_weights(
+                list(fold_batchnorm(layer, folds[layer.name])))
+        else:
+            lean.get_layer(layer.name).set_weights(layer.get_weights())
+
+    print("Inference graph: {} -> {} layers, {} BatchNormalization folded".format(
+        len(model.layers), len(lean.layers), len(folds)))
+
+    if verify:
+        x = np.random.uniform(size=(n_samples, ) + tuple(model.input_shape[1:])).astype(np.float32)
+        diff = np.max(np.abs(original(x, training=False).numpy() - lean(x, training=False).numpy()))
+        print("Max abs difference on {} random inputs: {:.2e}".format(n_samples, diff))
+        if diff > atol:
+            raise ValueError("Optimised model differs from the original (max abs diff {})".format(diff))
+
+    return lean
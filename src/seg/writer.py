@@ -0,0 +1,127 @@
+import os
+import json
+import threading
+import numpy as np
+from PIL import Image
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+from seg.rle import rle_encode
+from seg.maskstore import MaskStore
+from seg.ellipse import ellipse_fit_mask
+
+FORMATS = ["png", "png1", "rle", "ellipse", "store"]
+
+
+class MaskWriter(object):
+    '''Writes predicted masks on a thread pool, so that encoding and disk I/O overlap with inference.
+    # Usage
+        ```python
+            with MaskWriter("./data/predicted", fmt="png1") as writer:
+                for filename, mask in predictions:
+                    writer.write(filename, mask)
+        ```
+    # Arguments
+        save_dir: Output directory.
+        fmt: "png": 8-bit png per image (`*_Predicted_Mask.png`),
+             "png1": 1-bit png per image (mask thresholded at threshold),
+             "rle": run-length encoded masks (seg.rle) in a single masks.jsonl,
+             "ellipse": only the fitted ellipse (seg.ellipse.ellipse_fit_mask) in a single ellipses.jsonl,
+             "store": per-row RLE masks in a single indexed masks.store (seg.maskstore.MaskStore).
+        workers: Number of writer threads. PIL (zlib) and numpy release the GIL while encoding.
+        max_pending: Bound of the queue, `write` blocks when that many masks are waiting,
+                     which caps the memory held by predictions faster than the disk.
+        threshold: Binarisation threshold of the compact formats.
+    # Notes
+        The jsonl lines are written in completion order, every line carries its filename.
+        An error of a writer thread is raised by the next `write` or by `close`.
+    '''
+
+    def __init__(self, save_dir, fmt="png", workers=4, max_pending=32, threshold=0.5):
+        if fmt not in FORMATS:
+            raise ValueError("Unknown mask format: {}, expected one of {}".format(fmt, FORMATS))
+
+        self.save_dir = save_dir
+        self.fmt = fmt
+        self.threshold = threshold
+        Path(save_dir).mkdir(parents=True, exist_ok=True)
+
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.pending = threading.BoundedSemaphore(max_pending)
+        self.lock = threading.Lock()
+        self.error = None
+
+        self.jsonl = None
+        if fmt in ["rle", "ellipse"]:
+            name = "masks.jsonl" if fmt == "rle" else "ellipses.jsonl"
+            self.jsonl = open(os.path.join(save_dir, name), "w")
+
+        self.store = None
+        if fmt == "store":
+            self.store = MaskStore(os.path.join(save_dir, "masks.store"), mode="w",
+                                   threshold=threshold)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, filename, mask):
+        """
+            Queues mask (2D float array in [0, 1]) of the image filename
+        """
+        self.raise_error()
+        self.pending.acquire()
+        future = self.executor.submit(self._write, filename, np.asarray(mask).squeeze())
+        future.add_done_callback(self._done)
+
+    def _done(self, future):
+        if future.exception() is not None and self.error is None:
+            self.error = future.exception()
+        self.pending.release()
+
+    def _write(self, filename, mask):
+        if self.fmt == "png":
+            path = os.path.join(self.save_dir, filename.replace(".png", "_Predicted_Mask.png"))
+            image = np.clip(mask * 255, 0, 255).astype(np.uint8)
+            Image.fromarray(image, mode="L").save(path)
+        elif self.fmt == "png1":
+            path = os.path.join(self.save_dir, filename.replace(".png", "_Predicted_Mask.png"))
+            Image.fromarray(mask > self.threshold).convert("1").save(path, optimize=True)
+        elif self.fmt == "rle":
+            counts = rle_encode(mask > self.threshold)
+            self._write_line({"filename": filename,
+                              "shape": list(mask.shape),
+                              "counts": counts.tolist()})
+        elif self.fmt == "ellipse":
+            (xx, yy), (MA, ma), angle = ellipse_fit_mask(
+                (mask > self.threshold).astype(np.float32))
+            self._write_line({"filename": filename,
+                              "shape": list(mask.shape),
+                              "center": [float(xx), float(yy)],
+                              "axes": [float(MA), float(ma)],
+                              "angle": float(angle)})
+        elif self.fmt == "store":
+            record = self.store.encode(mask)
+            with self.lock:
+                self.store.append(filename, *record)
+
+    def _write_line(self, record):
+        line = json.dumps(record)
+        with self.lock:
+            self.jsonl.write(line + "\n")
+
+    def raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        if self.jsonl is not None:
+            self.jsonl.close()
+            self.jsonl = None
+        if self.store is not None:
+            self.store.close()
+            self.store = None
+        self.raise_error()
@@ -0,0 +1,37 @@
+import os
+import sys
+
+import cv2
+import numpy as np
+import pandas as pd
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+# seg.data builds its module level test loader from ./data/test_set_pixel_size.csv
+os.chdir(ROOT)
+
+
+@pytest.fixture
+def training_set(tmp_path):
+    """
+        Tiny training set: 6 noisy scans with a filled ellipse mask each, returns (root, csv path)
+    """
+    root = tmp_path / "training_set"
+    root.mkdir()
+    rng = np.random.RandomState(0)
+
+    rows = list()
+    for i in range(6):
+        mask = np.zeros((60, 80), np.uint8)
+        cv2.ellipse(mask, (40 + i, 30), (20 + i, 12), 10 * i, 0, 360, 255, -1)
+        image = np.clip(rng.normal(60, 20, mask.shape) + (mask > 0) * 100, 0, 255).astype(np.uint8)
+
+        cv2.imwrite(str(root / "{}_HC.png".format(i)), image)
+        cv2.imwrite(str(root / "{}_HC_Annotation.png".format(i)), mask)
+        rows.append({"filename": "{}_HC.png".format(i), "pixel size(mm)": 0.1 + 0.01 * i})
+
+    csv_path = tmp_path / "train.csv"
+    pd.DataFrame(rows).to_csv(csv_path, index=False)
+
+    return str(root), str(csv_path)
@@ -0,0 +1,54 @@
+import numpy as np
+
+from seg.cache import PredictionCache
+
+ELLIPSE = ((12.5, 20.25), (30., 18.5), 42.)
+
+
+def random_mask(seed, shape=(32, 48)):
+    return (np.random.RandomState(seed).uniform(size=shape) > 0.5).astype(np.float32)
+
+
+def test_prediction_cache_round_trip(tmp_path):
+    mask = random_mask(0)
+    with PredictionCache(str(tmp_path), "model") as cache:
+        assert cache.get(b"image", 0.1) is None
+        cache.put(b"image", ELLIPSE, mask, 0.1)
+
+    # persisted on disk, keyed by the image, the pixel size, the model and the settings
+    with PredictionCache(str(tmp_path), "model") as cache:
+        ellipse, cached_mask = cache.get(b"image", 0.1)
+        assert ellipse == ELLIPSE
+        assert cached_mask.dtype == np.uint8
+        np.testing.assert_array_equal(cached_mask, mask)
+
+        assert cache.get(b"image", 0.2) is None
+        assert cache.get(b"other image", 0.1) is None
+        assert (cache.hits, cache.misses) == (1, 2)
+
+    with PredictionCache(str(tmp_path), "retrained model") as cache:
+        assert cache.get(b"image", 0.1) is None
+    with PredictionCache(str(tmp_path), "model", settings={"image_size": [64, 96, 1]}) as cache:
+        assert cache.get(b"image", 0.1) is None
+
+
+def test_prediction_cache_without_masks(tmp_path):
+    with PredictionCache(str(tmp_path), "model", store_masks=False) as cache:
+        cache.put(b"image", ELLIPSE, random_mask(0))
+
+        assert cache.get(b"image") == (ELLIPSE, None)
+
+
+def test_prediction_cache_evicts_the_least_recently_used(tmp_path):
+    # same mask: every entry has the same size
+    mask = random_mask(0)
+    with PredictionCache(str(tmp_path), "model") as cache:
+        cache.put(b"first", ELLIPSE, mask)
+        cache.max_bytes = 2 * cache.size()
+        cache.put(b"second", ELLIPSE, mask)
+        cache.get(b"first")
+        cache.put(b"third", ELLIPSE, mask)
+
+        assert len(cache) == 2
+        assert cache.get(b"second") is None
+        assert cache.get(b"first") is not None and cache.get(b"third") is not None
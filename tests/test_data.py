@@ -0,0 +1,68 @@
+import pytest
+import numpy as np
+import tensorflow as tf
+
+from seg.data import DataLoader
+
+
+def loader(root, csv_path, **kwargs):
+    return DataLoader(root, mode="valid", one_hot_encoding=True, palette=[255], image_size=(32, 48, 1),
+                      csv_path=csv_path, **kwargs)
+
+
+def epoch(data):
+    return [(image.numpy(), mask.numpy()) for image, mask in data]
+
+
+def test_evaluation_epochs_are_identical(training_set):
+    root, csv_path = training_set
+    data = loader(root, csv_path).data_gen(4)
+
+    for (image, mask), (image_2, mask_2) in zip(epoch(data), epoch(data)):
+        np.testing.assert_array_equal(image, image_2)
+        np.testing.assert_array_equal(mask, mask_2)
+
+
+def test_evaluation_inputs_do_not_depend_on_the_order(training_set):
+    root, csv_path = training_set
+    data = loader(root, csv_path).data_gen(1, shuffle=True)
+
+    def images():
+        return sorted(float(image.sum()) for image, _ in epoch(data))
+
+    assert images() == images()
+
+
+def test_augmentation_is_seeded(training_set):
+    root, csv_path = training_set
+
+    first = epoch(loader(root, csv_path, augmentation=True).data_gen(3, shuffle=True))
+    second = epoch(loader(root, csv_path, augmentation=True).data_gen(3, shuffle=True))
+    for (image, mask), (image_2, mask_2) in zip(first, second):
+        np.testing.assert_array_equal(image, image_2)
+        np.testing.assert_array_equal(mask, mask_2)
+
+
+@pytest.mark.parametrize("params", [dict(theta=10.), dict(tx=4., ty=-6.), dict(zx=1.2, zy=1.2),
+                                    dict(theta=-12., tx=3., ty=2.)])
+def test_affine_transform_matches_keras(training_set, params):
+    root, csv_path = training_set
+    x = np.zeros((41, 41, 1), np.float32)
+    x[5:20, 10:35] = np.random.RandomState(0).uniform(size=(15, 25, 1))
+
+    expected = tf.keras.preprocessing.image.apply_affine_transform(x, row_axis=0, col_axis=1, channel_axis=2,
+                                                                   **params)
+    transformed = loader(root, csv_path)._affine_transform(tf.constant(x), "BILINEAR", **params)
+    np.testing.assert_allclose(transformed.numpy(), expected, atol=1e-4)
+
+
+def test_geometric_augmentations_keep_hard_masks(training_set):
+    root, csv_path = training_set
+    data = loader(root, csv_path)
+    image = tf.random.uniform((32, 48, 1))
+    mask = tf.cast(tf.random.uniform((32, 48, 1)) > 0.5, tf.float32)
+
+    for seed in range(8):
+        for augment_func in (data.rotate, data.shift, data.zoom):
+            _, augmented = augment_func(image, mask, tf.constant([seed, 0], tf.int64))
+            assert set(np.unique(augmented.numpy())) <= {0., 1.}
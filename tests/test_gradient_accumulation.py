@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+import tensorflow as tf
+from tensorflow.keras import Input
+from tensorflow.keras.models import Model
+from tensorflow.keras.layers import Conv2D
+
+from seg.GradientAccumulationModel import with_gradient_accumulation
+
+
+def updated_weights(accum_steps, x, y):
+    # no BatchNormalization: the micro-batches normalise with their own statistics
+    tf.keras.utils.set_random_seed(0)
+    inputs = Input((16, 16, 1))
+    outputs = Conv2D(1, 1, activation="sigmoid")(Conv2D(4, 3, padding="same", activation="relu")(inputs))
+    model = with_gradient_accumulation(Model(inputs, outputs), accum_steps)
+    model.compile(optimizer=tf.keras.optimizers.SGD(learning_rate=0.5), loss="binary_crossentropy")
+
+    model.train_on_batch(x, y)
+
+    return model.get_weights()
+
+
+@pytest.mark.parametrize("batch_size, accum_steps", [(8, 4), (7, 3), (2, 4)])
+def test_accumulated_update_is_the_full_batch_update(batch_size, accum_steps):
+    x = np.random.RandomState(0).uniform(size=(batch_size, 16, 16, 1)).astype(np.float32)
+    y = (x > 0.5).astype(np.float32)
+
+    full_batch = updated_weights(1, x, y)
+    accumulated = updated_weights(accum_steps, x, y)
+
+    assert not np.allclose(full_batch[0], updated_weights(1, x[:1], y[:1])[0])
+    for w, w_accum in zip(full_batch, accumulated):
+        np.testing.assert_allclose(w_accum, w, atol=1e-6)
@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+import tensorflow as tf
+from tensorflow.keras.layers import BatchNormalization, Dropout
+
+from seg.architect.Unet import unet
+from seg.architect.DilateUnet import dilate_unet
+from seg.architect.AttentionUnet import attention_unet
+from seg.architect.MobileUnet import mobile_unet, mobile_attention_unet
+from seg.utils import foldable_batchnorms, optimize_for_inference
+
+
+def random_statistics(model, rs):
+    # freshly built BatchNormalization layers are almost the identity, folding them would test nothing
+    for layer in model.layers:
+        if isinstance(layer, BatchNormalization):
+            gamma, beta, mean, variance = layer.get_weights()
+            layer.set_weights([rs.uniform(0.5, 1.5, gamma.shape), rs.normal(0., 0.1, beta.shape),
+                               rs.normal(0., 0.1, mean.shape), rs.uniform(0.5, 1.5, variance.shape)])
+
+
+@pytest.mark.parametrize("builder", [unet, dilate_unet, attention_unet, mobile_unet, mobile_attention_unet])
+def test_folded_model_matches(builder):
+    tf.keras.utils.set_random_seed(0)
+    model = builder(input_size=(32, 48, 1), n_filters=8)
+    random_statistics(model, np.random.RandomState(0))
+    folds = foldable_batchnorms(model)
+
+    lean = optimize_for_inference(model, verify=False)
+
+    assert len(folds) > 0
+    assert not any(isinstance(layer, Dropout) for layer in lean.layers)
+    n_batchnorms = sum(isinstance(layer, BatchNormalization) for layer in model.layers)
+    assert sum(isinstance(layer, BatchNormalization) for layer in lean.layers) == n_batchnorms - len(folds)
+
+    x = np.random.RandomState(1).uniform(size=(4, 32, 48, 1)).astype(np.float32)
+    np.testing.assert_allclose(lean(x, training=False).numpy(), model(x, training=False).numpy(), atol=1e-5)
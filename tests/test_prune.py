@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+import tensorflow as tf
+from tensorflow.keras.layers import BatchNormalization
+
+from seg.architect.Unet import unet
+from seg.architect.DilateUnet import dilate_unet
+from seg.prune import prunable_groups, outbound_layers, select_filters, prune_model
+
+
+def silence_filters(model, rs):
+    """
+        Zeroes gamma and beta of half of the filters of every group: their channels are 0 after the
+        BatchNormalization, so removing them must not change the output. Returns the kept filters.
+    """
+    kept = {}
+    for group in prunable_groups(model):
+        n_filters = group[0].filters
+        drop = rs.choice(n_filters, n_filters // 2, replace=False)
+        for conv in group:
+            bn, = outbound_layers(model, conv)
+            assert isinstance(bn, BatchNormalization)
+            gamma, beta, mean, variance = bn.get_weights()
+            gamma[drop], beta[drop] = 0., 0.
+            bn.set_weights([gamma, beta, mean, variance])
+            kept[conv.name] = np.setdiff1d(np.arange(n_filters), drop)
+
+    return kept
+
+
+@pytest.mark.parametrize("builder", [unet, dilate_unet])
+def test_pruned_model_keeps_the_output(builder):
+    tf.keras.utils.set_random_seed(0)
+    model = builder(input_size=(32, 48, 1), n_filters=16)
+    kept = silence_filters(model, np.random.RandomState(0))
+
+    keep = select_filters(model, ratio=0.5)
+    assert set(keep) == set(kept)
+    for name, indices in keep.items():
+        np.testing.assert_array_equal(indices, kept[name])
+
+    pruned = prune_model(model, ratio=0.5)
+    assert pruned.output_shape == model.output_shape
+    assert pruned.count_params() < model.count_params()
+    for name, indices in keep.items():
+        assert pruned.get_layer(name).filters == len(indices) == model.get_layer(name).filters // 2
+
+    x = np.random.RandomState(1).uniform(size=(2, 32, 48, 1)).astype(np.float32)
+    np.testing.assert_allclose(pruned(x, training=False).numpy(), model(x, training=False).numpy(), atol=1e-5)
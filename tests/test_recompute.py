@@ -0,0 +1,62 @@
+import pytest
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras.layers import BatchNormalization, Dropout
+
+from seg.architect.Unet import unet
+from seg.architect.MobileUnet import mobile_unet
+from seg.utils import flatten_model, foldable_batchnorms, optimize_for_inference, transfer_weights
+
+
+def gradients(model, x, y):
+    # same dropout masks on every call
+    tf.keras.utils.set_random_seed(1)
+    with tf.GradientTape() as tape:
+        loss = tf.reduce_mean(tf.keras.losses.binary_crossentropy(y, model(x, training=True)))
+
+    return [g.numpy() for g in tape.gradient(loss, model.trainable_weights)]
+
+
+def test_recompute_keeps_the_dropout_gradients(monkeypatch):
+    tf.keras.utils.set_random_seed(0)
+    model = mobile_unet(input_size=(32, 48, 1), n_filters=8, dropout_rate=0.5, recompute=True)
+    x = tf.random.uniform((2, 32, 48, 1))
+    y = tf.cast(tf.random.uniform((2, 32, 48, 1)) > 0.5, tf.float32)
+
+    recomputed = gradients(model, x, y)
+    monkeypatch.setattr(tf, "recompute_grad", lambda f: f)
+    stored = gradients(model, x, y)
+
+    for g, g_stored in zip(recomputed, stored):
+        np.testing.assert_allclose(g, g_stored, atol=1e-5)
+
+
+def test_recompute_folds_the_same_batchnorms():
+    tf.keras.utils.set_random_seed(0)
+    plain = unet(input_size=(32, 48, 1), n_filters=8)
+    recomputed = unet(input_size=(32, 48, 1), n_filters=8, recompute=True)
+    transfer_weights(plain, recomputed)
+
+    lean = optimize_for_inference(recomputed)
+    lean_plain = optimize_for_inference(plain)
+
+    assert len(foldable_batchnorms(flatten_model(recomputed))) == len(foldable_batchnorms(plain)) == 18
+    assert [layer.name for layer in lean.layers] == [layer.name for layer in flatten_model(recomputed).layers
+                                                     if not isinstance(layer, (BatchNormalization, Dropout))]
+    x = np.random.uniform(size=(2, 32, 48, 1)).astype(np.float32)
+    np.testing.assert_allclose(lean(x).numpy(), lean_plain(x).numpy(), atol=1e-5)
+
+
+def test_transfer_weights_across_recompute():
+    tf.keras.utils.set_random_seed(0)
+    plain = mobile_unet(input_size=(32, 48, 1), n_filters=8)
+    recomputed = mobile_unet(input_size=(32, 48, 1), n_filters=8, recompute=True)
+    x = np.random.uniform(size=(2, 32, 48, 1)).astype(np.float32)
+
+    with pytest.raises(ValueError):
+        recomputed.set_weights(plain.get_weights())
+
+    transfer_weights(plain, recomputed)
+    np.testing.assert_allclose(recomputed(x).numpy(), plain(x).numpy(), atol=1e-6)
+
+    transfer_weights(recomputed, mobile_unet(input_size=(32, 48, 1), n_filters=8))
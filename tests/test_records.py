@@ -0,0 +1,74 @@
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+
+from seg.data import DataLoader
+from seg.records import write_shards, read_shards
+from seg.train import steps_per_epoch
+
+
+def loader(root, csv_path, records_dir=None, mode="train"):
+    return DataLoader(root, mode=mode, one_hot_encoding=True, palette=[255], image_size=(32, 48, 1),
+                      csv_path=csv_path, records_dir=records_dir)
+
+
+def test_shards_hold_every_row(training_set, tmp_path):
+    root, csv_path = training_set
+    path = write_shards(pd.read_csv(csv_path), root, str(tmp_path / "records"), n_shards=4)
+
+    data = read_shards(path)
+    assert int(data.cardinality()) == 6
+    assert sorted(int(example["index"]) for example in data) == list(range(6))
+
+
+def test_train_from_shards(training_set, tmp_path):
+    root, csv_path = training_set
+    write_shards(pd.read_csv(csv_path), root, str(tmp_path / "records"), n_shards=3)
+
+    data_set = loader(root, csv_path, str(tmp_path / "records"))
+    assert data_set.records is not None
+    train_gen = data_set.data_gen(4, shuffle=True)
+    assert steps_per_epoch(train_gen) == 2
+
+    inputs = tf.keras.Input((32, 48, 1))
+    outputs = tf.keras.layers.Conv2D(1, 3, padding="same", activation="sigmoid")(inputs)
+    model = tf.keras.Model(inputs, outputs)
+    model.compile(optimizer="sgd", loss="binary_crossentropy")
+    history = model.fit(train_gen, epochs=1, verbose=0)
+
+    assert np.isfinite(history.history["loss"][0])
+
+
+def test_shuffled_shards_keep_the_csv_rows(training_set, tmp_path):
+    root, csv_path = training_set
+    write_shards(pd.read_csv(csv_path), root, str(tmp_path / "records"), mode="valid", n_shards=3)
+
+    images = {int(index): image.numpy()
+              for index, image, _ in loader(root, csv_path).dataset(with_index=True)}
+    shuffled = loader(root, csv_path, str(tmp_path / "records"), mode="valid")
+    assert shuffled.records is not None
+    indices = list()
+    for index, image, _ in shuffled.dataset(shuffle=True, with_index=True):
+        indices.append(int(index))
+        np.testing.assert_array_equal(image.numpy(), images[int(index)])
+
+    assert sorted(indices) == list(range(6))
+    assert indices != list(range(6))
+
+
+def test_teacher_masks_follow_the_csv_rows(training_set, tmp_path):
+    from seg.train import cache_teacher_predictions, distillation_data_gen
+
+    root, csv_path = training_set
+    write_shards(pd.read_csv(csv_path), root, str(tmp_path / "records"), mode="valid", n_shards=3)
+
+    inputs = tf.keras.Input((32, 48, 1))
+    outputs = tf.keras.layers.Conv2D(1, 3, padding="same", activation="sigmoid")(inputs)
+    teacher = tf.keras.Model(inputs, outputs)
+    teacher.save(str(tmp_path / "teacher.hdf5"))
+
+    data_set = loader(root, csv_path, str(tmp_path / "records"), mode="valid")
+    assert data_set.records is not None
+    cache_path = cache_teacher_predictions(str(tmp_path / "teacher.hdf5"), data_set, str(tmp_path / "teacher"), 4)
+    for images, targets in distillation_data_gen(data_set, cache_path, 4, shuffle=True):
+        np.testing.assert_allclose(targets[..., 1:], teacher(images).numpy(), atol=1e-3)
@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+
+from seg.rle import rle_encode, rle_decode, rle_encode_rows, rle_decode_rows
+from seg.maskstore import MaskStore
+
+
+def random_masks():
+    rs = np.random.RandomState(0)
+    masks = [rs.uniform(size=(h, w)) < density
+             for h, w in [(1, 1), (7, 13), (64, 96), (216, 320)]
+             for density in (0.05, 0.5, 0.95)]
+
+    return masks + [np.zeros((5, 9), bool), np.ones((5, 9), bool)]
+
+
+@pytest.mark.parametrize("mask", random_masks())
+def test_rle_round_trip(mask):
+    np.testing.assert_array_equal(rle_decode(rle_encode(mask), mask.shape), mask)
+    np.testing.assert_array_equal(rle_decode_rows(*rle_encode_rows(mask), mask.shape), mask)
+
+
+def test_mask_store_round_trip(tmp_path):
+    path = str(tmp_path / "masks.store")
+    probabilities = {"{:03d}_HC.png".format(i): mask * np.random.RandomState(i).uniform(0.51, 1., mask.shape)
+                     for i, mask in enumerate(random_masks())}
+
+    with MaskStore(path, mode="w") as store:
+        for filename, probability in probabilities.items():
+            store.write(filename, probability[..., np.newaxis])
+
+    store = MaskStore(path)
+    assert store.keys() == list(probabilities)
+    for filename, mask in store.items():
+        assert mask.dtype == np.uint8
+        np.testing.assert_array_equal(mask, probabilities[filename] > 0.5)
+
+
+def test_empty_mask_store(tmp_path):
+    path = str(tmp_path / "masks.store")
+    MaskStore(path, mode="w").close()
+
+    assert len(MaskStore(path)) == 0
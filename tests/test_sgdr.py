@@ -0,0 +1,47 @@
+import numpy as np
+
+from seg.SGDRScheduler import SGDRSchedule, SGDRScheduler
+
+
+def cosine(epoch, min_lr=1e-5, max_lr=1e-2, lr_decay=0.9):
+    # cycle_length=10, mult_factor=2: restarts at the epochs 10, 30, 70
+    starts, lengths = [0, 10, 30, 70], [10, 20, 40, 80]
+    cycle = np.searchsorted(starts, epoch, side="right") - 1
+    fraction = (epoch - np.take(starts, cycle)) / np.take(lengths, cycle)
+
+    return min_lr + 0.5 * (max_lr * lr_decay ** cycle - min_lr) * (1. + np.cos(fraction * np.pi))
+
+
+def scheduler(steps_per_epoch):
+    return SGDRScheduler(min_lr=1e-5, max_lr=1e-2, steps_per_epoch=steps_per_epoch,
+                         lr_decay=0.9, cycle_length=10, mult_factor=2)
+
+
+def test_schedule_follows_the_cosine_cycles():
+    schedule = SGDRSchedule(min_lr=1e-5, max_lr=1e-2, steps_per_epoch=100,
+                            lr_decay=0.9, cycle_length=10, mult_factor=2)
+    epochs = np.arange(0, 100, 0.25)
+
+    assert schedule.restart_epochs[:3] == [10, 30, 70]
+    np.testing.assert_allclose(schedule(epochs * 100).numpy(), cosine(epochs), rtol=1e-4)
+
+
+def test_start_phase_keeps_the_curve_over_the_epochs():
+    reference = scheduler(100).schedule
+    lr_scheduler = scheduler(100)
+
+    first = lr_scheduler.start_phase(100, 0, last_phase=False)
+    np.testing.assert_allclose(first(np.arange(400)).numpy(), reference(np.arange(400)).numpy())
+
+    # 4 epochs of 100 steps, then 4x larger batches from epoch 4 with a new optimizer
+    lr_scheduler.steps = 400
+    second = lr_scheduler.start_phase(25, 4)
+    assert second.restart_epochs == reference.restart_epochs
+    np.testing.assert_allclose(second(np.arange(0, 800, 25)).numpy(),
+                               reference(np.arange(400, 3600, 100)).numpy(), rtol=1e-5)
+
+    lr_scheduler.steps = 200
+    history = lr_scheduler.lr_history()
+    assert len(history["lr"]) == 600
+    np.testing.assert_allclose(history["lr"][:400], reference(np.arange(400)).numpy())
+    np.testing.assert_allclose(history["lr"][400::25], reference(np.arange(400, 1200, 100)).numpy(), rtol=1e-5)